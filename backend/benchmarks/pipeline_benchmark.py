@@ -0,0 +1,540 @@
+# benchmarks/pipeline_benchmark.py
+"""End-to-end benchmark of the segmentation pipeline without GPU, registry or containers.
+
+Generates synthetic studies (flair, t1, t1km, t2) of a configurable size as NIfTI files or DICOM series, zips them
+like an upload and runs them through the code of the API and the workers:
+
+    ingest              extraction of the study zip into the raw folders (ingest.py)
+    classify            classification of the DICOM sequences (dicom_classifier.py), DICOM only
+    preprocessing_task  with all of its stages (staging, container run, nifti_to_dicom, min_max_values, ...)
+    prediction_task     with all of its stages
+    zip                 the archives for the viewer, built in-process instead of by the archive workers
+
+The Docker client of tasks.py is replaced by FakeDockerClient. Its containers run stand-ins of the preprocessing and
+the model entry points in-process or as subprocesses: they read the mounted inputs and write outputs of the right
+names, shapes and types, so everything around the containers runs like in production. The stages are the spans of
+metrics.py, the benchmark records their durations and the peak RSS of the process while they run (in subprocess
+mode the memory of the stand-ins is not included).
+
+The tasks write into the image repository, so run the benchmark in the worker container:
+
+    docker compose exec worker python -m benchmarks.pipeline_benchmark --format both --shape 192 192 160 -n 5
+
+--json writes the results, --baseline compares the p50 of every stage with an earlier result and exits with 1 if a
+stage got slower by more than --max-regression.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from contextlib import contextmanager
+
+import docker.errors
+import numpy as np
+import SimpleITK as sitk
+
+# Before the tasks are imported: bind mounts with the same paths on the "host" and one-shot containers
+os.environ.setdefault("DATA_PATH", "/usr/src/image-repository")
+os.environ["MODEL_SERVER_MODE"] = "oneshot"
+os.environ["INPUT_STAGING_MODE"] = "bind"
+
+from flask import Flask
+
+from server.database import db
+from server.images import helper as images_helper
+from server.main import dicom_classifier, image_registry, ingest, metrics, nifti2dicom, preprocessing_cache, result_cache, scheduler, tasks
+from server.models import DisplayValues, Project, Segmentation, Sequence, User
+
+repository_path = "/usr/src/image-repository"
+user_name = "benchmark"
+domain = "local"
+sequence_types = ["flair", "t1", "t1km", "t2"]
+rss_sample_interval = 0.005
+
+
+############################################
+############ Stage measurement #############
+############################################
+
+def get_rss() -> int:
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Only the peak is available, e.g. on macOS (in bytes there)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageRecorder:
+    """Replaces metrics.stage and metrics.record_stage. Collects the durations of all spans and samples the RSS in a
+    background thread to get the peak of each running stage."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.peak_rss = defaultdict(int)
+        self.active = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.stopped.wait(rss_sample_interval):
+            rss = get_rss()
+            with self.lock:
+                for entry in self.active:
+                    entry[1] = max(entry[1], rss)
+
+    @contextmanager
+    def stage(self, name):
+        entry = [name, get_rss()]
+        with self.lock:
+            self.active.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.active.remove(entry)
+            self.add(name, duration, max(entry[1], get_rss()))
+
+    def record_stage(self, name, duration, started_at=None):
+        # Spans that were measured elsewhere, e.g. inside a container, have no memory sample
+        self.add(name, duration, 0)
+
+    def add(self, name, duration, rss):
+        with self.lock:
+            self.durations[name].append(duration)
+            self.peak_rss[name] = max(self.peak_rss[name], rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def summary(self) -> dict:
+        results = {}
+        for name, durations in self.durations.items():
+            durations = np.array(durations)
+            results[name] = {
+                "count": len(durations),
+                "mean": float(durations.mean()),
+                "p50": float(np.percentile(durations, 50)),
+                "p95": float(np.percentile(durations, 95)),
+                # Runs of the stage per second of stage time
+                "throughput": float(len(durations) / durations.sum()) if durations.sum() > 0 else None,
+                "peak_rss_mb": self.peak_rss[name] / 1024 ** 2 if self.peak_rss[name] else None,
+            }
+        return results
+
+
+############################################
+########### Docker client stand-in #########
+############################################
+
+def fake_preprocessing(input_files, output_dir):
+    """Stand-in of preprocessing/src/main.py: reads the DICOM series or NIfTI files and writes the registered
+    sequences (nifti_<seq>_register.nii.gz) and timings.json into the output folder. prediction_task passes
+    <seq>.nii.gz of the preprocessed folder to the model, so the sequences are written under these names as well."""
+    started_at = time.time()
+    images = {}
+    for name, path in input_files.items():
+        if os.path.isdir(path):
+            reader = sitk.ImageSeriesReader()
+            reader.SetFileNames(reader.GetGDCMSeriesFileNames(path))
+            images[name] = reader.Execute()
+        else:
+            # nifti_t1.nii.gz -> t1
+            images[name[len("nifti_"):-len(".nii.gz")]] = sitk.ReadImage(path)
+
+    # The NIfTI preprocessing only gets t1 and t2, the other sequences are derived from them
+    first_image = next(iter(images.values()))
+    for seq in ["flair", "t1", "t1c", "t2"]:
+        image = images.get(seq, first_image)
+        # Skull strip: mask everything outside of the "brain"
+        image = sitk.Mask(image, sitk.Cast(image > 0, sitk.sitkUInt8))
+        image = sitk.Cast(image, sitk.sitkFloat32)
+        sitk.WriteImage(image, os.path.join(output_dir, f"nifti_{seq}_register.nii.gz"))
+        sitk.WriteImage(image, os.path.join(output_dir, f"{'t1km' if seq == 't1c' else seq}.nii.gz"))
+
+    with open(os.path.join(output_dir, "timings.json"), "w") as f:
+        json.dump([{"stage": "preprocessing_entrypoint", "started_at": started_at, "duration": time.time() - started_at}], f)
+    print(f"Preprocessed {sorted(images)} in {time.time() - started_at:.2f}s")
+
+
+def fake_prediction(input_files, output_dir, resampled_data_exists):
+    """Stand-in of a model: thresholds the first input into a label map. Models with resampled data (SynthSeg) also
+    write resampled/_0000_resampled.nii.gz."""
+    image = sitk.ReadImage(input_files["_0000.nii.gz"])
+    array = sitk.GetArrayFromImage(image)
+    labels = sitk.GetImageFromArray((array > array.mean()).astype(np.uint8))
+    labels.CopyInformation(image)
+    sitk.WriteImage(labels, os.path.join(output_dir, "prediction.nii.gz"))
+
+    if resampled_data_exists:
+        os.makedirs(os.path.join(output_dir, "resampled"), exist_ok=True)
+        sitk.WriteImage(image, os.path.join(output_dir, "resampled", "_0000_resampled.nii.gz"))
+    print(f"Predicted {array.shape}")
+
+
+def run_entrypoint(kind, input_files, output_dir, resampled_data_exists):
+    if kind == "preprocessing":
+        fake_preprocessing(input_files, output_dir)
+    else:
+        fake_prediction(input_files, output_dir, resampled_data_exists)
+
+
+class FakeImage:
+    def __init__(self, tag):
+        self.tags = [tag]
+        self.id = f"sha256:benchmark-{tag}"
+
+
+class FakeImages:
+    def __init__(self, client):
+        self.client = client
+
+    def list(self):
+        return [FakeImage(tag) for tag in self.client.image_tags]
+
+    def get(self, tag):
+        if tag not in self.client.image_tags:
+            raise docker.errors.ImageNotFound(f"No such image: {tag}")
+        return FakeImage(tag)
+
+    def build(self, path, tag, **kwargs):
+        self.client.image_tags.add(tag)
+        return FakeImage(tag), []
+
+
+class FakeContainer:
+    def __init__(self, client, image, name, volumes=None, mounts=None, **kwargs):
+        self.client = client
+        self.image = image
+        self.name = name
+        # Container path -> host path
+        self.binds = {mount["Target"]: mount["Source"] for mount in mounts or []}
+        self.binds.update({bind["bind"]: host_path for host_path, bind in (volumes or {}).items()})
+        self.temp_dirs = []
+        self.log_lines = []
+
+    def put_archive(self, path, data):
+        temp_dir = tempfile.mkdtemp(prefix="benchmark-container-")
+        self.temp_dirs.append(temp_dir)
+        with tarfile.open(fileobj=data) as tar:
+            tar.extractall(temp_dir)
+        self.binds[path] = temp_dir
+        return True
+
+    def get_inputs(self, container_path) -> dict:
+        """The files and folders that are mounted in container_path, by name."""
+        inputs = {}
+        for target, source in self.binds.items():
+            if target.startswith(f"{container_path}/"):
+                inputs[target[len(container_path) + 1:]] = source
+            elif target == container_path:
+                inputs.update({name: os.path.join(source, name) for name in os.listdir(source)})
+        return inputs
+
+    def start(self):
+        if self.image == image_registry.PREPROCESSING_IMAGE:
+            kind = "preprocessing"
+            input_path = next(path for path in ["/app/input/dicom", "/app/input/nifti"] if self.get_inputs(path))
+            input_files = self.get_inputs(input_path)
+            output_dir = self.binds["/app/output/nifti"]
+            resampled_data_exists = False
+        else:
+            kind = "prediction"
+            config = tasks.model_config(self.image, "")
+            input_files = self.get_inputs("/app/input")
+            output_dir = self.binds[config["output_path"]]
+            resampled_data_exists = config.get("resampledDataExists", False)
+
+        if self.client.container_mode == "subprocess":
+            process = subprocess.run(
+                [sys.executable, "-m", "benchmarks.pipeline_benchmark", "--entrypoint", kind, json.dumps(input_files), output_dir, str(resampled_data_exists)],
+                capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            self.log_lines = (process.stdout + process.stderr).splitlines(keepends=True)
+            if process.returncode != 0:
+                raise Exception(f"Entrypoint of {self.image} failed: {process.stderr}")
+        else:
+            run_entrypoint(kind, input_files, output_dir, resampled_data_exists)
+            self.log_lines = [f"{kind} finished in-process\n"]
+
+    def logs(self, stream=False):
+        return iter(line.encode("utf-8") for line in self.log_lines)
+
+    def wait(self):
+        for temp_dir in self.temp_dirs:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return {"StatusCode": 0}
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, image, name, **kwargs):
+        return FakeContainer(self.client, image, name, **kwargs)
+
+    def list(self, *args, **kwargs):
+        return []
+
+
+class FakeDockerClient:
+    """The part of docker.DockerClient that tasks.py uses."""
+
+    def __init__(self, container_mode="inprocess"):
+        self.container_mode = container_mode
+        # The images exist, building one would need the Redis lock of image_registry.ensure_image
+        self.image_tags = {image_registry.PREPROCESSING_IMAGE, *image_registry.MODEL_IMAGES}
+        self.images = FakeImages(self)
+        self.containers = FakeContainers(self)
+
+    def ping(self):
+        return True
+
+
+class FakeRedis:
+    """The part of a Redis connection that result_cache.py uses to memoize the hashes of the input files."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode("utf-8")
+
+
+############################################
+############ Synthetic studies #############
+############################################
+
+def make_volume(shape, seed, intensity) -> sitk.Image:
+    """A noisy ellipsoid "head" with an inner "brain", shape is (x, y, z)."""
+    rng = np.random.default_rng(seed)
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, size) for size in reversed(shape)], indexing="ij")
+    radius = x ** 2 + y ** 2 + z ** 2
+    array = np.where(radius < 0.8, intensity * 0.4, 0) + np.where(radius < 0.5, intensity * 0.6, 0)
+    array = (array + rng.normal(0, intensity * 0.05, array.shape)) * (radius < 0.8)
+    image = sitk.GetImageFromArray(np.clip(array, 0, None).astype(np.int16))
+    image.SetSpacing((1.0, 1.0, 1.0))
+    return image
+
+
+def write_dicom_series(image, dest_path, description, seed):
+    """Write the volume as a DICOM series with the tags the classifier and the conversion read."""
+    os.makedirs(dest_path)
+    uid_root = f"1.2.826.0.1.3680043.8.498.{seed + 1}"
+    series_tag_values = [
+        ("0008|0060", "MR"),
+        ("0008|103e", description),
+        ("0008|0016", "1.2.840.10008.5.1.4.1.1.4"),
+        ("0020|000d", f"{uid_root}.1"),
+        ("0020|000e", f"{uid_root}.{abs(hash(description)) % 10 ** 8}"),
+        ("0018|0050", "1.0"),
+        ("0018|0088", "1.0"),
+        ("0028|1050", "500"),
+        ("0028|1051", "1000"),
+        ("0020|0037", "1\\0\\0\\0\\1\\0"),
+    ]
+    nifti2dicom.write_series(image, series_tag_values, dest_path)
+
+
+def make_study(study_path, file_format, shape, seed) -> str:
+    """Write a study with one sequence per type and zip it like the frontend. Returns the path of the zip."""
+    descriptions = {"flair": "t2_flair_tra", "t1": "t1_mprage_tra", "t1km": "t1_mprage_tra_km", "t2": "t2_tse_tra"}
+    for index, seq in enumerate(sequence_types):
+        image = make_volume(shape, seed * 10 + index, 800 + 200 * index)
+        if file_format == "dicom":
+            write_dicom_series(image, os.path.join(study_path, seq), descriptions[seq], seed * 10 + index)
+        else:
+            os.makedirs(study_path, exist_ok=True)
+            sitk.WriteImage(image, os.path.join(study_path, f"{seq}.nii"))
+
+    zip_path = f"{study_path}.zip"
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
+        for root, _, files in os.walk(study_path):
+            for file in sorted(files):
+                z.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), study_path))
+    return zip_path
+
+
+############################################
+################ Pipeline ##################
+############################################
+
+def create_app(database_path) -> Flask:
+    app = Flask("benchmark")
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{database_path}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(user_mail=f"{user_name}@{domain}", password_hash="-"))
+        db.session.commit()
+    return app
+
+
+def run_iteration(recorder, work_path, file_format, shape, model, iteration):
+    study_path = os.path.join(work_path, f"study-{file_format}-{iteration}")
+    zip_path = make_study(study_path, file_format, shape, iteration)
+    sequence_names = {seq: seq if file_format == "dicom" else f"{seq}.nii" for seq in sequence_types}
+
+    with tasks.app.app_context():
+        project = Project(user_id=1, project_name=f"{file_format}{iteration}", file_format=file_format)
+        db.session.add(project)
+        db.session.flush()
+        sequences = {}
+        for seq, sequence_name in sequence_names.items():
+            sequence = Sequence(project_id=project.project_id, sequence_name=sequence_name, sequence_type=seq, selected=True)
+            db.session.add(sequence)
+            db.session.flush()
+            sequences[seq] = sequence
+        display_values = DisplayValues()
+        db.session.add(display_values)
+        db.session.flush()
+        segmentation = Segmentation(project_id=project.project_id, display_values=display_values.display_values_id, model=model,
+                                    status="QUEUEING", segmentation_name="benchmark",
+                                    **{f"{seq}_sequence": sequence.sequence_id for seq, sequence in sequences.items()})
+        db.session.add(segmentation)
+        db.session.commit()
+        project_id, project_name, segmentation_id = project.project_id, project.project_name, segmentation.segmentation_id
+        sequence_ids_and_names = {seq: (sequence.sequence_id, sequence.sequence_name) for seq, sequence in sequences.items()}
+
+    project_path = os.path.join(repository_path, f"1-{user_name}-{domain}", f"{project_id}-{project_name}")
+    sequence_directories = {}
+    nifti_targets = {}
+    for seq, (sequence_id, sequence_name) in sequence_ids_and_names.items():
+        sequence_directories[sequence_name] = os.path.join(project_path, "raw", f"{sequence_id}-{sequence_name}")
+        nifti_targets[sequence_name] = os.path.join(sequence_directories[sequence_name], f"{sequence_id}.nii.gz")
+        os.makedirs(sequence_directories[sequence_name])
+    os.makedirs(os.path.join(project_path, "preprocessed"))
+    os.makedirs(os.path.join(project_path, "segmentations", f"{segmentation_id}-benchmark"))
+
+    with recorder.stage("ingest"):
+        if file_format == "dicom":
+            ingest.extract_dicom_sequences(zip_path, sequence_directories)
+        else:
+            ingest.extract_nifti_sequences(zip_path, nifti_targets)
+    if file_format == "dicom":
+        with recorder.stage("classify"):
+            dicom_classifier.classify_zip(zip_path)
+
+    with recorder.stage("preprocessing_task"):
+        tasks.preprocessing_task(1, project_id, segmentation_id, sequence_ids_and_names, user_name, domain, project_name, False)
+    with recorder.stage("prediction_task"):
+        tasks.prediction_task(1, project_id, segmentation_id, sequence_ids_and_names, model, user_name, domain, project_name)
+
+    shutil.rmtree(study_path)
+    os.remove(zip_path)
+
+
+def print_summary(summary):
+    print(f"\n{'stage':<28}{'count':>6}{'p50 [s]':>10}{'p95 [s]':>10}{'mean [s]':>10}{'runs/s':>11}{'peak RSS [MB]':>15}")
+    for name, result in sorted(summary.items()):
+        throughput = f"{result['throughput']:.2f}" if result["throughput"] else "-"
+        peak_rss = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] else "-"
+        print(f"{name:<28}{result['count']:>6}{result['p50']:>10.3f}{result['p95']:>10.3f}{result['mean']:>10.3f}{throughput:>11}{peak_rss:>15}")
+
+
+def compare_with_baseline(summary, baseline_path, max_regression, min_difference) -> list[str]:
+    with open(baseline_path) as f:
+        baseline = json.load(f)["stages"]
+
+    regressions = []
+    for name, result in summary.items():
+        if name in baseline and baseline[name]["p50"] > 0:
+            change = result["p50"] / baseline[name]["p50"] - 1
+            # Stages of a few milliseconds are mostly noise
+            if change > max_regression and result["p50"] - baseline[name]["p50"] > min_difference:
+                regressions.append(f"{name}: p50 {baseline[name]['p50']:.3f}s -> {result['p50']:.3f}s (+{change:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the segmentation pipeline with synthetic studies.")
+    parser.add_argument("-n", "--iterations", type=int, default=3, help="Studies per file format.")
+    parser.add_argument("--format", choices=["dicom", "nifti", "both"], default="both", help="File format of the studies.")
+    parser.add_argument("--shape", type=int, nargs=3, default=[160, 160, 120], metavar=("X", "Y", "Z"), help="Size of the volumes.")
+    parser.add_argument("--model", default="nnunet-model:brainns", help="Model config of the prediction, see helper.model_config.")
+    parser.add_argument("--container-mode", choices=["inprocess", "subprocess"], default="inprocess", help="How the fake containers run the entry points.")
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--baseline", help="Results of an earlier run (--json) to compare the p50 of every stage with.")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed slowdown of a stage compared to the baseline.")
+    parser.add_argument("--min-difference", type=float, default=0.01, help="Slowdowns of less seconds are no regression.")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark folders in the image repository.")
+    parser.add_argument("--entrypoint", nargs=4, metavar=("KIND", "INPUTS", "OUTPUT", "RESAMPLED"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Entry point of a fake container in subprocess mode
+    if args.entrypoint:
+        kind, input_files, output_dir, resampled_data_exists = args.entrypoint
+        run_entrypoint(kind, json.loads(input_files), output_dir, resampled_data_exists == "True")
+        return
+
+    recorder = StageRecorder()
+    metrics.stage = recorder.stage
+    metrics.record_stage = recorder.record_stage
+
+    # No GPU and no Redis: the prediction runs on the CPU and the archives are built in-process
+    model_config = tasks.model_config
+    tasks.model_config = lambda model, segmentation_id: {"resampledDataExists": False, **model_config(model, segmentation_id), "uses_gpu": False}
+    scheduler.enqueue_archive = lambda function, entries, archive_path, *args: images_helper.build_archive(entries, archive_path, *args)
+    tasks.client = FakeDockerClient(args.container_mode)
+    result_cache.connection = FakeRedis()
+
+    user_path = os.path.join(repository_path, f"1-{user_name}-{domain}")
+    if os.path.exists(user_path):
+        shutil.rmtree(user_path)
+    work_path = tempfile.mkdtemp(prefix="brainns-benchmark-")
+    # A cache hit would skip the stages, every study is new anyway
+    preprocessing_cache.cache_path = os.path.join(user_path, ".preprocessing-cache")
+    tasks.app = create_app(os.path.join(work_path, "benchmark.db"))
+
+    file_formats = ["dicom", "nifti"] if args.format == "both" else [args.format]
+    print(f"Benchmarking {args.iterations} studies per format {file_formats} of {args.shape} voxels with {args.model} ({args.container_mode})")
+    start = time.perf_counter()
+    try:
+        for file_format in file_formats:
+            for iteration in range(args.iterations):
+                run_iteration(recorder, work_path, file_format, args.shape, args.model, iteration)
+    finally:
+        recorder.stop()
+        shutil.rmtree(work_path, ignore_errors=True)
+        if not args.keep:
+            shutil.rmtree(user_path, ignore_errors=True)
+    total_time = time.perf_counter() - start
+
+    summary = recorder.summary()
+    print_summary(summary)
+    studies = args.iterations * len(file_formats)
+    print(f"\n{studies} studies in {total_time:.1f}s ({studies / total_time * 60:.1f} studies/min)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"arguments": {key: value for key, value in vars(args).items() if key not in ["json", "baseline", "entrypoint"]},
+                       "total_time": total_time, "stages": summary}, f, indent=2)
+
+    if args.baseline:
+        regressions = compare_with_baseline(summary, args.baseline, args.max_regression, args.min_difference)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import json
 from server.database import db
 from server.models import User, Session, UserSettings
 from server.auth.validation import validate_user_mail, validate_whitelist, validate_password, validate_login
+from server.auth import sessions
 
 auth_blueprint = Blueprint(
     "auth",
@@ -114,6 +115,7 @@ def logout():
         # delete session
         db.session.delete(session)
         db.session.commit()
+        sessions.invalidate(session_token)
 
         # successful logout (client-side removal of token)
         return jsonify({'message': 'Logout of session ' + session_token + 'successful'}), 200
@@ -134,9 +136,9 @@ def getUserID():
     session_token = auth_header.replace('Bearer ', '').strip()
 
     # validate session token
-    session = Session.query.filter_by(session_token=session_token).first()
-    if session is None:
+    user_id = sessions.get_user_id(session_token)
+    if user_id is None:
         return jsonify({'message': 'Invalid session token'}), 401
 
     # successfull validation
-    return jsonify({'message': 'Valid session token', 'user_id': session.user_id}), 200
\ No newline at end of file
+    return jsonify({'message': 'Valid session token', 'user_id': user_id}), 200
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""Lookup of the user of a session token for the authentication middlewares.
+
+Tokens are looked up by the indexed session_token column and only if the session has not expired. The result is
+cached in the process for a short time, so most requests don't need a DB round trip. A cache entry never outlives
+its session: it expires with expires_at, like the rows removed by the delete_old_sessions event (see database.py),
+and logout removes it right away with invalidate().
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from server.models import Session
+
+cache_ttl = int(os.getenv("SESSION_CACHE_TTL", 60))
+cache_max_size = 10000
+
+# session_token -> (user_id, cached until as time.time())
+cache = {}
+cache_lock = threading.Lock()
+
+
+def utc_now():
+    # expires_at is stored as naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def get_user_id(session_token):
+    """Returns the user_id of a valid session token or None."""
+    now = time.time()
+    with cache_lock:
+        entry = cache.get(session_token)
+    if entry is not None and entry[1] > now:
+        return entry[0]
+
+    session = Session.query.filter(Session.session_token == session_token, Session.expires_at > utc_now()).first()
+    if session is None:
+        invalidate(session_token)
+        return None
+
+    expires_in = (session.expires_at - utc_now()).total_seconds()
+    with cache_lock:
+        if len(cache) >= cache_max_size:
+            # Drop the expired entries, or everything if that is not enough
+            for token in [token for token, (_, cached_until) in cache.items() if cached_until <= now]:
+                del cache[token]
+            if len(cache) >= cache_max_size:
+                cache.clear()
+        cache[session_token] = (session.user_id, now + min(cache_ttl, expires_in))
+
+    return session.user_id
+
+
+def invalidate(session_token):
+    with cache_lock:
+        cache.pop(session_token, None)
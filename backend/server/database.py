@@ -1,7 +1,20 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import text
+from sqlalchemy import inspect
 db = SQLAlchemy()
 
+def create_missing_indexes():
+    """db.create_all() doesn't change existing tables, so create the indexes that were added to the models later."""
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                print(f"Creating index {index.name} on {table.name}")
+                index.create(db.engine)
+
 def create_cleanup_event():
     """Erstellt ein MySQL-Event zum regelmäßigen Löschen abgelaufener Sessions."""
     with db.engine.connect() as connection:
@@ -1,8 +1,21 @@
 import os
+import math
 from pathlib import Path
 import zipfile
+import gzip
+import hashlib
+import shutil
+import struct
+import uuid
+from functools import lru_cache
 from io import BytesIO
 
+import numpy as np
+import SimpleITK as sitk
+import zstandard
+
+from server.main import metrics
+
 def get_domain(user_mail):
     # Get the domain of mail adress
     mailDomain = user_mail.split('@')[1]
@@ -31,73 +44,293 @@ def zip_sequence(sequence_path, file_format="dicom"):
     memory_file.seek(0)
     return memory_file
 
-# Returns a zip file in memory, containing the segmentation and its preprocessed data
+# Returns the files of the download archive of a segmentation as (file path, name in the archive) pairs
 # The param segmentation_path is the path to the segmentation file
 # The param preprocessed_path is the path to the directory, which contains the preprocessed data
-def zip_segmentation(segmentation_path, preprocessed_path, file_format):
-    # Create the zip file in memory
-    memory_file = BytesIO()
-    # Using ZIP_STORED archiving for faster runtime (no compression)
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_STORED) as zipf:
-        # The basefolder, the segmentation is in
-        base_folder = f"segmentation"
+def get_segmentation_archive_entries(segmentation_path, preprocessed_path, file_format):
+    entries = []
+    # The basefolder, the segmentation is in
+    base_folder = f"segmentation"
 
-        # Add the segmentation subfolder containing the segmentation
-        file_extension = ".dcm" if file_format == "dicom" else ".nii.gz"
-        for file in os.listdir(segmentation_path):
-            file_path = os.path.join(segmentation_path, file)
-            if file.endswith(file_extension):
-                arcname = os.path.join(base_folder, "segmentation", file)
-                zipf.write(file_path, arcname=arcname)
-        
-        # Handle dicom file structure
-        if file_format == "dicom":
-            # Dicom files are in the subdirectory /dicom
-            preprocessed_path = os.path.join(preprocessed_path, "dicom")
-            # Add the preprocessed subfolder containing all preprocessed files
-            for root, _, files in os.walk(preprocessed_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(file_path, preprocessed_path)
-                    arcname = os.path.join(base_folder, "preprocessed", rel_path)
-                    zipf.write(file_path, arcname=arcname)    
-
-        # Handle nifti file format
-        elif file_format == "nifti":
-            for file in os.listdir(preprocessed_path):
-                file_path = os.path.join(preprocessed_path, file)
-                # Ignore files (and directories) that do not start with nifti
-                if not file.startswith("nifti"):
-                    continue
-                # Add other to zip
-                arcname = os.path.join(base_folder, "preprocessed", file)
-                zipf.write(file_path, arcname=arcname)
+    # Add the segmentation subfolder containing the segmentation
+    file_extension = ".dcm" if file_format == "dicom" else ".nii.gz"
+    for file in sorted(os.listdir(segmentation_path)):
+        file_path = os.path.join(segmentation_path, file)
+        if file.endswith(file_extension):
+            entries.append((file_path, os.path.join(base_folder, "segmentation", file)))
 
-    memory_file.seek(0)
-    return memory_file
+    # Handle dicom file structure
+    if file_format == "dicom":
+        # Dicom files are in the subdirectory /dicom
+        preprocessed_path = os.path.join(preprocessed_path, "dicom")
+        # Add the preprocessed subfolder containing all preprocessed files
+        for root, dirs, files in os.walk(preprocessed_path):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                rel_path = os.path.relpath(file_path, preprocessed_path)
+                entries.append((file_path, os.path.join(base_folder, "preprocessed", rel_path)))
 
-# Returns a zip file in memory, containing the preprocessed data of the preprocessed_path
-def zip_preprocessed_files(preprocessed_path):
-    # Get the preprocessed files
-    t1_path = Path(f'{preprocessed_path}/t1')
-    t1km_path = Path(f'{preprocessed_path}/t1km')
-    t2_path = Path(f'{preprocessed_path}/t2')
-    flair_path = Path(f'{preprocessed_path}/flair')
+    # Handle nifti file format
+    elif file_format == "nifti":
+        for file in sorted(os.listdir(preprocessed_path)):
+            file_path = os.path.join(preprocessed_path, file)
+            # Ignore files (and directories) that do not start with nifti
+            if not file.startswith("nifti"):
+                continue
+            entries.append((file_path, os.path.join(base_folder, "preprocessed", file)))
 
-    # Create the zip file in memory
-    memory_file = BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        # Add all sequences into a separate directory 
-        for directory, folder_name in [(t1_path, 't1'), (t1km_path, 't1km'), (t2_path, 't2'), (flair_path, 'flair')]:
-            if directory.exists() and directory.is_dir():
-                for file in directory.glob('*.*'):
-                    zipf.write(file, arcname=f'{folder_name}/{file.name}')
+    return entries
 
-    memory_file.seek(0)
-    return memory_file
+# Returns the files of the preprocessed data of the preprocessed_path as (file path, name in the archive) pairs
+def get_preprocessed_archive_entries(preprocessed_path):
+    entries = []
+    # Add all sequences into a separate directory
+    for folder_name in ['t1', 't1km', 't2', 'flair']:
+        directory = Path(f'{preprocessed_path}/{folder_name}')
+        if directory.exists() and directory.is_dir():
+            for file in sorted(directory.glob('*.*')):
+                entries.append((str(file), f'{folder_name}/{file.name}'))
+    return entries
+
+def write_zip(entries, fileobj, compression=zipfile.ZIP_STORED):
+    with zipfile.ZipFile(fileobj, 'w', compression) as zipf:
+        for file_path, arcname in entries:
+            zipf.write(file_path, arcname=arcname)
+
+# Archives are built by a background job (see scheduler.enqueue_archive) and stored on disk. Until an archive
+# exists, requests are answered with stream_zip, which sends the zip while it reads the files instead of building
+# it in memory first.
+archive_cache_dir = ".archives"
+archive_chunk_size = 1024 * 1024
+
+class ZipStream:
+    """Write-only file object for zipfile. It has no tell() or seek(), so zipfile writes data descriptors instead of
+    seeking back, and the written bytes can be taken out with pop() and sent right away."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def stream_zip(entries):
+    """Generator of the bytes of an uncompressed zip archive of the entries."""
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as zipf:
+        for file_path, arcname in entries:
+            with open(file_path, 'rb') as src, zipf.open(zipfile.ZipInfo.from_file(file_path, arcname), 'w') as dst:
+                while chunk := src.read(archive_chunk_size):
+                    dst.write(chunk)
+                    yield stream.pop()
+            yield stream.pop()
+    # Central directory
+    yield stream.pop()
+
+def get_archive_digest(entries):
+    """Hash over the names, sizes and modification times of the entries. It changes whenever a file of the archive
+    changes, without reading the files."""
+    digest = hashlib.sha256()
+    for file_path, arcname in entries:
+        stat = os.stat(file_path)
+        digest.update(f"{arcname};{stat.st_size};{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def get_archive_path(base_path, name, digest):
+    return os.path.join(base_path, archive_cache_dir, f"{name}-{digest}.zip")
+
+def build_archive(entries, archive_path, compression=zipfile.ZIP_STORED):
+    """Write the zip archive to disk. It is written to a temporary file and renamed, so that it is never sent half
+    written."""
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    temp_path = f"{archive_path}.{uuid.uuid4()}"
+    with metrics.stage("zip"), open(temp_path, 'wb') as f:
+        write_zip(entries, f, compression)
+    os.replace(temp_path, archive_path)
+
+def build_cached_archive(entries, archive_path, digest):
+    """Build an archive created with get_archive_path and remove the older versions of it."""
+    # The files changed since the job was enqueued, the next request enqueues the archive with the new digest
+    if get_archive_digest(entries) != digest:
+        return
+
+    build_archive(entries, archive_path)
+
+    archive_name = os.path.basename(archive_path)
+    prefix = archive_name[:-len(f"{digest}.zip")]
+    for file in os.listdir(os.path.dirname(archive_path)):
+        if file.startswith(prefix) and file.endswith(".zip") and file != archive_name:
+            os.remove(os.path.join(os.path.dirname(archive_path), file))
 
 # map file_format to /relative/path
 file_format_mapping = {
     "nifti": (""),
     "dicom": ("dicom")
 }
+
+
+# Binary transport of segmentations for the viewer (see images/routes.py:get_binary_segmentation).
+# The body starts with a 44 byte little-endian header followed by the voxels in C order (z, y, x):
+#   magic b"BSEG", version (uint8), encoding (uint8, 0 = raw, 1 = rle), bytes per voxel (uint8), padding,
+#   shape z, y, x (3 x uint32), spacing x, y, z (3 x float64)
+# The "rle" encoding stores runs as (length uint32, value) pairs instead of the voxels.
+segmentation_header_format = "<4sBBBx3I3d"
+segmentation_encodings = {"raw": 0, "rle": 1}
+# Compressed variants for HTTP Content-Encoding, in order of preference
+segmentation_compressions = {"zstd": ".zst", "gzip": ".gz"}
+
+def encode_segmentation(nifti_path, encoding="raw"):
+    """Encode a NIfTI label map in the binary segmentation format. Labels are stored as uint8, or as uint16 if a
+    model uses label values above 255."""
+    image = sitk.ReadImage(str(nifti_path))
+    array = sitk.GetArrayViewFromImage(image)
+    voxel_type = np.uint8 if array.max() <= np.iinfo(np.uint8).max else np.uint16
+    voxels = np.ascontiguousarray(array, dtype=np.dtype(voxel_type).newbyteorder("<")).ravel()
+
+    header = struct.pack(segmentation_header_format, b"BSEG", 1, segmentation_encodings[encoding], voxels.itemsize,
+                         *array.shape, *image.GetSpacing())
+
+    if encoding == "rle":
+        run_starts = np.concatenate(([0], np.flatnonzero(np.diff(voxels)) + 1))
+        run_lengths = np.diff(np.append(run_starts, len(voxels)))
+        runs = np.empty(len(run_starts), dtype=[("length", "<u4"), ("value", voxels.dtype)])
+        runs["length"] = run_lengths
+        runs["value"] = voxels[run_starts]
+        return header + runs.tobytes()
+
+    return header + voxels.tobytes()
+
+def get_binary_segmentation(nifti_path, encoding="raw", compression=None):
+    """Path of the encoded (and optionally compressed) segmentation. The files are created on first use next to the
+    NIfTI file and reused as long as the NIfTI file doesn't change, so they can be sent with send_file (ETag, Range)."""
+    cache_path = os.path.join(os.path.dirname(nifti_path), f".segmentation.{encoding}")
+    if compression:
+        cache_path += segmentation_compressions[compression]
+
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(nifti_path):
+        return cache_path
+
+    # Write to a temporary file and rename it, so that concurrent requests never send half a file
+    temp_path = f"{cache_path}.{uuid.uuid4()}"
+    if compression is None:
+        with open(temp_path, "wb") as f:
+            f.write(encode_segmentation(nifti_path, encoding))
+    else:
+        with open(get_binary_segmentation(nifti_path, encoding), "rb") as src, open(temp_path, "wb") as dst:
+            if compression == "zstd":
+                zstandard.ZstdCompressor(level=3).copy_stream(src, dst)
+            else:
+                with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=6, mtime=0) as gz:
+                    shutil.copyfileobj(src, gz)
+    os.replace(temp_path, cache_path)
+    return cache_path
+
+def compress(data, compression):
+    """Compress a response body for the given HTTP Content-Encoding (one of segmentation_compressions or None)."""
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    return data
+
+
+# Volume cache of the slice API (see images/routes.py:get_slice). The preprocessed NIfTI files are converted once to
+# uncompressed .npy files, which are memory-mapped, so reading a slice only touches the pages of that slice.
+# The voxels are cast to UInt16 like in nifti2dicom.convert_base_image_to_dicom_sequence, so the slices match the
+# DICOM series of the viewer.
+volume_cache_dir = ".volumes"
+slice_axes = {"axial": 0, "coronal": 1, "sagittal": 2}
+tile_size = 256
+thumbnail_size = 64
+
+# Preprocessed NIfTI file of each sequence, or the copied raw file if the preprocessing was skipped
+preprocessed_nifti_files = {
+    "flair": ["nifti_flair_register.nii.gz", "flair.nii.gz"],
+    "t1": ["nifti_t1_register.nii.gz", "t1.nii.gz"],
+    "t1km": ["nifti_t1c_register.nii.gz", "t1km.nii.gz"],
+    "t2": ["nifti_t2_register.nii.gz", "t2.nii.gz"],
+}
+
+def get_preprocessed_nifti_path(preprocessed_path, sequence):
+    for file_name in preprocessed_nifti_files.get(sequence, []):
+        nifti_path = os.path.join(preprocessed_path, file_name)
+        if os.path.isfile(nifti_path):
+            return nifti_path
+    return None
+
+def get_volume_path(nifti_path):
+    """Path of the memory-mappable copy of the NIfTI file, which is created on first use."""
+    volume_path = os.path.join(os.path.dirname(nifti_path), volume_cache_dir, os.path.basename(nifti_path).split('.')[0] + ".npy")
+    if os.path.isfile(volume_path) and os.path.getmtime(volume_path) >= os.path.getmtime(nifti_path):
+        return volume_path
+
+    os.makedirs(os.path.dirname(volume_path), exist_ok=True)
+    image = sitk.Cast(sitk.ReadImage(nifti_path), sitk.sitkUInt16)
+    temp_path = f"{volume_path}.{uuid.uuid4()}.npy"
+    np.save(temp_path, sitk.GetArrayViewFromImage(image).astype("<u2"))
+    os.replace(temp_path, volume_path)
+    return volume_path
+
+@lru_cache(maxsize=32)
+def open_volume(volume_path, modification_time):
+    """Memory-map a cached volume (z, y, x). The modification time is part of the key, so a rebuilt file is
+    mapped again."""
+    return np.load(volume_path, mmap_mode="r")
+
+@lru_cache(maxsize=32)
+def get_volume_spacing(nifti_path, modification_time):
+    """Spacing (x, y, z) of the NIfTI file, read from the header only."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(nifti_path)
+    reader.ReadImageInformation()
+    return reader.GetSpacing()
+
+def get_volume(nifti_path):
+    volume_path = get_volume_path(nifti_path)
+    return open_volume(volume_path, os.path.getmtime(volume_path)), get_volume_spacing(nifti_path, os.path.getmtime(nifti_path))
+
+def get_slice_levels(shape):
+    """Number of resolution levels of the slices of a volume: level n is downsampled by 2^n, down to a thumbnail."""
+    levels = 1
+    while max(shape) / 2 ** (levels - 1) > thumbnail_size:
+        levels += 1
+    return levels
+
+def get_slice_tiles(shape, axis, level):
+    """Number of tile columns and rows of a slice of a volume with the given shape (z, y, x), downsampled by 2^level
+    like in encode_slice."""
+    rows, columns = [size // 2 ** level for dimension, size in enumerate(shape) if dimension != slice_axes[axis]]
+    return math.ceil(columns / tile_size), math.ceil(rows / tile_size)
+
+def encode_slice(volume, spacing, axis, index, level=0, tile=None):
+    """Extract a slice of the volume and encode it like encode_segmentation (magic b"BSLC", shape (1, rows, columns)).
+    The slice is downsampled by 2^level by averaging blocks of voxels. tile (column, row) selects a tile of
+    tile_size x tile_size voxels of the downsampled slice."""
+    image_slice = np.take(volume, index, axis=slice_axes[axis])
+    # Spacing of the rows and columns of the slice, the spacing of the volume is given in x, y, z
+    row_spacing, column_spacing = [spacing[2 - dimension] for dimension in range(3) if dimension != slice_axes[axis]]
+    thickness = spacing[2 - slice_axes[axis]]
+
+    factor = 2 ** level
+    if factor > 1:
+        rows, columns = (image_slice.shape[0] // factor) * factor, (image_slice.shape[1] // factor) * factor
+        blocks = image_slice[:rows, :columns].reshape(rows // factor, factor, columns // factor, factor)
+        image_slice = blocks.mean(axis=(1, 3)).round().astype("<u2")
+        row_spacing, column_spacing = row_spacing * factor, column_spacing * factor
+
+    if tile is not None:
+        column, row = tile
+        image_slice = image_slice[row * tile_size:(row + 1) * tile_size, column * tile_size:(column + 1) * tile_size]
+
+    image_slice = np.ascontiguousarray(image_slice, dtype="<u2")
+    header = struct.pack(segmentation_header_format, b"BSLC", 1, segmentation_encodings["raw"], image_slice.itemsize,
+                         1, *image_slice.shape, column_spacing, row_spacing, thickness)
+    return header + image_slice.tobytes()
@@ -1,18 +1,19 @@
 # server/images/routes.py
 
 from flask import request, jsonify, send_file
-from flask import Blueprint, jsonify, request, g
+from flask import Blueprint, jsonify, request, g, make_response, Response
 import os
 import shutil
 import zipfile
 from . import helper
-from server.models import Segmentation, Project, Session, User, Sequence
+from server.models import Segmentation, Project, User, Sequence
 import json
 from io import BytesIO
 from pathlib import Path
 from server.database import db
+from server.auth import sessions
 import SimpleITK as sitk
-from server.main import nifti2dicom
+from server.main import nifti2dicom, scheduler
 import uuid
 
 images_blueprint = Blueprint(
@@ -42,13 +43,13 @@ def authenticate_user():
 
     session_token = auth_header.replace('Bearer ', '').strip()
 
-    # validate token
-    session = Session.query.filter_by(session_token=session_token).first()
-    if session is None:
+    # validate token (cached, see auth/sessions.py)
+    user_id = sessions.get_user_id(session_token)
+    if user_id is None:
         return jsonify({'message': 'Invalid session token'}), 401
 
     # save user_id for routes to use
-    g.user_id = session.user_id
+    g.user_id = user_id
 
 
 # This endpoint returns a zip file containing a dicom series of a not preprocessed 
@@ -178,14 +179,9 @@ def get_segmentation(segmentation_id):
             as_attachment=True
         )
     else:
-        zip_file = helper.zip_preprocessed_files(preprocessed_path)
-        # Return the zip file
-        response = send_file(
-            zip_file,
-            mimetype='application/zip',
-            download_name='imaging_files.zip',
-            as_attachment=True
-        )
+        # The archive is built in the background after the preprocessing, stream it until it is ready
+        response = Response(helper.stream_zip(helper.get_preprocessed_archive_entries(preprocessed_path)), mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', filename='imaging_files.zip')
 
     # Add a header indicating if files are DICOM or NIFTI
     # TODO: Save in DB if Files are DICOM or NIFTI
@@ -247,6 +243,144 @@ def get_raw_segmentation(segmentation_id):
     return jsonify({"segmentation": segmentation_list})
 
 
+# Returns the segmentation as binary label map instead of nested JSON lists (see helper.encode_segmentation for the
+# format). ?encoding=rle returns run-length encoded voxels. The body is additionally compressed with zstd or gzip if
+# the client accepts it, and supports ETag and Range requests.
+@images_blueprint.route("/segmentations/<segmentation_id>/rawsegmentation/binary", methods=["GET"])
+def get_binary_segmentation(segmentation_id):
+    user_id = g.user_id
+
+    segmentation = Segmentation.query.filter_by(segmentation_id=segmentation_id).first()
+    if segmentation is None:
+        return jsonify({"error": "Segmentation not found"}), 404
+    project = Project.query.filter_by(project_id=segmentation.project_id).first()
+    if(project.user_id != user_id):
+        return jsonify({'message': f'Access to segmentation {segmentation.segmentation_name} with id {segmentation.segmentation_id} denied, because it belongs to another user'}), 403
+
+    encoding = request.args.get("encoding", "raw")
+    if encoding not in helper.segmentation_encodings:
+        return jsonify({"error": f"Invalid encoding {encoding}. Only {', '.join(helper.segmentation_encodings)} are supported."}), 400
+
+    # query the user mail from the db
+    user = User.query.filter_by(user_id=user_id).first()
+    user_name = user.user_mail.split('@')[0]
+    # refers to either uksh or uni luebeck
+    domain = helper.get_domain(user.user_mail)
+
+    # Find corresponding nifti file
+    segmentations_path = Path(f"/usr/src/image-repository/{user_id}-{user_name}-{domain}/{segmentation.project_id}-{project.project_name}/segmentations/{segmentation_id}-{segmentation.segmentation_name}")
+    nifti_path = next((segmentations_path / file for file in os.listdir(segmentations_path) if file.endswith(".nii.gz")), None) if segmentations_path.is_dir() else None
+    if nifti_path is None:
+        return jsonify({"error": "Segmentation file not found"}), 404
+
+    # Compression is only a transport encoding, the client gets the same bytes in every case
+    compression = request.accept_encodings.best_match(list(helper.segmentation_compressions) + ["identity"])
+    if compression == "identity":
+        compression = None
+
+    try:
+        binary_path = helper.get_binary_segmentation(nifti_path, encoding, compression)
+    except Exception as e:
+        print(f"Error encoding segmentation {nifti_path}: {e}")
+        return jsonify({"error": "Error reading NIfTI file"}), 500
+
+    response = send_file(binary_path, mimetype="application/octet-stream", conditional=True, max_age=0)
+    if compression:
+        response.headers["Content-Encoding"] = compression
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    return response
+
+
+# Finds the preprocessed NIfTI file of a sequence of a segmentation of the user. Returns the path and None, or None
+# and an error response.
+def find_preprocessed_nifti(user_id, segmentation_id, sequence):
+    segmentation = Segmentation.query.filter_by(segmentation_id=segmentation_id).first()
+    if segmentation is None:
+        return None, (jsonify({"error": "Segmentation not found"}), 404)
+    project = Project.query.filter_by(project_id=segmentation.project_id).first()
+    if(project.user_id != user_id):
+        return None, (jsonify({'message': f'Access to segmentation {segmentation.segmentation_name} with id {segmentation.segmentation_id} denied, because it belongs to another user'}), 403)
+
+    # query the user mail from the db
+    user = User.query.filter_by(user_id=user_id).first()
+    user_name = user.user_mail.split('@')[0]
+    # refers to either uksh or uni luebeck
+    domain = helper.get_domain(user.user_mail)
+
+    project_path = f'/usr/src/image-repository/{user_id}-{user_name}-{domain}/{segmentation.project_id}-{project.project_name}'
+    preprocessed_path = f'{project_path}/preprocessed/{segmentation.flair_sequence or 0}_{segmentation.t1_sequence or 0}_{segmentation.t1km_sequence or 0}_{segmentation.t2_sequence or 0}'
+
+    nifti_path = helper.get_preprocessed_nifti_path(preprocessed_path, sequence)
+    if nifti_path is None:
+        return None, (jsonify({"error": f"Preprocessed sequence {sequence} not found"}), 404)
+    return nifti_path, None
+
+
+# Returns shape, spacing and number of resolution levels of a preprocessed sequence for the slice API
+@images_blueprint.route("/segmentations/<segmentation_id>/sequences/<sequence>/volume", methods=["GET"])
+def get_volume_info(segmentation_id, sequence):
+    nifti_path, error = find_preprocessed_nifti(g.user_id, segmentation_id, sequence)
+    if error:
+        return error
+
+    volume, spacing = helper.get_volume(nifti_path)
+    return jsonify({
+        "shape": list(volume.shape),  # z, y, x
+        "spacing": list(spacing),  # x, y, z
+        "levels": helper.get_slice_levels(volume.shape),
+        "tileSize": helper.tile_size,
+        "axes": list(helper.slice_axes),
+    }), 200
+
+
+# Returns a single axial, coronal or sagittal slice of a preprocessed sequence, so the viewer doesn't have to
+# download the whole series first. ?level=n downsamples the slice by 2^n, ?tile=column,row returns one tile of the
+# downsampled slice. The body has the same binary format as the segmentation (see helper.encode_slice).
+@images_blueprint.route("/segmentations/<segmentation_id>/sequences/<sequence>/slices/<axis>/<int:index>", methods=["GET"])
+def get_slice(segmentation_id, sequence, axis, index):
+    if axis not in helper.slice_axes:
+        return jsonify({"error": f"Invalid axis {axis}. Only {', '.join(helper.slice_axes)} are supported."}), 400
+
+    nifti_path, error = find_preprocessed_nifti(g.user_id, segmentation_id, sequence)
+    if error:
+        return error
+
+    volume, spacing = helper.get_volume(nifti_path)
+    level = request.args.get("level", 0, type=int)
+    tile = request.args.get("tile")
+    try:
+        tile = tuple(int(value) for value in tile.split(",")) if tile else None
+    except ValueError:
+        tile = ()
+    if tile is not None and len(tile) != 2:
+        return jsonify({"error": f"Invalid tile {request.args.get('tile')}, expected column,row"}), 400
+    if not 0 <= index < volume.shape[helper.slice_axes[axis]] or not 0 <= level < helper.get_slice_levels(volume.shape):
+        return jsonify({"error": "Slice index or level out of range"}), 404
+    if tile is not None and not all(0 <= value < count for value, count in zip(tile, helper.get_slice_tiles(volume.shape, axis, level))):
+        return jsonify({"error": "Tile out of range"}), 404
+
+    # The slices of a volume don't change, so the ETag only depends on the volume file and the request
+    compression = request.accept_encodings.best_match(list(helper.segmentation_compressions) + ["identity"])
+    compression = None if compression == "identity" else compression
+    etag = f"{os.path.getmtime(nifti_path)}-{sequence}-{axis}-{index}-{level}-{tile}-{compression}"
+
+    response = make_response()
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = "private, max-age=3600"
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    response.set_data(helper.compress(helper.encode_slice(volume, spacing, axis, index, level, tile), compression))
+    response.mimetype = "application/octet-stream"
+    if compression:
+        response.headers["Content-Encoding"] = compression
+    return response
+
+
 @images_blueprint.route("/preprocessed/nifti/test-nifti.nii.gz", methods=["GET"])
 def get_nifti():
     # Path to your NIfTI file
@@ -294,13 +428,25 @@ def download(seg_id, file_format):
     preprocessed_path = f'{project_path}/preprocessed/{segmentation_entry.flair_sequence}_{segmentation_entry.t1_sequence}_{segmentation_entry.t1km_sequence}_{segmentation_entry.t2_sequence}'
 
     # Check if the file exists
-    if os.path.exists(segmentation_path):
-        zip_segmentation = helper.zip_segmentation(segmentation_path=segmentation_path, preprocessed_path=preprocessed_path, file_format=file_format)
-        # Send the file as a response
-        return send_file(
-            zip_segmentation, 
-            as_attachment=True, 
-            download_name=f"{file_format}_segmentation_{segmentation_entry.segmentation_name}.zip", 
-        )
-    else:
-        return jsonify({"error": "File not found"}), 404
\ No newline at end of file
+    if not os.path.exists(segmentation_path):
+        return jsonify({"error": "File not found"}), 404
+
+    entries = helper.get_segmentation_archive_entries(segmentation_path=segmentation_path, preprocessed_path=preprocessed_path, file_format=file_format)
+    download_name = f"{file_format}_segmentation_{segmentation_entry.segmentation_name}.zip"
+
+    # The archive is cached on disk under the hash of its files, which is also the ETag
+    digest = helper.get_archive_digest(entries)
+    archive_path = helper.get_archive_path(segmentation_base_path, f"{file_format}_segmentation", digest)
+    if os.path.isfile(archive_path):
+        return send_file(archive_path, mimetype='application/zip', as_attachment=True, download_name=download_name, etag=digest)
+
+    # Build the archive in the background for the next request and stream this one
+    try:
+        scheduler.enqueue_archive("server.images.helper.build_cached_archive", entries, archive_path, digest)
+    except Exception as e:
+        print(f"Failed to enqueue archive {archive_path}: {e}")
+
+    response = Response(helper.stream_zip(entries), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.set_etag(digest)
+    return response.make_conditional(request)
\ No newline at end of file
@@ -1,82 +1,182 @@
 # server/main/dicom_classifier.py
-from dcm_classifier.study_processing import ProcessOneDicomStudyToVolumesMappingBase
-from dcm_classifier.image_type_inference import ImageTypeClassifierBase
+"""Classification of DICOM sequences by their headers.
+
+Only the header of one file per series is read (stop_before_pixels, large elements are deferred and skipped), from
+the uploaded zip or from the extracted sequence folder, without copying the files to a temp folder first. The
+features for the classifier of dcm_classifier, the resolution and the contrast agent all come from this one header.
+The series are classified concurrently and the results are memoized per SeriesInstanceUID, so the classification
+at project creation reuses the one from POST /classify.
+"""
+
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-import pydicom
 
+import pydicom
+from dcm_classifier.dicom_series import DicomSingleSeries
+from dcm_classifier.dicom_volume import DicomSingleVolumeInfoBase
+from dcm_classifier.image_type_inference import ImageTypeClassifierBase
+from dcm_classifier.utility_functions import get_bvalue, get_diffusion_gradient_direction
+
+classifier_threads = int(os.getenv("CLASSIFIER_THREADS", min(8, os.cpu_count() or 4)))
+# Elements larger than this are only read when they are accessed
+header_defer_size = "4 KB"
+
+series_cache_size = 1024
+# SeriesInstanceUID -> classification of the series
+series_cache = OrderedDict()
+series_cache_lock = threading.Lock()
+
+sequence_types = ["t1", "t1km", "t2", "t2star", "flair", "rest"]
+
+
+class HeaderVolumeInfo(DicomSingleVolumeInfoBase):
+    """DicomSingleVolumeInfoBase of a header that is already read. The base class reads the first file of the volume
+    again from a path, which doesn't exist for zip members."""
+
+    def __init__(self, header, filename):
+        self.one_volume_dcm_filenames = [Path(filename)]
+        self.ro_user_supplied_dcm_filenames = list(self.one_volume_dcm_filenames)
+        self._pydicom_info = header
+
+        # Same as DicomSingleVolumeInfoBase.__init__
+        self.bvalue = get_bvalue(self._pydicom_info, round_to_nearst_10=True)
+        self.diffusion_gradient = get_diffusion_gradient_direction(self._pydicom_info)
+        self.has_diffusion_gradient = self.diffusion_gradient is not None
+        self.parent_series = None
+        self.volume_index = None
+        self.volume_modality = "INVALID"
+        self.series_modality = "INVALID"
+        self.modality_probability = None
+        self.average_slice_spacing = -12345.0
+        self.acquisition_plane = "UNKNOWN"
+        self.is_isotropic = False
+        self.has_contrast = False
+        self.itk_image = None
+        _, self.volume_info_dict = self._make_one_study_info_mapping_from_filelist()
+
+
+def read_header(source):
+    header = pydicom.dcmread(source, stop_before_pixels=True, defer_size=header_defer_size, force=True)
+    # The classifier copies the header, which fails for zip members. The large (deferred) elements are not needed by
+    # the classifier, they can only be read again from a file on disk.
+    header.buffer = None
+    return header
+
+
+def classify_zip(files) -> dict:
+    """Classify the sequences in a zip, one folder per sequence. Every file is classified with the folder it is in as
+    path, only the first file of each series is passed to the classifier."""
+    with zipfile.ZipFile(files) as z:
+        members = [member for member in z.namelist() if os.path.basename(member)]
+        return classify_sources([(os.path.dirname(member), member, lambda member=member: z.open(member)) for member in members])
+
+
+def classify_files(files) -> dict:
+    """Classify the sequences given as a mapping of path (the sequence name) to one of its DICOM files."""
+    return classify_sources([(path, filename, lambda filename=filename: nullcontext(filename)) for path, filename in files.items()])
+
+
+def classify_sources(sources) -> dict:
+    """sources is a list of (path, filename, open function) of one or more files per sequence. Returns a mapping of
+    the sequence types to lists of {path, resolution, acquisition_plane}, each path is listed once per series."""
+    claimed_series = set()
+    claimed_lock = threading.Lock()
+
+    def read_volume(path, filename, open_source):
+        with open_source() as source:
+            header = read_header(source)
+        series_uid = header.get("SeriesInstanceUID")
+        with claimed_lock, series_cache_lock:
+            # Only the first file of a series that is not memoized yet is classified
+            if series_uid in series_cache or series_uid in claimed_series:
+                return path, series_uid, None
+            if series_uid:
+                claimed_series.add(series_uid)
+        return path, series_uid, (HeaderVolumeInfo(header, filename), get_resolution(header), has_contrast(header))
+
+    with ThreadPoolExecutor(max_workers=classifier_threads) as executor:
+        volumes = list(executor.map(lambda source: read_volume(*source), sources))
+        new_volumes = [(series_uid, volume) for _, series_uid, volume in volumes if volume is not None]
+        new_classifications = list(executor.map(lambda volume: classify_volume(*volume[1]), new_volumes))
+
+    classifications = {}
+    for (series_uid, volume), classification in zip(new_volumes, new_classifications):
+        classifications[series_uid or id(volume)] = classification
+        if series_uid:
+            cache_series(series_uid, classification)
+
+    results = {sequence_type: [] for sequence_type in sequence_types}
+    listed = set()
+    for path, series_uid, volume in volumes:
+        key = series_uid or id(volume)
+        if (path, key) in listed:
+            continue
+        listed.add((path, key))
+
+        classification = classifications.get(key)
+        if classification is None:
+            with series_cache_lock:
+                classification = series_cache[series_uid]
+
+        sequence_type, resolution, acquisition_plane = classification
+        results[sequence_type].append({
+            "path": path,
+            "resolution": resolution,
+            "acquisition_plane": acquisition_plane
+        })
 
-def classify(path):
-    current_directory: Path = Path.cwd()
+    return results
 
-    session_directory = current_directory / path
 
-    # create inferer object
-    inferer = ImageTypeClassifierBase()
+def cache_series(series_uid, classification):
+    with series_cache_lock:
+        series_cache[series_uid] = classification
+        series_cache.move_to_end(series_uid)
+        while len(series_cache) > series_cache_size:
+            series_cache.popitem(last=False)
 
-    # create study for given session directory
-    study = ProcessOneDicomStudyToVolumesMappingBase(
-        study_directory=session_directory.as_posix(), inferer=inferer
-    )
-
-    # run the inference on the study
-    study.run_inference()
-
-    t1 = []
-    t1km = []
-    t2 = []
-    t2star = []
-    flair = []
-    rest = []
-
-    for series_number, series in study.series_dictionary.items():
-        for index, volume in enumerate(series.get_volume_list()):
-            volume_filename = volume.get_one_volume_dcm_filenames()[0]
-            volume_acq_plane = volume.get_acquisition_plane()
-            volume_modality = volume.get_volume_modality()
-            volume_object = {
-                "path": get_correct_path(volume_filename),
-                "resolution": get_resolution(volume_filename),
-                "acquisition_plane": volume_acq_plane
-            }
-            if volume_modality == "t1w":
-                if has_contrast(volume_filename) or "km" in volume.get_volume_series_description().lower():
-                    t1km.append(volume_object)
-                else:
-                    t1.append(volume_object)
-            elif volume_modality == "t2w":
-                t2.append(volume_object)
-            elif volume_modality == "flair":
-                flair.append(volume_object)
-            elif volume_modality == "gret2star" or volume_modality == "t2star":
-                t2star.append(volume_object)
-            else:
-                description = volume.get_volume_series_description().lower()
-                if "t1" in description:
-                    if has_contrast(volume_filename) or "km" in description:
-                        t1km.append(volume_object)
-                    else:
-                        t1.append(volume_object)
-                elif "t2" in description:
-                    t2.append(volume_object)
-                elif "flair" in description:
-                    flair.append(volume_object)
-                else:
-                    rest.append(volume_object)
-
-    results = {
-        "t1" : t1,
-        "t1km" : t1km,
-        "t2" : t2,
-        "t2star": t2star,
-        "flair" : flair,
-        "rest" : rest
-    }
 
-    return results
+def classify_volume(volume, resolution, contrast) -> tuple:
+    """Run the classifier of dcm_classifier on a single volume. Returns (sequence type, resolution, acquisition
+    plane)."""
+    series = DicomSingleSeries(series_number=volume.get_series_number())
+    series.add_volume_to_series(volume)
 
-
-def has_contrast(path):
-    ds = pydicom.dcmread(path)
+    # The inferer keeps the current series, so every thread needs its own
+    inferer = ImageTypeClassifierBase()
+    inferer.set_series(series)
+    inferer.run_inference()
+
+    modality = volume.get_volume_modality()
+    description = volume.get_volume_series_description().lower()
+    return get_sequence_type(modality, description, contrast), resolution, volume.get_acquisition_plane()
+
+
+def get_sequence_type(modality, description, contrast) -> str:
+    if modality == "t1w":
+        return "t1km" if contrast or "km" in description else "t1"
+    elif modality == "t2w":
+        return "t2"
+    elif modality == "flair":
+        return "flair"
+    elif modality == "gret2star" or modality == "t2star":
+        return "t2star"
+
+    if "t1" in description:
+        return "t1km" if contrast or "km" in description else "t1"
+    elif "t2" in description:
+        return "t2"
+    elif "flair" in description:
+        return "flair"
+    return "rest"
+
+
+def has_contrast(ds):
     contrast_used = False
 
     if 'ContrastBolusAgent' in ds and ds.ContrastBolusAgent:
@@ -86,31 +186,10 @@ def has_contrast(path):
     return contrast_used
 
 
-def get_correct_path(path):
-    splitpath = str(path).split("/")
-    relevant_path = splitpath[splitpath.index("temp")+2:len(splitpath)-1]
-    return "/".join(relevant_path)
-
-
-def get_resolution(path):
-    ds = pydicom.dcmread(path)
+def get_resolution(ds):
     if("PixelSpacing" in ds and "SpacingBetweenSlices" in ds):
         return max(ds.SpacingBetweenSlices, ds.PixelSpacing[0], ds.PixelSpacing[1])
     elif("SpacingBetweenSlices" in ds):
         return ds.SpacingBetweenSlices
     else:
         return None
-
-
-def get_best_resolution(files):
-    ds = pydicom.dcmread(files[0])
-    best_dicom = files[0]
-    best_res = max(ds.SpacingBetweenSlices, ds.PixelSpacing[0], ds.PixelSpacing[1])
-    for file in files:
-        ds = pydicom.dcmread(file)
-        res = max(ds.SpacingBetweenSlices, ds.PixelSpacing[0], ds.PixelSpacing[1])
-        if res < best_res:
-            best_dicom = file
-            best_res = res
-    path, seperator, file = str(best_dicom).rpartition("\\")
-    return path
\ No newline at end of file
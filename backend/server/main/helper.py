@@ -1,5 +1,6 @@
 # Using shutil to remove non empty directories
 import shutil
+import os
 
 #################################################################################
 ####  legacy --> deleting from image repository is implemented on routes.py  ####
@@ -49,13 +50,30 @@ def delete_folder(path_to_delete):
     except Exception as e:
         print(f"Failed to delete folder {path_to_delete}: {e}")
 
+def link_tree(src_path, dest_path):
+    """Recreate the directory tree of src_path in dest_path with hard links (or copies if linking fails)."""
+    for root, dirs, files in os.walk(src_path):
+        target_root = os.path.join(dest_path, os.path.relpath(root, src_path))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            try:
+                os.link(os.path.join(root, file), os.path.join(target_root, file))
+            except OSError:
+                shutil.copy2(os.path.join(root, file), os.path.join(target_root, file))
+
 def model_config(model, segmentation_id):
     match model:
         case "nnunet-model:brainns":
+            predict_argv = ["nnUNet_predict", "-i", "/app/input", "-o", '/app/output', "-t", "1", "-m", "3d_fullres"]
             return {
                 "image": "nnunet-model:brainns",
                 "container_name": f'nnUnet_container_{segmentation_id}',
-                "command": ["nnUNet_predict", "-i", "/app/input", "-o", '/app/output', "-t", "1", "-m", "3d_fullres"],
+                "command": predict_argv,
+                # Entry point of the command for the warm model server (see model_pool.py) and its sys.argv, which
+                # starts with the script and not with the interpreter
+                "serve_python": ["python"],
+                "serve_entrypoint": "nnunet.inference.predict_simple:main",
+                "serve_argv": predict_argv,
                 "output_path" : '/app/output',
                 "docker_file_path" : "/usr/src/models/nnUnet",
                 "uses_gpu": True,
@@ -64,17 +82,21 @@ def model_config(model, segmentation_id):
                 "resampledDataExists": False
             }
         case "own-model:brainns":
+            # TODO Don't hard-code these things (like the checkpoint)
+            inference_argv = ["src/inference.py",
+                              "--lightning-checkpoint=/app/checkpoints/checkpoint-01-04-25-version-server-58-epoch-23.ckpt",
+                              "--input-path=/app/input/",
+                              "--output-path=/app/output/",
+                              "--patch-overlap=24",
+                              "--device=cpu"
+                              ]
             return {
                 "image": "own-model:brainns",
                 "container_name": f'own_model_container_{segmentation_id}',
-                # TODO Don't hard-code these things (like the checkpoint)
-                "command": ["python", "src/inference.py",
-                            "--lightning-checkpoint=/app/checkpoints/checkpoint-01-04-25-version-server-58-epoch-23.ckpt",
-                            "--input-path=/app/input/",
-                            "--output-path=/app/output/",
-                            "--patch-overlap=24",
-                            "--device=cpu"
-                            ],
+                "command": ["python"] + inference_argv,
+                "serve_python": ["python"],
+                "serve_entrypoint": "src/inference.py:main",
+                "serve_argv": inference_argv,
                 "output_path" : '/app/output',
                 "docker_file_path" : "/usr/src/models/own",
                 "uses_gpu": False
@@ -94,11 +116,16 @@ def model_config(model, segmentation_id):
 
     # von Theresa hinzugefügt am 29.05.2025
         case "synthseg-model:brainns":
+            #                 "command": ["conda", "run", "-n" "synthseg_env", "python", "SynthSeg/scripts/commands/SynthSeg_predict.py", "--i", "/app/input", "--o", '/app/output', "--cpu", "--threads", "6", "--resample", "/app/output/resampled"],
+            predict_argv = ["SynthSeg/scripts/commands/SynthSeg_predict.py", "--i", "/app/input", "--o", '/app/output',"--parc", "--cpu", "--threads", "6", "--resample", "/app/output/resampled"]
             return {
                 "image": "synthseg-model:brainns",
                 "container_name": f'SynthSeg_container_{segmentation_id}',
-                #                 "command": ["conda", "run", "-n" "synthseg_env", "python", "SynthSeg/scripts/commands/SynthSeg_predict.py", "--i", "/app/input", "--o", '/app/output', "--cpu", "--threads", "6", "--resample", "/app/output/resampled"],
-                "command": ["conda", "run", "-n" "synthseg_env", "python", "SynthSeg/scripts/commands/SynthSeg_predict.py", "--i", "/app/input", "--o", '/app/output',"--parc", "--cpu", "--threads", "6", "--resample", "/app/output/resampled"],
+                "command": ["conda", "run", "-n" "synthseg_env", "python"] + predict_argv,
+                # The predict script has no main function, so the server runs it as a script (imports stay warm)
+                "serve_python": ["conda", "run", "--no-capture-output", "-n", "synthseg_env", "python"],
+                "serve_entrypoint": "SynthSeg/scripts/commands/SynthSeg_predict.py",
+                "serve_argv": predict_argv,
                 "output_path": '/app/output',
                 "docker_file_path": "/usr/src/models/SynthSeg",
                 "uses_gpu": True,
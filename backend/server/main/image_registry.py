@@ -0,0 +1,143 @@
+# server/main/image_registry.py
+"""The local Docker images of the preprocessing and the models, and deduplicated builds of them.
+
+Each worker process loads the tags of the local images once at startup (watch() in worker.py) and keeps them current
+with the Docker events in a background thread, which has its own Docker client. The jobs are forked from the worker
+process and get its current tags, so checking an image costs no Docker API call. Outside of a worker, or for a tag
+that isn't known, the image is looked up directly.
+
+A missing image is built by ensure_image() behind a Redis lock per tag, so concurrent jobs in all worker containers
+wait for one build instead of each starting a multi-GB build. worker.py prebuilds the images at startup (PREBUILD_IMAGES).
+"""
+
+import os
+import threading
+import time
+
+import docker
+import docker.errors
+import redis
+
+from server.main import scheduler
+from server.main.helper import model_config
+
+# "flirt" (FSL) or "sitk" (SimpleITK), the preprocessing image is built with it and the preprocessing runs with it.
+# The image of each backend has its own tag, so an image built for the other backend is never reused.
+registration_backend = os.getenv("REGISTRATION_BACKEND", "flirt").lower()
+PREPROCESSING_IMAGE = f"preprocessing:brainns-{registration_backend}"
+preprocessing_docker_file_path = "/usr/src/preprocessing"
+# The models of helper.model_config
+MODEL_IMAGES = ["nnunet-model:brainns", "own-model:brainns", "synthseg-model:brainns"]
+
+build_lock_prefix = "brainns:image-build:"
+# Upper bound of a build, the lock expires after it in case the worker was killed
+build_timeout = 3 * 60 * 60
+# Actions of image events that add a tag, untag and delete events reload the tags
+tag_actions = ("tag", "pull", "load", "import")
+event_retry_interval = 5
+
+tags = set()
+watching = False
+tags_lock = threading.Lock()
+
+
+def reset_tags_lock():
+    """RQ forks a work horse per job. If the thread of watch() held the lock at the fork, it would stay locked in the
+    child forever, so the child gets a new lock. The child keeps the tags as they were at the fork."""
+    global tags_lock
+    tags_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_tags_lock)
+
+
+def load(client):
+    """Replace the known tags with the tags of all local images."""
+    global tags
+    image_tags = {tag for image in client.images.list() for tag in image.tags}
+    with tags_lock:
+        tags = image_tags
+
+
+def handle_event(client, event):
+    action = event.get("Action", "")
+    name = event.get("Actor", {}).get("Attributes", {}).get("name")
+    if action in tag_actions and name:
+        with tags_lock:
+            tags.add(name if ":" in name else f"{name}:latest")
+    elif action in ("untag", "delete"):
+        # The events only have the ID of the image, not the tags it had
+        load(client)
+
+
+def follow_events():
+    client = None
+    while True:
+        try:
+            # Not the client of the jobs, the event stream and the requests of a job must not share a connection
+            if client is None:
+                client = docker.from_env()
+            # Subscribe before loading, so no change between the two is missed
+            events = client.events(decode=True, filters={"type": "image"})
+            load(client)
+            for event in events:
+                handle_event(client, event)
+        except Exception as e:
+            print(f"Lost the Docker image events, reconnecting: {e}")
+        time.sleep(event_retry_interval)
+
+
+def watch(client):
+    """Load the local images and keep them current in a background thread of this process."""
+    global watching
+    try:
+        load(client)
+    except Exception as e:
+        # The thread loads them again when it is connected
+        print(f"Could not load the local images: {e}")
+    threading.Thread(target=follow_events, daemon=True).start()
+    watching = True
+
+
+def exists(client, tag) -> bool:
+    if watching:
+        with tags_lock:
+            if tag in tags:
+                return True
+    try:
+        client.images.get(tag)
+        return True
+    except docker.errors.ImageNotFound:
+        return False
+
+
+def get_build_arguments(tag) -> dict:
+    if tag == PREPROCESSING_IMAGE:
+        return {"path": preprocessing_docker_file_path, "buildargs": {"REGISTRATION_BACKEND": registration_backend}}
+    return {"path": model_config(tag, 0)["docker_file_path"], "rm": True}
+
+
+def ensure_image(client, tag):
+    """Build the image tag if it doesn't exist. Only one worker builds it, the others wait for the build."""
+    if exists(client, tag):
+        return
+
+    connection = redis.from_url(scheduler.REDIS_URL)
+    with connection.lock(f"{build_lock_prefix}{tag}", timeout=build_timeout, blocking_timeout=build_timeout):
+        # Checked again under the lock, another worker may have built it in the meantime
+        if not exists(client, tag):
+            print(f"Image {tag} doesn't exist. Creating image...")
+            client.images.build(tag=tag, **get_build_arguments(tag))
+            print(f"Done creating image {tag}!")
+
+    with tags_lock:
+        tags.add(tag)
+
+
+def prebuild(client, image_tags):
+    """Build the missing images of image_tags one after another, e.g. at worker startup."""
+    for tag in image_tags:
+        try:
+            ensure_image(client, tag)
+        except Exception as e:
+            print(f"Could not prebuild image {tag}: {e}")
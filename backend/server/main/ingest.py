@@ -0,0 +1,111 @@
+# server/main/ingest.py
+"""Extraction of the uploaded study zip of POST /projects into the raw folders of the sequences.
+
+The archive is indexed once and its members are grouped by sequence. The members are then extracted by a thread pool:
+zipfile serializes the reads of the shared archive, but the decompression and the writes run in parallel.
+Uncompressed NIfTI files are gzipped in chunks in parallel. The chunks are written as consecutive gzip members, which
+zlib, Python's gzip and nibabel read as one file.
+"""
+
+import gzip
+import os
+import shutil
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+ingest_threads = int(os.getenv("INGEST_THREADS", min(8, os.cpu_count() or 4)))
+gzip_chunk_size = 16 * 1024 * 1024
+gzip_compresslevel = 6
+
+
+def group_members_by_sequence(z, sequence_names) -> dict[str, list[str]]:
+    """Group the files of the archive by the sequence (folder) name they start with, in one pass over the
+    archive. Only the prefixes with the lengths of the sequence names are looked up, instead of comparing every
+    member with every sequence name. A file belongs to the longest matching name, so "s1" doesn't take the files
+    of "s10"."""
+    names = set(sequence_names)
+    lengths = sorted({len(name) for name in names}, reverse=True)
+    members = {name: [] for name in names}
+
+    for member in z.namelist():
+        # Skip directories
+        if not os.path.basename(member):
+            continue
+        for length in lengths:
+            if member[:length] in names:
+                members[member[:length]].append(member)
+                break
+
+    return members
+
+
+def extract_member(z, member, target_path):
+    with z.open(member) as source, open(target_path, "wb") as target:
+        shutil.copyfileobj(source, target)
+
+
+def gzip_stream(source, target_path, executor):
+    """Gzip a file object. The chunks are compressed in parallel by the executor (zlib releases the GIL), at most two
+    per thread are held in memory."""
+    with open(target_path, "wb") as target:
+        pending = deque()
+        while chunk := source.read(gzip_chunk_size):
+            pending.append(executor.submit(gzip.compress, chunk, gzip_compresslevel, mtime=0))
+            if len(pending) >= 2 * ingest_threads:
+                target.write(pending.popleft().result())
+        while pending:
+            target.write(pending.popleft().result())
+
+        # An empty input still has to be a valid gzip file
+        if target.tell() == 0:
+            target.write(gzip.compress(b"", mtime=0))
+
+
+def gzip_member(z, member, target_path, executor):
+    with z.open(member) as source:
+        gzip_stream(source, target_path, executor)
+
+
+def gzip_file(source_path, target_path):
+    with open(source_path, "rb") as source, ThreadPoolExecutor(max_workers=ingest_threads) as executor:
+        gzip_stream(source, target_path, executor)
+
+
+def extract_dicom_sequences(files, sequence_directories):
+    """Extract the DICOM files of each sequence into its directory. sequence_directories maps the sequence (folder)
+    names in the archive to the raw directories. Sequences without files are skipped."""
+    with zipfile.ZipFile(files) as z:
+        members = group_members_by_sequence(z, sequence_directories)
+
+        extractions = []
+        for sequence_name, sequence_directory in sequence_directories.items():
+            extractions += [(member, os.path.join(sequence_directory, os.path.basename(member))) for member in members[sequence_name]]
+
+        with ThreadPoolExecutor(max_workers=ingest_threads) as executor:
+            futures = [executor.submit(extract_member, z, member, target_path) for member, target_path in extractions]
+            # Raise the first error, if any
+            for future in futures:
+                future.result()
+
+
+def extract_nifti_sequences(files, sequence_targets) -> list[str]:
+    """Extract the NIfTI file of each sequence gzipped to its target path. sequence_targets maps the file names in
+    the archive to the target paths. Returns the names that are missing in the archive, nothing is extracted then."""
+    with zipfile.ZipFile(files) as z:
+        available_members = set(z.namelist())
+        missing = [sequence_name for sequence_name in sequence_targets if sequence_name not in available_members]
+        if missing:
+            return missing
+
+        with ThreadPoolExecutor(max_workers=ingest_threads) as executor:
+            futures = []
+            for sequence_name, target_path in sequence_targets.items():
+                if sequence_name.endswith(".nii"):
+                    gzip_member(z, sequence_name, target_path, executor)
+                elif sequence_name.endswith(".nii.gz"):
+                    futures.append(executor.submit(extract_member, z, sequence_name, target_path))
+            for future in futures:
+                future.result()
+
+    return []
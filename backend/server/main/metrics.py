@@ -0,0 +1,232 @@
+# server/main/metrics.py
+"""Timing of the pipeline stages and Prometheus metrics of the API and the workers.
+
+Every stage of a job (queue wait, image check, GPU wait, input staging, container run, conversion to DICOM, ...) is
+timed with stage(). A span is printed as one JSON log line and added to a duration histogram in Redis, which is shared
+by the API and all worker containers. The spans of a job are also kept in Redis until the job has finished, then
+save_job_timings() stores them per segmentation in the DB (SegmentationStageTiming). The API adds a histogram of its
+request durations.
+
+GET /brainns-api/metrics renders the histograms together with the queue depths, the worker utilization and the GPU
+reservations in the Prometheus text format. The gauges are read from Redis at scrape time. The endpoint doesn't use
+the user sessions, the scraper authenticates with the token METRICS_TOKEN (Authorization: Bearer <token>). Without a
+token the endpoint is disabled.
+"""
+
+import hmac
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import redis
+from rq import Queue, Worker, get_current_job
+from sqlalchemy import select
+
+from server.database import db
+from server.main import scheduler
+from server.models import Segmentation, SegmentationStageTiming
+
+# Upper bounds of the histogram buckets in seconds, the stages take from milliseconds to an hour
+duration_buckets = [0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+
+metrics_key_prefix = "brainns:metrics:"
+# Set of the keys of all histogram series
+series_key = f"{metrics_key_prefix}series"
+job_timings_key_prefix = f"{metrics_key_prefix}job:"
+# The spans of a job are kept for a day at most, e.g. if the worker was killed
+job_timings_ttl = 24 * 60 * 60
+
+# Token of the Prometheus scrape, empty disables GET /brainns-api/metrics
+scrape_token = os.getenv("METRICS_TOKEN", "")
+
+connection = None
+
+
+def is_scrape_authorized(authorization_header) -> bool:
+    if not scrape_token or not authorization_header.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(authorization_header[len("Bearer "):].strip().encode("utf-8"), scrape_token.encode("utf-8"))
+
+
+def get_connection():
+    # One connection pool per process, the API records every request
+    global connection
+    if connection is None:
+        connection = redis.from_url(scheduler.REDIS_URL)
+    return connection
+
+
+def observe(name, labels, value):
+    """Add value to the histogram series name{labels} in Redis."""
+    key = f"{metrics_key_prefix}{name}:{json.dumps(labels, sort_keys=True)}"
+    pipeline = get_connection().pipeline(transaction=False)
+    pipeline.sadd(series_key, key)
+    pipeline.hincrby(key, "count", 1)
+    pipeline.hincrbyfloat(key, "sum", value)
+    for bucket in duration_buckets:
+        if value <= bucket:
+            pipeline.hincrby(key, f"le:{bucket}", 1)
+    pipeline.execute()
+
+
+def record_stage(name, duration, started_at=None):
+    """Record a span of the current job, outside of a job (e.g. in the API) the span only goes into the histogram."""
+    job = get_current_job()
+    queue = job.origin if job else "api"
+    span = {
+        "stage": name,
+        "queue": queue,
+        "job_id": job.id if job else None,
+        "started_at": started_at if started_at is not None else time.time() - duration,
+        "duration": round(duration, 4),
+    }
+    print(f"TIMING {json.dumps(span)}")
+
+    try:
+        observe("stage_duration_seconds", {"stage": name, "queue": queue}, duration)
+        if job:
+            job_timings_key = f"{job_timings_key_prefix}{job.id}"
+            pipeline = get_connection().pipeline(transaction=False)
+            pipeline.rpush(job_timings_key, json.dumps(span))
+            pipeline.expire(job_timings_key, job_timings_ttl)
+            pipeline.execute()
+    except redis.exceptions.RedisError as e:
+        # The metrics must never fail a job
+        print(f"Could not record the timing of {name}: {e}")
+
+
+@contextmanager
+def stage(name):
+    """Time the stage name of the current job."""
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, started_at)
+
+
+def record_queue_wait():
+    """Record how long the current job waited in its queue. A job that depends on another job is only enqueued when
+    the other job has finished, so this doesn't include e.g. the wait for the preprocessing."""
+    job = get_current_job()
+    if job and job.enqueued_at and job.started_at:
+        record_stage("queue_wait", max(0.0, (job.started_at - job.enqueued_at).total_seconds()), job.enqueued_at.replace(tzinfo=timezone.utc).timestamp())
+
+
+def record_container_timings(timings_path):
+    """Record the spans a container wrote to timings_path, e.g. skullstrip, resample and register of the
+    preprocessing container. The file is a list of {"stage", "started_at", "duration"}."""
+    try:
+        with open(timings_path) as f:
+            spans = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"No stage timings of the container in {timings_path}: {e}")
+        return
+
+    for span in spans:
+        record_stage(span["stage"], span["duration"], span.get("started_at"))
+
+
+def save_job_timings(job, segmentation_ids):
+    """Store the spans of a finished job for each of its segmentations. Needs an app context, the caller commits."""
+    job_timings_key = f"{job_timings_key_prefix}{job.id}"
+    try:
+        pipeline = get_connection().pipeline()
+        pipeline.lrange(job_timings_key, 0, -1)
+        pipeline.delete(job_timings_key)
+        spans = [json.loads(span) for span in pipeline.execute()[0]]
+    except redis.exceptions.RedisError as e:
+        print(f"Could not load the timings of job {job.id}: {e}")
+        return
+
+    # Segmentations that were deleted in the meantime are skipped
+    existing_segmentation_ids = db.session.execute(
+        select(Segmentation.segmentation_id).where(Segmentation.segmentation_id.in_(segmentation_ids))
+    ).scalars().all()
+
+    for segmentation_id in existing_segmentation_ids:
+        for span in spans:
+            db.session.add(SegmentationStageTiming(
+                segmentation_id=segmentation_id,
+                job_id=job.id,
+                queue=span["queue"],
+                stage=span["stage"],
+                started_at=datetime.fromtimestamp(span["started_at"], timezone.utc),
+                duration=span["duration"]))
+
+
+def record_request(endpoint, method, status_code, duration):
+    try:
+        observe("request_duration_seconds", {"endpoint": endpoint or "unknown", "method": method, "status": str(status_code)}, duration)
+    except redis.exceptions.RedisError as e:
+        print(f"Could not record the request to {endpoint}: {e}")
+
+
+def format_labels(labels) -> str:
+    escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"') for key, value in labels.items()}
+    return ",".join(f'{key}="{value}"' for key, value in sorted(escaped.items()))
+
+
+def render_histograms(lines):
+    connection = get_connection()
+    families = {}
+    for key in sorted(key.decode() for key in connection.smembers(series_key)):
+        name, labels = key[len(metrics_key_prefix):].split(":", 1)
+        families.setdefault(name, []).append((json.loads(labels), connection.hgetall(key)))
+
+    for name, series in families.items():
+        lines.append(f"# TYPE brainns_{name} histogram")
+        for labels, values in series:
+            values = {field.decode(): value.decode() for field, value in values.items()}
+            for bucket in duration_buckets:
+                lines.append(f"brainns_{name}_bucket{{{format_labels({**labels, 'le': bucket})}}} {values.get(f'le:{bucket}', 0)}")
+            lines.append(f"brainns_{name}_bucket{{{format_labels({**labels, 'le': '+Inf'})}}} {values.get('count', 0)}")
+            lines.append(f"brainns_{name}_sum{{{format_labels(labels)}}} {values.get('sum', 0)}")
+            lines.append(f"brainns_{name}_count{{{format_labels(labels)}}} {values.get('count', 0)}")
+
+
+def render_gauges(lines):
+    connection = get_connection()
+    queue_names = scheduler.QUEUES + [scheduler.ARCHIVE_QUEUE]
+
+    lines.append("# TYPE brainns_queue_jobs gauge")
+    for queue_name in queue_names:
+        q = Queue(queue_name, connection=connection)
+        states = {
+            "queued": q.count,
+            "deferred": q.deferred_job_registry.count,
+            "started": q.started_job_registry.count,
+            "failed": q.failed_job_registry.count,
+        }
+        for state, count in states.items():
+            lines.append(f"brainns_queue_jobs{{{format_labels({'queue': queue_name, 'state': state})}}} {count}")
+
+    # Busy workers per queue, a worker of several queues is counted for each
+    workers = {queue_name: [0, 0] for queue_name in queue_names}
+    for worker in Worker.all(connection=connection):
+        for queue_name in worker.queue_names():
+            if queue_name in workers:
+                workers[queue_name][0] += 1
+                workers[queue_name][1] += worker.get_state() == "busy"
+
+    lines.append("# TYPE brainns_workers gauge")
+    for queue_name, (total, busy) in workers.items():
+        lines.append(f"brainns_workers{{{format_labels({'queue': queue_name, 'state': 'busy'})}}} {busy}")
+        lines.append(f"brainns_workers{{{format_labels({'queue': queue_name, 'state': 'idle'})}}} {total - busy}")
+    lines.append("# TYPE brainns_worker_utilization gauge")
+    for queue_name, (total, busy) in workers.items():
+        lines.append(f"brainns_worker_utilization{{{format_labels({'queue': queue_name})}}} {busy / total if total else 0}")
+
+    lines.append("# TYPE brainns_gpus_reserved gauge")
+    lines.append(f"brainns_gpus_reserved {sum(1 for _ in connection.scan_iter(f'{scheduler.gpu_key_prefix}[0-9]*'))}")
+
+
+def render() -> str:
+    """All metrics in the Prometheus text format."""
+    lines = []
+    render_histograms(lines)
+    render_gauges(lines)
+    return "\n".join(lines) + "\n"
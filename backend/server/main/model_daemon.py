@@ -0,0 +1,171 @@
+# server/main/model_daemon.py
+"""Long-lived inference server that runs inside a model container.
+
+This file is copied into the model container by server/main/model_pool.py and started instead of the one-shot
+model command. It keeps the Python interpreter (and with it TensorFlow/PyTorch and the model code) loaded between
+jobs and receives the jobs over HTTP. It may only use the standard library and has to stay compatible with
+Python 3.8, because the model images bring their own interpreters.
+"""
+
+import argparse
+import contextlib
+import importlib
+import importlib.util
+import json
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Only one job runs at a time per model server. Further jobs are rejected with 503 so that the worker can fall back
+# to a one-shot container.
+job_lock = threading.Lock()
+last_activity = time.time()
+loaded_modules = {}
+
+
+def load_entrypoint_module(module_path):
+    """Import the module of the entrypoint once and keep it, so that module level caches (e.g. loaded weights)
+    survive between jobs. module_path is either a dotted module name or a path to a .py file."""
+    if module_path in loaded_modules:
+        return loaded_modules[module_path]
+
+    if module_path.endswith(".py"):
+        file_path = os.path.abspath(module_path)
+        sys.path.insert(0, os.path.dirname(file_path))
+        module_name = os.path.splitext(os.path.basename(file_path))[0]
+        spec = importlib.util.spec_from_file_location(module_name, file_path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(module_path)
+
+    loaded_modules[module_path] = module
+    return module
+
+
+def run_entrypoint(entrypoint, argv):
+    """Run the model entrypoint with the given command line, argv is sys.argv of the entrypoint (argv[0] is the
+    script, not the interpreter). The entrypoint has the format "module:function" or
+    "path/to/script.py:function". Scripts without a main function ("path/to/script.py") are executed as __main__,
+    which still saves the interpreter start and the framework imports."""
+    module_path, _, function_name = entrypoint.partition(":")
+    sys.argv = list(argv)
+
+    if function_name:
+        module = load_entrypoint_module(module_path)
+        getattr(module, function_name)()
+    else:
+        sys.argv[0] = os.path.abspath(module_path)
+        runpy.run_path(module_path, run_name="__main__")
+
+
+def run_job(entrypoint, server_argv, job):
+    """Stage the inputs of a job as symlinks, rewrite the container paths in the command line of the server to the job
+    directories and run the model. Returns the exit code of the model."""
+    job_input_path = tempfile.mkdtemp(prefix="job_input_")
+    output_dir = job["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+
+    try:
+        for arcname, source_path in job["inputs"].items():
+            os.symlink(source_path, os.path.join(job_input_path, arcname))
+
+        argv = [
+            arg.replace(job["input_path"], job_input_path).replace(job["output_path"], output_dir)
+            for arg in server_argv
+        ]
+
+        # Write the logs of the job to the same file the one-shot container would write them to
+        with open(os.path.join(output_dir, "container_logs.log"), "w") as logfile, \
+                contextlib.redirect_stdout(logfile), contextlib.redirect_stderr(logfile):
+            print("Model server command:", argv, flush=True)
+            try:
+                run_entrypoint(entrypoint, argv)
+                return 0
+            except SystemExit as e:
+                # The model scripts call exit() on invalid input
+                return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                traceback.print_exc()
+                return 1
+    finally:
+        shutil.rmtree(job_input_path, ignore_errors=True)
+
+
+def make_handler(entrypoint, server_argv):
+    class ModelServerHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self.send_json(404, {"message": "Not found"})
+                return
+            self.send_json(200, {"status": "busy" if job_lock.locked() else "ready", "entrypoint": entrypoint, "argv": server_argv})
+
+        def do_POST(self):
+            global last_activity
+            if self.path != "/predict":
+                self.send_json(404, {"message": "Not found"})
+                return
+            if not job_lock.acquire(blocking=False):
+                self.send_json(503, {"message": "Model server is busy"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                job = json.loads(self.rfile.read(length))
+                start = time.time()
+                exit_code = run_job(entrypoint, server_argv, job)
+                self.send_json(200, {"exit_code": exit_code, "duration": time.time() - start})
+            finally:
+                last_activity = time.time()
+                job_lock.release()
+
+        def log_message(self, format, *args):
+            # Keep health checks out of the job logs
+            pass
+
+    return ModelServerHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keeps a model loaded and runs inference jobs received over HTTP.")
+    parser.add_argument("--entrypoint", required=True, help="module:function, script.py:function or script.py")
+    parser.add_argument("--argv", required=True, help="sys.argv of the entrypoint as JSON list, argv[0] is the script.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--idle-timeout", type=int, default=0,
+                        help="Shut down after this many seconds without a job (0 = never).")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("0.0.0.0", args.port), make_handler(args.entrypoint, json.loads(args.argv)))
+    server.timeout = 5
+
+    # Import the model code before the first job arrives
+    module_path, _, function_name = args.entrypoint.partition(":")
+    if function_name:
+        load_entrypoint_module(module_path)
+
+    print(f"Model server for {args.entrypoint} listening on port {args.port}", flush=True)
+    while True:
+        server.handle_request()
+        idle_for = time.time() - last_activity
+        if args.idle_timeout and not job_lock.locked() and idle_for > args.idle_timeout:
+            print(f"Model server idle for {int(idle_for)}s, shutting down.", flush=True)
+            break
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
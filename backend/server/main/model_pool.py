@@ -0,0 +1,201 @@
+# server/main/model_pool.py
+"""Pool of warm model servers used by the prediction task.
+
+Instead of creating a fresh container for every segmentation, each model image can be started once in server mode
+(see model_daemon.py). The container keeps running between jobs and receives jobs over HTTP on the docker network of
+the worker. RQ runs every job in a forked process, so the pool keeps no state in Python: the running model servers
+are found through their docker labels. If no server can be used, the caller falls back to the one-shot container.
+"""
+
+import json
+import os
+import socket
+import tarfile
+import time
+import urllib.error
+import urllib.request
+from io import BytesIO
+
+import docker.errors
+
+# "warm" uses model servers where the model config supports it, "oneshot" always creates a new container per job
+mode = os.getenv("MODEL_SERVER_MODE", "warm").lower()
+# Docker network shared by the worker and the model servers (see docker-compose.yml)
+network = os.getenv("MODEL_SERVER_NETWORK", "brainns-network")
+port = 8000
+# Model servers shut themselves down after this time without jobs, which also frees the GPU memory they hold
+idle_timeout = int(os.getenv("MODEL_SERVER_IDLE_TIMEOUT", 30 * 60))
+startup_timeout = 10 * 60
+job_timeout = 60 * 60
+
+# Paths of the image repository in the worker and inside the model servers
+worker_repository_path = "/usr/src/image-repository"
+server_repository_path = "/app/repository"
+daemon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_daemon.py")
+
+
+def is_enabled(config) -> bool:
+    return mode == "warm" and "serve_entrypoint" in config and "serve_argv" in config
+
+
+def get_server_name(model, device) -> str:
+    """Container name of the model server, e.g. model_server_nnunet-model-brainns_gpu0"""
+    return f"model_server_{model.replace(':', '-')}_{device}"
+
+
+def request_server(name, method, path, body=None, timeout=5):
+    """Send a request to a model server and return the status code and the decoded JSON answer."""
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(f"http://{name}:{port}{path}", data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, {}
+
+
+def get_server_info(name) -> dict | None:
+    """Returns the health of the server (status "ready" or "busy", entrypoint and argv it was started with) or None if
+    the server can't be reached (yet)."""
+    try:
+        status_code, answer = request_server(name, "GET", "/health")
+    except (urllib.error.URLError, OSError):
+        return None
+    return answer if status_code == 200 else None
+
+
+def get_server_status(name) -> str | None:
+    """Returns "ready", "busy" or None if the server can't be reached (yet)."""
+    info = get_server_info(name)
+    return info.get("status") if info is not None else None
+
+
+def serves_config(info, config) -> bool:
+    """Whether the server was started with the entrypoint and command line of the model config. The command line is
+    fixed when the server starts, a server of an older config is replaced instead of being sent jobs."""
+    return info.get("entrypoint") == config["serve_entrypoint"] and info.get("argv") == config["serve_argv"]
+
+
+def stop_server(client, name):
+    """Stop a model server and wait until it is removed, so that its name can be used again."""
+    try:
+        container = client.containers.get(name)
+        container.stop()
+        container.wait(condition="removed")
+    except docker.errors.NotFound:
+        pass
+
+
+def was_refused(error) -> bool:
+    """Whether a request failed before the server received it: nothing listens on the port or there is no such
+    container (yet)."""
+    reason = getattr(error, "reason", error)
+    return isinstance(reason, (ConnectionRefusedError, socket.gaierror))
+
+
+def stop_idle_servers(client, device, keep_model):
+    """Stop the idle model servers of all other models on the device, so that they don't hold its memory."""
+    containers = client.containers.list(filters={"label": [f"brainns.device={device}"], "status": "running"})
+    for container in containers:
+        if container.labels.get("brainns.model-server") != keep_model and get_server_status(container.name) == "ready":
+            print(f"Stopping idle model server {container.name}")
+            container.stop()
+
+
+def start_server(client, config, model, device, device_requests, container_user) -> str | None:
+    """Start a model server for the model on the given device ("cpu" or "gpu<ID>") and wait until it accepts jobs.
+    Returns the container name or None if the server could not be started."""
+    name = get_server_name(model, device)
+    data_path = os.getenv('DATA_PATH')  # Host path of the image repository, because the container is a sibling
+
+    try:
+        container = client.containers.create(
+            image = config["image"],
+            name = name,
+            command = config["serve_python"] + ["/app/model_daemon.py",
+                                                "--entrypoint", config["serve_entrypoint"],
+                                                "--argv", json.dumps(config["serve_argv"]),
+                                                "--port", str(port),
+                                                "--idle-timeout", str(idle_timeout)],
+            volumes = {
+                data_path: {
+                    'bind': server_repository_path,
+                    'mode': 'rw',
+                },
+            },
+            labels = {"brainns.model-server": model, "brainns.device": device},
+            network = network,
+            device_requests = device_requests,
+            user = container_user,
+            detach = True,
+            auto_remove = True
+        )
+
+        # Copy the daemon script into the model container
+        tarstream = BytesIO()
+        with tarfile.TarFile(fileobj=tarstream, mode='w') as tar:
+            tar.add(daemon_path, arcname="model_daemon.py")
+        tarstream.seek(0)
+        if not container.put_archive('/app', tarstream):
+            container.remove(force=True)
+            return None
+
+        container.start()
+    except docker.errors.APIError as e:
+        # 409: another job started the same server in the meantime, so just wait for it
+        if e.status_code != 409:
+            print(f"Failed to start model server {name}: {e}")
+            return None
+
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if get_server_status(name) is not None:
+            return name
+        try:
+            client.containers.get(name)
+        except docker.errors.NotFound:
+            print(f"Model server {name} exited during startup.")
+            return None
+        time.sleep(2)
+
+    print(f"Model server {name} did not become ready within {startup_timeout}s.")
+    return None
+
+
+def to_server_path(path) -> str:
+    """Translate a path in the image repository of the worker to the same path inside the model server."""
+    return os.path.join(server_repository_path, os.path.relpath(path, worker_repository_path))
+
+
+def run_prediction(client, name, config, input_files, output_dir) -> int | None:
+    """Send a prediction job to the model server. input_files maps the file names the model expects in its input
+    directory to the files in the image repository. Returns the exit code of the model or None if the server did
+    not take the job (busy or not reachable), in which case the caller should fall back to a one-shot container.
+    If the job was lost after the server may have started it (timeout, dropped connection), the server is stopped
+    and an error is raised, so that no one-shot container writes into the same output directory."""
+    job = {
+        "input_path": "/app/input",
+        "output_path": config["output_path"],
+        "inputs": {arcname: to_server_path(path) for arcname, path in input_files.items()},
+        "output_dir": to_server_path(output_dir),
+    }
+
+    try:
+        status_code, answer = request_server(name, "POST", "/predict", job, timeout=job_timeout)
+    except OSError as e:
+        if was_refused(e):
+            print(f"Model server {name} not reachable: {e}")
+            return None
+        print(f"Lost the job on model server {name}, stopping it: {e}")
+        stop_server(client, name)
+        raise RuntimeError(f"The job on model server {name} was lost: {e}") from e
+
+    if status_code == 503:
+        print(f"Model server {name} is busy and did not accept the job.")
+        return None
+    if status_code != 200:
+        raise RuntimeError(f"Model server {name} failed the job (HTTP {status_code}).")
+
+    print(f"Model server {name} finished the job in {answer['duration']:.1f}s with exit code {answer['exit_code']}.")
+    return answer["exit_code"]
@@ -5,30 +5,132 @@ from __future__ import print_function
 import SimpleITK as sitk
 
 import time, os
+import multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-def writeSlices(series_tag_values, new_img, i, writer, dest_path):
-    image_slice = new_img[:,:,i]
+# The GDCM writer of SimpleITK is not thread-safe (concurrent writes abort the process now and then), so the sequences
+# are converted in separate processes and the slices of a series are written by separate processes as well.
+conversion_processes = int(os.getenv("DICOM_CONVERSION_PROCESSES", min(4, os.cpu_count() or 4)))
+# Series whose slices are written by a slice writer process, set by the initializer of the process (see write_series)
+series_to_write = None
 
-    # Tags shared by the series.
-    list(map(lambda tag_value: image_slice.SetMetaData(tag_value[0], tag_value[1]), series_tag_values))
-
-    # Slice specific tags.
-    image_slice.SetMetaData("0008|0012", time.strftime("%Y%m%d")) # Instance Creation Date
-    image_slice.SetMetaData("0008|0013", time.strftime("%H%M%S")) # Instance Creation Time
+def get_slice_writer():
+    writer = sitk.ImageFileWriter()
+    # Use the study/series/frame of reference information given in the meta-data
+    # dictionary and not the automatically generated information from the file IO
+    writer.KeepOriginalImageUIDOn()
+    return writer
 
-    # Setting the type to CT preserves the slice location.
-    image_slice.SetMetaData("0008|0060", "CT")  # set the type to CT so the thickness is carried over
+def writeSlices(writer, series_tag_values, image_slice, i, position, dest_path):
+    # Tags shared by the series (built once per series) and the slice specific tags.
+    for tag, value in series_tag_values:
+        image_slice.SetMetaData(tag, value)
 
     # (0020, 0032) image position patient determines the 3D spacing between slices.
-    image_slice.SetMetaData("0020|0032", '\\'.join(map(str,new_img.TransformIndexToPhysicalPoint((0,0,i))))) # Image Position (Patient)
+    image_slice.SetMetaData("0020|0032", position) # Image Position (Patient)
     image_slice.SetMetaData("0020,0013", str(i)) # Instance Number
 
     # Write to the output directory and add the extension dcm, to force writing in DICOM format.
     writer.SetFileName(os.path.join(dest_path,str(i)+'.dcm'))
     writer.Execute(image_slice)
 
-def convert_base_image_to_dicom_sequence(nifti_image_path, dest_path, dicom_tag_src_path=""):
+def write_slices(series, slice_indices):
+    """Write the given slices of series, a tuple (new_img, series_tag_values, positions, dest_path)."""
+    new_img, series_tag_values, positions, dest_path = series
+    writer = get_slice_writer()
+    # Same slice as new_img[:,:,i], but with one filter instead of Slice and Extract and without starting the thread
+    # pool of the filter for every slice
+    extractor = sitk.ExtractImageFilter()
+    extractor.SetNumberOfThreads(1)
+    extractor.SetSize([new_img.GetWidth(), new_img.GetHeight(), 0])
+    for i in slice_indices:
+        extractor.SetIndex([0, 0, i])
+        writeSlices(writer, series_tag_values, extractor.Execute(new_img), i, positions[i], dest_path)
+
+def set_series_to_write(series):
+    global series_to_write
+    series_to_write = series
+
+def write_slice_chunk(slice_indices):
+    write_slices(series_to_write, slice_indices)
+
+def write_series(new_img, series_tag_values, dest_path, processes=1):
+    """Write the slices of the image as <index>.dcm files into dest_path. With more than one process, each process
+    writes a contiguous chunk of the slices."""
+    series = (new_img, series_tag_values, get_slice_positions(new_img), dest_path)
+    chunks = [chunk.tolist() for chunk in np.array_split(np.arange(new_img.GetDepth()), processes) if len(chunk)]
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            write_slices(series, chunk)
+        return
+    # Forked, so the image is inherited by the processes and not pickled, and they don't import the app again
+    with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context("fork"),
+                             initializer=set_series_to_write, initargs=(series,)) as executor:
+        list(executor.map(write_slice_chunk, chunks))
+
+def get_slice_positions(image):
+    """Image Position (Patient) of all slices at once: origin + index * spacing along the slice direction."""
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    slice_step = direction[:, 2] * image.GetSpacing()[2]
+    positions = np.array(image.GetOrigin()) + np.outer(np.arange(image.GetDepth()), slice_step)
+    return ['\\'.join(map(str, position)) for position in positions.tolist()]
+
+# Percentiles and number of histogram bins of the intensity statistics returned by convert_base_image_to_dicom_sequence
+statistics_percentiles = [0.5, 1, 2, 5, 25, 50, 75, 95, 98, 99, 99.5]
+histogram_bins = 256
+
+def get_intensity_statistics(image):
+    """Min/max, percentiles and a histogram of the voxel values of a UInt16 image. Everything is derived from one
+    bincount over the image in memory, so the written DICOM files don't have to be read again."""
+    counts = np.bincount(sitk.GetArrayViewFromImage(image).ravel())
+    present_values = np.flatnonzero(counts)
+    min_value, max_value = int(present_values[0]), int(present_values[-1])
+
+    cumulative_counts = np.cumsum(counts)
+    total = cumulative_counts[-1]
+    percentiles = {
+        str(percentile): int(np.searchsorted(cumulative_counts, max(total * percentile / 100, 1)))
+        for percentile in statistics_percentiles
+    }
+
+    histogram, bin_edges = np.histogram(np.arange(len(counts)), bins=histogram_bins, range=(min_value, max_value + 1), weights=counts)
+
+    return {
+        "min": min_value,
+        "max": max_value,
+        "percentiles": percentiles,
+        "histogram": {"counts": histogram.astype(int).tolist(), "bin_edges": bin_edges.tolist()},
+    }
+
+def get_window_bounds_by_dicom_tags(source_image):
+    """Window bounds given by Window Center (0028|1050) and Window Width (0028|1051) of the source header, or None."""
+    if not (source_image.HasMetaDataKey("0028|1050") and source_image.HasMetaDataKey("0028|1051")):
+        return None, None
+
+    # These might be multi-valued, use the first window
+    try:
+        window_center = float(source_image.GetMetaData("0028|1050").split("\\")[0])
+        window_width = float(source_image.GetMetaData("0028|1051").split("\\")[0])
+    except ValueError:
+        return None, None
+    return window_center - window_width / 2, window_center + window_width / 2
+
+def convert_base_images_to_dicom_sequences(conversions):
+    """Convert several base images concurrently, each in its own process. conversions is a list of argument tuples for
+    convert_base_image_to_dicom_sequence, i.e. (nifti_image_path, dest_path[, dicom_tag_src_path]). Returns the
+    statistics of the images in the same order."""
+    # Forked, so the processes don't import the app again. ITK suspends its thread pool around a fork.
+    # The processes are split between the sequences, each sequence writes its slices with its share.
+    slice_processes = max(1, conversion_processes // len(conversions))
+    with ProcessPoolExecutor(max_workers=min(len(conversions), conversion_processes), mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = [executor.submit(convert_base_image_to_dicom_sequence, *conversion, slice_processes=slice_processes) for conversion in conversions]
+        return [future.result() for future in futures]
+
+def convert_base_image_to_dicom_sequence(nifti_image_path, dest_path, dicom_tag_src_path="", slice_processes=conversion_processes):
+    """Write the image as a DICOM series with slice_processes processes and return its intensity statistics (see
+    get_intensity_statistics) together with the window bounds of the source header ("min_by_dicom_tag",
+    "max_by_dicom_tag")."""
     # Create a new series from a numpy array
     # Converted to UInt 16 so that the Viewer can handle it
     new_img = sitk.Cast(sitk.ReadImage(nifti_image_path), sitk.sitkUInt16)
@@ -44,11 +146,7 @@ def convert_base_image_to_dicom_sequence(nifti_image_path, dest_path, dicom_tag_
     #            If it is critical for your work to generate valid DICOM files,
     #            It is recommended to use David Clunie's Dicom3tools to validate the files 
     #                           (http://www.dclunie.com/dicom3tools.html).
-
-    writer = sitk.ImageFileWriter()
-    # Use the study/series/frame of reference information given in the meta-data
-    # dictionary and not the automatically generated information from the file IO
-    writer.KeepOriginalImageUIDOn()
+    # The slices are written by write_series() below.
 
     modification_time = time.strftime("%H%M%S")
     modification_date = time.strftime("%Y%m%d")
@@ -64,6 +162,7 @@ def convert_base_image_to_dicom_sequence(nifti_image_path, dest_path, dicom_tag_
                     ("0020|0037", '\\'.join(map(str, (direction[0], direction[3], direction[6],# Image Orientation (Patient)
                                                         direction[1],direction[4],direction[7]))))]
 
+    window_bounds = (None, None)
     reader = sitk.ImageSeriesReader()
     if dicom_tag_src_path:
         # Use the ImageSeriesReader to get the list of DICOM files in the series to get the header informations from
@@ -79,6 +178,8 @@ def convert_base_image_to_dicom_sequence(nifti_image_path, dest_path, dicom_tag_
             value = source_image.GetMetaData(key)
             series_tag_values.append((key, value.encode("utf-8", errors="replace").decode()))
 
+        window_bounds = get_window_bounds_by_dicom_tags(source_image)
+
     # Set series Description to missing if not set
     if not "0008|103e" in list(map(lambda e: e[0], series_tag_values)):
         series_tag_values.append(("0008|103e", "Missing"))
@@ -91,8 +192,18 @@ def convert_base_image_to_dicom_sequence(nifti_image_path, dest_path, dicom_tag_
     if not "0008|0008" in list(map(lambda e: e[0], series_tag_values)):
         series_tag_values.append(("0008|0008","DERIVED\\SECONDARY"))
 
+    # Slice tags that are the same for all slices
+    series_tag_values.append(("0008|0012", modification_date)) # Instance Creation Date
+    series_tag_values.append(("0008|0013", modification_time)) # Instance Creation Time
+    # Setting the type to CT preserves the slice location.
+    series_tag_values.append(("0008|0060", "CT"))  # set the type to CT so the thickness is carried over
+
     # Write slices to output directory
-    list(map(lambda i: writeSlices(series_tag_values, new_img, i, writer, dest_path), range(new_img.GetDepth())))
+    write_series(new_img, series_tag_values, dest_path, slice_processes)
+
+    statistics = get_intensity_statistics(new_img)
+    statistics["min_by_dicom_tag"], statistics["max_by_dicom_tag"] = window_bounds
+    return statistics
 
 
 def convert_base_image_to_3d_dicom(nifti_image_path, dest_path, dicom_tag_src_path=""):
@@ -0,0 +1,114 @@
+# server/main/preprocessing_cache.py
+"""Content-addressed cache for the results of the preprocessing task.
+
+The key of an entry is a hash over the content of the raw input files, the preprocessing version and the
+parameters, so the same study is only preprocessed once, no matter in which project or by which user it was
+uploaded. Entries are stored in the image repository and restored as copies. Hard links would be cheaper, but the
+tasks write into the preprocessed folder of a project (statistics, DICOM conversions, reruns of the container), and
+through a hard link such a write would change the entry and every other project restored from it.
+The cache is evicted in LRU order when it grows larger than PREPROCESSING_CACHE_MAX_GB.
+"""
+
+import hashlib
+import os
+import shutil
+import time
+import uuid
+
+# Increase whenever the preprocessing container or the conversion to DICOM changes its output, this invalidates
+# all existing entries.
+PREPROCESSING_VERSION = "2"
+
+cache_path = "/usr/src/image-repository/.preprocessing-cache"
+max_cache_size = float(os.getenv("PREPROCESSING_CACHE_MAX_GB", 50)) * 1024 ** 3
+chunk_size = 1024 * 1024
+
+
+def hash_file(digest, file_path):
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+
+
+def get_cache_key(raw_data_path, sequence_ids_and_names, file_format, parameters) -> str:
+    """Hash of the raw input files of all sequences, the preprocessing version and the parameters."""
+    digest = hashlib.sha256()
+    digest.update(f"version={PREPROCESSING_VERSION};format={file_format};parameters={parameters}".encode("utf-8"))
+
+    for seq in sorted(sequence_ids_and_names):
+        seq_id, seq_name = sequence_ids_and_names[seq]
+        sequence_path = os.path.join(raw_data_path, f'{seq_id}-{seq_name}')
+        digest.update(f";sequence={seq}".encode("utf-8"))
+
+        # Walk in a fixed order, so that the key doesn't depend on the file system
+        for root, dirs, files in os.walk(sequence_path):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                # The NIfTI files are named after the sequence ID, which differs between uploads of the same study
+                relative_path = os.path.relpath(file_path, sequence_path).replace(f"{seq_id}.nii", "sequence.nii")
+                digest.update(f";file={relative_path}".encode("utf-8"))
+                hash_file(digest, file_path)
+
+    return digest.hexdigest()
+
+
+def restore(cache_key, processed_data_path) -> bool:
+    """Fill processed_data_path with the cached preprocessing result. Returns False if there is no entry."""
+    entry_path = os.path.join(cache_path, cache_key)
+    if not os.path.isdir(entry_path):
+        return False
+
+    shutil.copytree(entry_path, processed_data_path, dirs_exist_ok=True)
+    # The modification time of the entry is used for the LRU eviction
+    os.utime(entry_path)
+    return True
+
+
+def store(cache_key, processed_data_path):
+    """Add the preprocessing result in processed_data_path to the cache and evict old entries if necessary."""
+    entry_path = os.path.join(cache_path, cache_key)
+    if os.path.isdir(entry_path):
+        return
+
+    # Build the entry in a temporary directory and rename it, so that other jobs never see half an entry
+    temp_path = os.path.join(cache_path, f".{cache_key}-{uuid.uuid4()}")
+    os.makedirs(cache_path, exist_ok=True)
+    shutil.copytree(processed_data_path, temp_path)
+    try:
+        os.rename(temp_path, entry_path)
+    except OSError:
+        # Another job stored the same entry in the meantime
+        shutil.rmtree(temp_path, ignore_errors=True)
+        return
+
+    evict()
+
+
+def get_size(path) -> int:
+    """Bytes freed by removing path. Files with other hard links (e.g. entries stored before the entries were copies)
+    keep their space, so they don't count."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            file_stat = os.stat(os.path.join(root, file))
+            if file_stat.st_nlink == 1:
+                size += file_stat.st_size
+    return size
+
+
+def evict():
+    """Remove the least recently used entries until the cache is smaller than the maximum size."""
+    entries = [
+        os.path.join(cache_path, entry) for entry in os.listdir(cache_path)
+        if not entry.startswith(".") and os.path.isdir(os.path.join(cache_path, entry))
+    ]
+    sizes = {entry: get_size(entry) for entry in entries}
+    total_size = sum(sizes.values())
+
+    for entry in sorted(entries, key=os.path.getmtime):
+        if total_size <= max_cache_size:
+            break
+        print(f"Evicting preprocessing cache entry {entry} (last used {time.ctime(os.path.getmtime(entry))})")
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= sizes[entry]
@@ -0,0 +1,133 @@
+# server/main/result_cache.py
+"""Reuse of finished segmentations for the same model and the same preprocessed input.
+
+The key of a result is a hash over the preprocessed input files as they are passed to the model, the digest of the
+model image and the command (including the checkpoint) of the model. Running the same model on the same sequences
+again, e.g. in a new segmentation or another project with the same study, links the outputs of the finished
+segmentation into the new folder instead of starting a container.
+
+The entries point to the folders of the segmentations that hold the result, every segmentation created from the cache
+gets its own entry. Entries are removed together with their segmentation (and its folder), so a result is reused as
+long as one of the segmentations with it exists. The functions need an app context, the caller commits.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+import redis
+
+from server.database import db
+from server.main import helper, scheduler
+from server.models import ResultCacheEntry
+
+# Increase whenever the outputs of the prediction (e.g. the conversion to DICOM) change, this invalidates all entries
+RESULT_CACHE_VERSION = "1"
+
+hash_chunk_size = 1024 * 1024
+# The hashes of the input files are memoized in Redis per (path, size, mtime_ns), a changed file gets a new key
+file_hash_key_prefix = "brainns:file-hash:"
+file_hash_ttl = 30 * 24 * 60 * 60
+
+connection = None
+
+
+def get_connection():
+    global connection
+    if connection is None:
+        connection = redis.from_url(scheduler.REDIS_URL)
+    return connection
+
+
+def get_file_hash(file_path, compute=True):
+    """SHA-256 of a file. The hash is memoized in Redis and recomputed when the file changes. With compute=False only
+    a memoized hash is returned, None if there is none."""
+    stat = os.stat(file_path)
+    memo_key = f"{file_hash_key_prefix}{file_path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    try:
+        file_hash = get_connection().get(memo_key)
+        if file_hash is not None:
+            return file_hash.decode("utf-8")
+    except redis.RedisError as e:
+        print(f"Could not read the memoized hash of {file_path}: {e}")
+
+    if not compute:
+        return None
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(hash_chunk_size):
+            digest.update(chunk)
+    file_hash = digest.hexdigest()
+
+    try:
+        get_connection().set(memo_key, file_hash, ex=file_hash_ttl)
+    except redis.RedisError as e:
+        print(f"Could not memoize the hash of {file_path}: {e}")
+    return file_hash
+
+
+def get_image_digest(client, image):
+    """ID of the local model image, None if there is no Docker client or the image doesn't exist yet."""
+    if client is None:
+        return None
+    try:
+        return client.images.get(image).id
+    except Exception as e:
+        print(f"Could not get the digest of image {image}: {e}")
+        return None
+
+
+def get_cache_key(config, image_digest, input_files, compute_hashes=True):
+    """Hash of the model image, its command and the input files, as the input_files mapping of prediction_task
+    (names in the input dir of the model -> preprocessed files). Returns None if the key can't be computed, or with
+    compute_hashes=False if a file wasn't hashed before."""
+    if image_digest is None:
+        return None
+
+    digest = hashlib.sha256()
+    model = {key: config.get(key) for key in ["command", "serve_python", "serve_entrypoint", "output_path"]}
+    digest.update(f"version={RESULT_CACHE_VERSION};image={image_digest};model={json.dumps(model, sort_keys=True)}".encode("utf-8"))
+    try:
+        for input_name in sorted(input_files):
+            file_hash = get_file_hash(input_files[input_name], compute_hashes)
+            if file_hash is None:
+                return None
+            digest.update(f";input={input_name}:{file_hash}".encode("utf-8"))
+    except OSError as e:
+        print(f"Could not hash the input of the model: {e}")
+        return None
+
+    return digest.hexdigest()
+
+
+def restore(cache_key, result_path) -> bool:
+    """Link the outputs of a segmentation with the same key into result_path. Returns False if there is none."""
+    if cache_key is None:
+        return False
+
+    for entry in ResultCacheEntry.query.filter_by(cache_key=cache_key).all():
+        if not os.path.isdir(entry.result_path):
+            # The folder is gone, e.g. the segmentation is being deleted
+            db.session.delete(entry)
+            continue
+
+        helper.link_tree(entry.result_path, result_path)
+        print(f"Result cache hit for {cache_key}, reused the result of segmentation {entry.segmentation_id}")
+        return True
+
+    return False
+
+
+def store(cache_key, segmentation_id, result_path):
+    if cache_key is None:
+        return
+    if db.session.get(ResultCacheEntry, (cache_key, segmentation_id)) is None:
+        db.session.add(ResultCacheEntry(cache_key=cache_key, segmentation_id=segmentation_id, result_path=result_path, date_time=datetime.now(timezone.utc)))
+
+
+def evict_segmentations(segmentation_ids):
+    """Remove the entries of the given segmentations, before they are deleted."""
+    ResultCacheEntry.query.filter(ResultCacheEntry.segmentation_id.in_([int(segmentation_id) for segmentation_id in segmentation_ids])).delete(synchronize_session=False)
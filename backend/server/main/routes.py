@@ -1,21 +1,23 @@
 # server/main/routes.py
 import redis
 from rq import Queue, Connection
-from flask import Blueprint, jsonify, request, g
+from flask import Blueprint, jsonify, request, g, Response
 import uuid
 import os
 import shutil
 from . import helper
-from . import dicom_classifier, tasks
+from . import dicom_classifier, tasks, scheduler, status_events, ingest, uploads, result_cache, metrics
 import zipfile
 # Note: Since we are inside a docker container we have to adjust the imports accordingly
 from server.database import db
-from server.main.tasks import preprocessing_task, prediction_task, report_segmentation_finished, report_segmentation_error 
-from server.models import Segmentation, Project, Sequence, Session, User, UserSettings, DisplayValues
+from server.auth import sessions
+from server.main.tasks import preprocessing_task, prediction_task, report_preprocessing_finished, report_segmentation_finished, report_segmentation_error 
+from server.models import Segmentation, Project, Sequence, User, UserSettings, DisplayValues, SegmentationBatch, SegmentationBatchEntry
 import json
 from pathlib import Path
 from datetime import datetime, timezone
 from sqlalchemy import select, and_
+from sqlalchemy.orm import selectinload
 import time
 import re
 import gzip
@@ -35,7 +37,7 @@ def authenticate_user():
     
     # todo: add store_sequence_informations
     # do not use middleware for requests, that dont need the user_id
-    public_endpoints = ['main.assign_types' , "main.get_nifti"]
+    public_endpoints = ['main.assign_types' , "main.get_nifti", "main.get_metrics"]
     
     if request.endpoint in public_endpoints:
         return
@@ -47,13 +49,13 @@ def authenticate_user():
 
     session_token = auth_header.replace('Bearer ', '').strip()
 
-    # validate token
-    session = Session.query.filter_by(session_token=session_token).first()
-    if session is None:
+    # validate token (cached, see auth/sessions.py)
+    user_id = sessions.get_user_id(session_token)
+    if user_id is None:
         return jsonify({'message': 'Invalid session token'}), 401
 
     # save user_id for routes to use
-    g.user_id = session.user_id
+    g.user_id = user_id
 
 
 @main_blueprint.route("/settings", methods=["GET"])
@@ -122,24 +124,9 @@ def update_settings():
 
 @main_blueprint.route("/classify", methods=["POST"])
 def assign_types():
-    base_path = "temp"
-    unique_id = str(uuid.uuid4())
-
-    unique_path = os.path.join(base_path, unique_id)
-
-    # create unique directories
-    os.makedirs(unique_path)
-
-    # extract the zip files to the unique directory
+    # Classify directly from the headers in the zip (see dicom_classifier.py)
     dicom_sequence = request.files["dicom_data"]
-
-    with zipfile.ZipFile(dicom_sequence) as z:
-        z.extractall(unique_path)
-
-    # run classification
-    classification = dicom_classifier.classify(unique_path)
-
-    shutil.rmtree(unique_path)
+    classification = dicom_classifier.classify_zip(dicom_sequence)
 
     return jsonify(classification), 200
 
@@ -208,17 +195,10 @@ def delete_project(project_id):
             successfully_stopped_segmentation_ids: list[str] = []
             # Like in the DELETE route for a segmentation, we first check if the segmentation can still be found in the queue
             # and if not, we try searching the corresponding container in the container list.
-            segmentation_ids_deleted_from_queue: list[str] = []
-
-            # Handle the elements in the queue
-            with Connection(redis.from_url("redis://redis:6379/0")):
-                q = Queue("my_queue")
-                for job in q.jobs:
-                    # Check if the job's segmentation ID is one of the IDs to stop
-                    if str(job.meta['segmentation_id']) in segmentation_ids_to_stop:
-                        q.remove(job.id)
-                        segmentation_ids_deleted_from_queue.append(str(job.meta['segmentation_id']))
-                        successfully_stopped_segmentation_ids.append(str(job.meta['segmentation_id']))
+
+            # Handle the elements in the queues
+            segmentation_ids_deleted_from_queue: list[str] = scheduler.remove_queued_jobs(segmentation_ids_to_stop)
+            successfully_stopped_segmentation_ids.extend(segmentation_ids_deleted_from_queue)
             
             # Handle the containers
             for segmentation_id in segmentation_ids_to_stop:
@@ -246,6 +226,7 @@ def delete_project(project_id):
                 helper.delete_folder(project_path_to_delete)
             
             # --- DB DELETION
+            result_cache.evict_segmentations(segmentation_ids_to_stop)
             project_to_delete.delete()
             db.session.commit()
             num_rows_after = Project.query.count()
@@ -292,17 +273,9 @@ def delete_segmentation(segmentation_id):
             if len(project_ids_for_user) == 1:
                 # --- CONTAINER/QUEUE DELETION
                 project_id = project_ids_for_user[0].project_id
-                job_deleted_from_queue = False
-                # If the segmentation's status is still QUEUEING, remove the element from the queue to ensure it never
+                # If the segmentation's status is still QUEUEING, remove the element from the queues to ensure it never
                 # gets into a later pipeline stage.
-                with Connection(redis.from_url("redis://redis:6379/0")):
-                    q = Queue("my_queue")
-                    for job in q.jobs:
-                        print("Job ID:", job.id, "Job's segmentation ID:", job.meta["segmentation_id"], "segmentation ID to remove:", segmentation_id)
-                        if str(job.meta['segmentation_id']) == str(segmentation_id):
-                            q.remove(job.id)
-                            print(f"Job for segmentation {job.meta['segmentation_id']} deleted from queue!")
-                            job_deleted_from_queue = True
+                job_deleted_from_queue = len(scheduler.remove_queued_jobs([segmentation_id])) > 0
         
                 # Only when the database is clean, we remove the corresponding containers. We don't know if the segmentation with segmentation_id
                 # is in the preprocessing or prediction stage, but the tasks module takes care of all that. This is only necessary if we haven't deleted
@@ -324,6 +297,7 @@ def delete_segmentation(segmentation_id):
                     helper.delete_folder(segmentation_path_to_delete)
                 
                 # --- DB DELETION
+                result_cache.evict_segmentations([segmentation_id])
                 relevant_segmentation.delete()
                 db.session.commit()
                 num_rows_after = Segmentation.query.count()
@@ -347,31 +321,46 @@ def delete_segmentation(segmentation_id):
 
 
 # Returns all relevant informations on all projects of the user except the actual sequences
+# Optional pagination: ?limit=<n> returns at most n projects, ordered by ID. If there are more, the header X-Next-Cursor
+# contains the value for ?cursor=<...> to get the next page. The response has an ETag for conditional requests.
 @main_blueprint.route("/projects", methods=["GET"])
 def get_projects():
     user_id = g.user_id
-
-    # Get all projects from a given user
-    projects = Project.query.filter_by(user_id = user_id)
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor", type=int)
+
+    # Get all projects from a given user, with their sequences and segmentations in one query per table
+    query = (
+        Project.query
+        .filter(Project.user_id == user_id)
+        .options(selectinload(Project.sequences), selectinload(Project.segmentations))
+        .order_by(Project.project_id)
+    )
+    if cursor is not None:
+        query = query.filter(Project.project_id > cursor)
+    if limit is not None:
+        # One more to know if there is a next page
+        query = query.limit(limit + 1)
+    projects = query.all()
+
+    next_cursor = None
+    if limit is not None and len(projects) > limit:
+        projects = projects[:limit]
+        next_cursor = projects[-1].project_id if projects else None
 
     response = []
     
     for project in projects:
-        project_id = project.project_id
-
         # Create an object for each project
         project_info = {
-            "projectID" : project_id,
+            "projectID" : project.project_id,
             "projectName" : project.project_name,
             "fileType" : project.file_format,
             "sequences" : [],
             "segmentations" : []
         }
 
-        # Get all sequences of the project
-        sequences = Sequence.query.filter_by(project_id = project_id)
-
-        for sequence in sequences:
+        for sequence in sorted(project.sequences, key=lambda sequence: sequence.sequence_id):
             # Create an object for each sequence in the project
             sequence_info = {
                 "sequenceID" : sequence.sequence_id,
@@ -387,10 +376,7 @@ def get_projects():
             # Append the sequence object to the project object
             project_info["sequences"].append(sequence_info)
 
-        # Get all segmentations of the project
-        segmentations = Segmentation.query.filter_by(project_id = project_id)
-
-        for segmentation in segmentations:
+        for segmentation in sorted(project.segmentations, key=lambda segmentation: segmentation.segmentation_id):
             # Create an object for each segmentation in the project
             segmentation_info = {
                 "segmentationID" : segmentation.segmentation_id,
@@ -410,45 +396,66 @@ def get_projects():
         # Append the project object to the response
         response.append(project_info)
 
-    return response
+    response = jsonify(response)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    # The dashboard polls this endpoint, an unchanged list is answered with 304
+    response.add_etag()
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
 
 
-@main_blueprint.route("/predict", methods=["POST"])
-def run_task():
-    # Get data from request
-    segmentation_data = request.get_json()
-    print("Segmentation data:")
-    print(segmentation_data)
-    user_id = g.user_id
-    project_id = segmentation_data["projectID"]
-    model = segmentation_data["model"]
-    model_config = helper.model_config(model, "")
-
-    necessarySequences = model_config["necessarySequences"]
-
+def find_preprocessed_segmentation(necessary_sequences, segmentation_data):
+    """An existing segmentation of the same sequences, its preprocessing and display values are reused."""
     sequence_filters = [
         getattr(Segmentation, f"{seq}_sequence") == segmentation_data[seq]
-        for seq in necessarySequences
+        for seq in necessary_sequences
+    ]
+    # The preprocessed folder depends on all sequences, e.g. a segmentation of only the t2 sequence can't reuse the
+    # preprocessing of all four
+    sequence_filters += [
+        getattr(Segmentation, f"{seq}_sequence").is_(None)
+        for seq in ["t1", "t1km", "t2", "flair"]
+        if seq not in necessary_sequences
     ]
     all_filters = [Segmentation.status != "ERROR"] + sequence_filters
+    return db.session.query(Segmentation).filter(and_(*all_filters)).first()
 
-    # Get display value entry from existing segmentation with the same sequences or create a new entry
-    preprocessed_segmentation = db.session.query(Segmentation).filter(and_(*all_filters)).first()
 
-    display_values = 0
-    if preprocessed_segmentation:
-        display_values = preprocessed_segmentation.display_values
-    else:
+def get_sequence_ids_and_names(necessary_sequences, segmentation_data, sequences=None) -> dict:
+    """Maps the necessary sequence types to (sequence ID, sequence name). sequences optionally maps the sequence IDs to
+    already loaded sequences."""
+    sequence_ids_and_names = {}
+
+    for seq in necessary_sequences:
+        try:
+            seq_id = segmentation_data[seq]
+        except KeyError:
+            raise KeyError(f"Missing key '{seq}' in segmentation_data")
+        if sequences is not None:
+            seq_obj = sequences.get(seq_id)
+        else:
+            seq_obj = Sequence.query.filter_by(sequence_id=seq_id).first()
+        if seq_obj is None:
+            raise ValueError(f"No sequence found for ID: {seq_id}")
+        sequence_ids_and_names[seq] = (seq_id, seq_obj.sequence_name)
+
+    return sequence_ids_and_names
+
+
+def create_segmentation(project_id, segmentation_name, model, segmentation_data, display_values) -> Segmentation:
+    """Add a new segmentation with the given display values, or new ones if display_values is None."""
+    if display_values is None:
         new_display_values = DisplayValues()
         # Add new display_values object
         db.session.add(new_display_values)
         db.session.flush()  # Use flush to get display_values_id
         display_values = new_display_values.display_values_id
-    
+
     # Create new segmentation object
     base_fields = {
         "project_id": project_id,
-        "segmentation_name": segmentation_data["segmentationName"],
+        "segmentation_name": segmentation_name,
         "display_values": display_values,
         "model": model,
         "status": "QUEUEING",
@@ -465,24 +472,138 @@ def run_task():
 
     # Combine all fields
     new_segmentation = Segmentation(**base_fields, **sequence_fields)
+    db.session.add(new_segmentation)
+    db.session.flush()  # Use flush to get segmentation_id
+    return new_segmentation
+
+
+def enqueue_segmentation(segmentation, preprocessed_segmentation, user_id, project_id, sequence_ids_and_names, model, model_config, user_name, domain, project_name):
+    """Enqueue the preprocessing and prediction jobs of a new segmentation. Must be called within a redis Connection.
+
+    The preprocessing job of the sequences is shared: if it is still pending (from an earlier segmentation of the same
+    sequences, a concurrent request or another model of a batch) the segmentation is attached to it instead."""
+    segmentation_id = segmentation.segmentation_id
+    # Preprocessing and prediction run on separate queues, the prediction on the queue of its resource (GPU/CPU)
+    preprocessing_queue = Queue(scheduler.PREPROCESSING_QUEUE)
+    q = Queue(scheduler.get_queue_name(model_config))
+
+    preprocessing_job = None
+    if not preprocessed_segmentation:
+        # Preprocessing Task
+        preprocessing_job = scheduler.enqueue_preprocessing(
+            preprocessing_task,
+            args=[user_id, project_id, segmentation_id, sequence_ids_and_names, user_name, domain, project_name, model_config["skipPreprocessing"]],
+            segmentation_id=segmentation_id,
+            job_id=scheduler.get_preprocessing_job_id(project_id, sequence_ids_and_names),
+            job_timeout=60 * 60, # 60 min
+            on_success=report_preprocessing_finished,
+            on_failure=report_segmentation_error)
+        # Attached to a preprocessing that is already running
+        if preprocessing_job.get_status() == "started":
+            segmentation.status = "PREPROCESSING"
+        preprocessing_id = preprocessing_job.get_id()
+
+    else:
+        # If the sequences are already preprocessed, we don't need a preprocessing task
+        preprocessing_id = preprocessed_segmentation.preprocessing_id
+        job = preprocessing_queue.fetch_job(preprocessing_id) if preprocessing_id else None
+
+        # If the preprocessing job is not finished, we have to wait for it
+        if job and scheduler.attach_to_job(job, segmentation_id):
+            segmentation.status = "PREPROCESSING"
+            preprocessing_job = job
+
+    # The preprocessed input is ready, a result of the same model and input is reused right away
+    if preprocessing_job is None and not model_config.get("resampledDataExists"):
+        if restore_cached_result(segmentation, user_id, project_id, sequence_ids_and_names, model, model_config, user_name, domain, project_name):
+            segmentation.preprocessing_id = preprocessing_id
+            return
+
+    # Prediction Task
+    prediction_job = q.enqueue(
+        prediction_task,
+        depends_on=preprocessing_job,
+        args=[user_id, project_id, segmentation_id, sequence_ids_and_names, model, user_name, domain, project_name],
+        job_timeout=60 * 60, # 60 min
+        on_success=report_segmentation_finished,
+        on_failure=report_segmentation_error)
+
+    prediction_job.meta['segmentation_id'] = segmentation_id
+    prediction_job.save_meta()
+
+    # Update segmentation object
+    segmentation.preprocessing_id = preprocessing_id
+    segmentation.prediction_id = prediction_job.get_id()
+
+
+def restore_cached_result(segmentation, user_id, project_id, sequence_ids_and_names, model, model_config, user_name, domain, project_name) -> bool:
+    """Link the result of a finished segmentation with the same model and preprocessed input into the new segmentation
+    and mark it as DONE (see result_cache.py). Returns False if there is no such result."""
+    processed_data_path = tasks.get_processed_data_path(user_id, user_name, domain, project_id, project_name, sequence_ids_and_names)
+    input_files = tasks.get_input_files(processed_data_path, sequence_ids_and_names)
+    # Only with the memoized hashes, the request doesn't hash the input. Otherwise the prediction job hashes it and
+    # looks up the cache before it runs the model.
+    cache_key = result_cache.get_cache_key(model_config, result_cache.get_image_digest(tasks.client, model), input_files, compute_hashes=False)
+
+    result_path = f'/usr/src/image-repository/{user_id}-{user_name}-{domain}/{project_id}-{project_name}/segmentations/{segmentation.segmentation_id}-{segmentation.segmentation_name}'
+    if not result_cache.restore(cache_key, result_path):
+        return False
+
+    result_cache.store(cache_key, segmentation.segmentation_id, result_path)
+    segmentation.status = "DONE"
+    status_events.publish_status(user_id, segmentation.segmentation_id, "DONE")
+    return True
+
+
+def get_segmentation_data(segmentation) -> dict:
+    return {
+        'segmentation_id': segmentation.segmentation_id,
+        'segmentation_name': segmentation.segmentation_name,
+        "date_time" : segmentation.date_time,
+        "model" : segmentation.model,
+        "selected_sequences": {
+            "t1_sequence" : segmentation.t1_sequence,
+            "t1km_sequence" : segmentation.t1km_sequence,
+            "t2_sequence" : segmentation.t2_sequence,
+            "flair_sequence" : segmentation.flair_sequence
+        },
+        "status" : segmentation.status
+    }
+
+
+@main_blueprint.route("/predict", methods=["POST"])
+def run_task():
+    # Get data from request
+    segmentation_data = request.get_json()
+    print("Segmentation data:")
+    print(segmentation_data)
+    user_id = g.user_id
+    project_id = segmentation_data["projectID"]
+    model = segmentation_data["model"]
+    model_config = helper.model_config(model, "")
+
+    necessarySequences = model_config["necessarySequences"]
+
+    # Get display value entry from existing segmentation with the same sequences or create a new entry
+    preprocessed_segmentation = find_preprocessed_segmentation(necessarySequences, segmentation_data)
+    display_values = preprocessed_segmentation.display_values if preprocessed_segmentation else None
 
     try:
         # Add new segmentation
-        db.session.add(new_segmentation)
-        db.session.flush()  # Use flush to get segmentation_id
-        
+        new_segmentation = create_segmentation(project_id, segmentation_data["segmentationName"], model, segmentation_data, display_values)
+
         # query the user mail from the db
         user = User.query.filter_by(user_id=user_id).first()
         user_mail = user.user_mail if user else "unknown_user"
-        
+
         user_name = helper.get_user_name(user_mail)
         # refers to either uksh or uni luebeck
         domain = helper.get_domain(user_mail)
-        
+
         # query the project name from the db
         project = Project.query.filter_by(project_id=project_id).first()
         project_name = project.project_name if project else "unknown_project"
-        
+
         # Create new directory for the segmentation
         segmentation_id = new_segmentation.segmentation_id
         segmentation_name = new_segmentation.segmentation_name
@@ -492,114 +613,17 @@ def run_task():
         print(f"Predicting segmentation {segmentation_id}")
 
         # TODO: error handling
-        sequence_ids_and_names = {}
-
-        for seq in necessarySequences:
-            try:
-                seq_id = segmentation_data[seq]
-                seq_obj = Sequence.query.filter_by(sequence_id=seq_id).first()
-                if seq_obj is None:
-                    raise ValueError(f"No sequence found for ID: {seq_id}")
-                sequence_ids_and_names[seq] = (seq_id, seq_obj.sequence_name)
-            except KeyError:
-                raise KeyError(f"Missing key '{seq}' in segmentation_data")
-
-        # Starting Preprocessing and Prediction Task 
-        with Connection(redis.from_url("redis://redis:6379/0")):
-            q = Queue("my_queue") # Define the queue
-            
-            # query the user mail from the db
-            user = User.query.filter_by(user_id=user_id).first()
-            user_mail = user.user_mail if user else "unknown_user"
-            user_name = helper.get_user_name(user_mail)
-            domain = helper.get_domain(user_mail)
-            
-            # query the project name from the db
-            project = Project.query.filter_by(project_id=project_id).first()
-            project_name = project.project_name if project else "unknown_project"
-
-            if not preprocessed_segmentation:
-                # Preprocessing Task
-                task_1 = q.enqueue(
-                    preprocessing_task,
-                    args=[user_id, project_id, segmentation_id, sequence_ids_and_names, user_name, domain, project_name, model_config["skipPreprocessing"]],
-                    job_timeout=60 * 60, # 60 min
-                    on_failure=report_segmentation_error)
-                # Prediction Task
-                task_2 = q.enqueue(
-                    prediction_task,
-                    depends_on=task_1, 
-                    args=[user_id, project_id, segmentation_id, sequence_ids_and_names, model, user_name, domain, project_name],
-                    job_timeout=60 * 60, # 60 min
-                    on_success=report_segmentation_finished,
-                    on_failure=report_segmentation_error)
-
-                task_1.meta['segmentation_id'] = segmentation_id
-                task_1.save_meta()
-
-                task_2.meta['segmentation_id'] = segmentation_id
-                task_2.save_meta()
-
-                # Update segmentation object and commit to DB
-                new_segmentation.preprocessing_id = task_1.get_id()
-                new_segmentation.prediction_id = task_2.get_id()
+        sequence_ids_and_names = get_sequence_ids_and_names(necessarySequences, segmentation_data)
 
-                db.session.commit()
+        # Starting Preprocessing and Prediction Task
+        with Connection(redis.from_url(scheduler.REDIS_URL)):
+            enqueue_segmentation(new_segmentation, preprocessed_segmentation, user_id, project_id, sequence_ids_and_names, model, model_config, user_name, domain, project_name)
 
-            else:
-                # If the sequences are already preprocessed, we don't need a preprocessing task
-                preprocessing_id = preprocessed_segmentation.preprocessing_id
-                preprocessing_job = q.fetch_job(preprocessing_id)
-
-                # If the preprocessing job is not finished, we have to wait for it
-                if(preprocessing_job and not preprocessing_job.is_finished):
-                    new_segmentation.status = "PREPROCESSING"
-                    # THERESA-TODO Delete Preprocessing before, just for debugging reasons
-
-                    task = q.enqueue(
-                        prediction_task,
-                        depends_on=preprocessing_job,
-                        args=[user_id, project_id, segmentation_id, sequence_ids_and_names, model, user_name, domain, project_name],
-                        job_timeout=60 * 60, # 60 min
-                        on_success=report_segmentation_finished,
-                        on_failure=report_segmentation_error) 
-                
-                    task.meta['segmentation_id'] = segmentation_id  
-                    task.save_meta()
-
-                else:
-                    task = q.enqueue(
-                        prediction_task, 
-                        args=[user_id, project_id, segmentation_id, sequence_ids_and_names, model, user_name, domain, project_name],
-                        job_timeout=60 * 60, # 60 min
-                        on_success=report_segmentation_finished,
-                        on_failure=report_segmentation_error) 
-                
-                    task.meta['segmentation_id'] = segmentation_id  
-                    task.save_meta()
-                        
-
-                # Update segmentation object and commit to DB
-                new_segmentation.prediction_id = task.get_id()
-                new_segmentation.preprocessing_id = preprocessing_id
-
-                db.session.commit()
+        db.session.commit()
 
         return jsonify({
             'message': 'Jobs started successfully!',
-            'segmentation_data' : {
-                'segmentation_id': new_segmentation.segmentation_id,
-                'segmentation_name': new_segmentation.segmentation_name,
-                "date_time" : new_segmentation.date_time,
-                "model" : new_segmentation.model,
-                "selected_sequences": {
-                    "t1_sequence" : new_segmentation.t1_sequence,
-                    "t1km_sequence" : new_segmentation.t1km_sequence,
-                    "t2_sequence" : new_segmentation.t2_sequence,
-                    "flair_sequence" : new_segmentation.flair_sequence
-                },
-                "status" : new_segmentation.status
-            }
+            'segmentation_data' : get_segmentation_data(new_segmentation)
         }), 202
     except Exception as e:
         print(e)
@@ -607,6 +631,149 @@ def run_task():
         return jsonify({'message': f'Error occurred while creating starting prediction: {str(e)}'}), 500
 
 
+# Start the segmentations of a cohort: every subject (a set of sequences of a project) with every model. Each subject
+# is preprocessed once, its preprocessing job fans out to the prediction jobs of all models that need the same sequences.
+# Expects {"batchName": ..., "models": [...], "subjects": [{"projectID": ..., "t1": ..., "t1km": ..., "t2": ...,
+# "flair": ..., "segmentationName": ...}, ...]}, segmentationName is optional.
+@main_blueprint.route("/segmentations/batch", methods=["POST"])
+def run_batch():
+    batch_data = request.get_json(silent=True) or {}
+    user_id = g.user_id
+    batch_name = batch_data.get("batchName") or "batch"
+    models = batch_data.get("models")
+    subjects = batch_data.get("subjects")
+
+    if not isinstance(models, list) or not models or not isinstance(subjects, list) or not subjects:
+        return jsonify({'message': 'A batch needs a list of models and a list of subjects.'}), 400
+    if any(not isinstance(subject, dict) or not isinstance(subject.get("projectID"), int) for subject in subjects):
+        return jsonify({'message': 'Every subject needs a projectID.'}), 400
+
+    try:
+        model_configs = {model: helper.model_config(model, "") for model in dict.fromkeys(models)}
+    except Exception as e:
+        return jsonify({'message': str(e)}), 400
+
+    # Load the projects, sequences and the user once for the whole batch
+    project_ids = {subject["projectID"] for subject in subjects}
+    projects = {project.project_id: project for project in Project.query.filter(Project.project_id.in_(project_ids), Project.user_id == user_id)}
+    if len(projects) != len(project_ids):
+        return jsonify({'message': 'Project not found.'}), 404
+
+    sequence_ids = {subject[seq] for subject in subjects for seq in ["t1", "t1km", "t2", "flair"] if seq in subject}
+    sequences = {sequence.sequence_id: sequence for sequence in Sequence.query.filter(Sequence.sequence_id.in_(sequence_ids))}
+
+    # Check every subject before anything is created
+    entries = []
+    for subject in subjects:
+        project_sequences = {sequence_id: sequence for sequence_id, sequence in sequences.items() if sequence.project_id == subject["projectID"]}
+        for model, model_config in model_configs.items():
+            try:
+                sequence_ids_and_names = get_sequence_ids_and_names(model_config["necessarySequences"], subject, project_sequences)
+            except (KeyError, ValueError) as e:
+                return jsonify({'message': f'Subject of project {subject["projectID"]}: {e.args[0]}'}), 400
+            # Only the sequences of the model are stored with its segmentation
+            model_subject = {seq: subject[seq] for seq in model_config["necessarySequences"]}
+            model_subject["projectID"] = subject["projectID"]
+            model_subject["segmentationName"] = subject.get("segmentationName")
+            entries.append((model_subject, model, model_config, sequence_ids_and_names))
+
+    user = User.query.filter_by(user_id=user_id).first()
+    user_mail = user.user_mail if user else "unknown_user"
+    user_name = helper.get_user_name(user_mail)
+    domain = helper.get_domain(user_mail)
+
+    batch_id = str(uuid.uuid4())
+    try:
+        db.session.add(SegmentationBatch(batch_id=batch_id, user_id=user_id, batch_name=batch_name, date_time=datetime.now(timezone.utc)))
+
+        # Preprocessing job ID -> (preprocessed segmentation, display values), shared by all models of a subject
+        preprocessings = {}
+        new_segmentations = []
+        for subject, model, model_config, sequence_ids_and_names in entries:
+            project_id = subject["projectID"]
+            preprocessing_key = scheduler.get_preprocessing_job_id(project_id, sequence_ids_and_names)
+            if preprocessing_key not in preprocessings:
+                preprocessed_segmentation = find_preprocessed_segmentation(model_config["necessarySequences"], subject)
+                preprocessings[preprocessing_key] = (preprocessed_segmentation, preprocessed_segmentation.display_values if preprocessed_segmentation else None)
+            preprocessed_segmentation, display_values = preprocessings[preprocessing_key]
+
+            segmentation_name = subject.get("segmentationName") or f"{batch_name}-{model.split(':')[0]}"
+            new_segmentation = create_segmentation(project_id, segmentation_name, model, subject, display_values)
+            if display_values is None:
+                preprocessings[preprocessing_key] = (preprocessed_segmentation, new_segmentation.display_values)
+            db.session.add(SegmentationBatchEntry(batch_id=batch_id, segmentation_id=new_segmentation.segmentation_id))
+
+            project_name = projects[project_id].project_name
+            os.makedirs(f'/usr/src/image-repository/{user_id}-{user_name}-{domain}/{project_id}-{project_name}/segmentations/{new_segmentation.segmentation_id}-{segmentation_name}')
+            new_segmentations.append((new_segmentation, preprocessed_segmentation, subject, model, model_config, sequence_ids_and_names))
+
+        # Commit before enqueueing, so that the first jobs find all segmentations of their batch
+        db.session.commit()
+    except Exception as e:
+        print(e)
+        db.session.rollback()
+        return jsonify({'message': f'Error occurred while creating the batch: {str(e)}'}), 500
+
+    with Connection(redis.from_url(scheduler.REDIS_URL)):
+        for new_segmentation, preprocessed_segmentation, subject, model, model_config, sequence_ids_and_names in new_segmentations:
+            project_id = subject["projectID"]
+            try:
+                enqueue_segmentation(new_segmentation, preprocessed_segmentation, user_id, project_id, sequence_ids_and_names, model, model_config, user_name, domain, projects[project_id].project_name)
+            except Exception as e:
+                print(f"Could not enqueue segmentation {new_segmentation.segmentation_id}: {e}")
+                new_segmentation.status = "ERROR"
+
+    db.session.commit()
+    print(f"Started batch {batch_id} with {len(new_segmentations)} segmentations of {len(preprocessings)} preprocessings")
+
+    return jsonify({
+        'message': 'Jobs started successfully!',
+        'batch_id': batch_id,
+        'segmentations': [get_segmentation_data(new_segmentation) for new_segmentation, *_ in new_segmentations]
+    }), 202
+
+
+# Aggregated progress of a batch: the number of segmentations per status and the finished fraction
+@main_blueprint.route("/segmentations/batch/<batch_id>", methods=["GET"])
+def get_batch_status(batch_id):
+    batch = SegmentationBatch.query.filter_by(batch_id=batch_id, user_id=g.user_id).first()
+    if batch is None:
+        return jsonify({'message': 'Batch not found.'}), 404
+
+    batch_segmentations = db.session.execute(
+        select(Segmentation.segmentation_id, Segmentation.status)
+        .join(SegmentationBatchEntry, Segmentation.segmentation_id == SegmentationBatchEntry.segmentation_id)
+        .where(SegmentationBatchEntry.batch_id == batch_id)
+    ).all()
+
+    statuses = { segmentation_id: status for segmentation_id, status in batch_segmentations }
+    counts = {}
+    for status in statuses.values():
+        counts[status] = counts.get(status, 0) + 1
+    total = len(statuses)
+    finished = counts.get("DONE", 0) + counts.get("ERROR", 0)
+
+    return jsonify({
+        'batch_id': batch.batch_id,
+        'batch_name': batch.batch_name,
+        'date_time': batch.date_time,
+        'total': total,
+        'counts': counts,
+        'progress': finished / total if total else 1.0,
+        'finished': finished == total,
+        'segmentations': statuses
+    }), 200
+
+
+# Stage durations, request durations, queue depths and worker utilization in the Prometheus text format (see metrics.py).
+# Not behind the user sessions, the scraper authenticates with the token METRICS_TOKEN.
+@main_blueprint.route("/metrics", methods=["GET"])
+def get_metrics():
+    if not metrics.is_scrape_authorized(request.headers.get('Authorization', '')):
+        return jsonify({'message': 'Missing or invalid metrics token'}), 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 # Get the segmentation status for all segmentations of this user that are either QUEUEING, PREPROCESSING or PREDICTING, i.e.,
 # those that are not resolved yet.
 @main_blueprint.route("/segmentations/status", methods=["GET"])
@@ -616,13 +783,13 @@ def get_all_segmentation_statuses():
     result = {}
 
     try:
-        # Get all the user's projects to check if the segmentations' project ID is in the list of user projects.
-        user_projects = Project.query.filter_by(user_id = user_id).all()
-        allowed_project_ids = [project.project_id for project in user_projects]
-        # Get relevant segmentations, i.e., those of the logged in user.
-        user_segmentations = db.session.execute(select(Segmentation).where(Segmentation.project_id.in_(allowed_project_ids))).fetchall()
-        # Get row[0] because for some reason, the request above returns 1-element tuples of Segmentations
-        result = { row[0].segmentation_id: row[0].status for row in user_segmentations }
+        # Get the segmentations of the logged in user with a single join instead of loading the projects first
+        user_segmentations = db.session.execute(
+            select(Segmentation.segmentation_id, Segmentation.status)
+            .join(Project, Segmentation.project_id == Project.project_id)
+            .where(Project.user_id == user_id)
+        ).all()
+        result = { segmentation_id: status for segmentation_id, status in user_segmentations }
 
         return jsonify(result), 200
 
@@ -634,15 +801,63 @@ def get_all_segmentation_statuses():
     
 
 
+# Server-sent events with the status changes of the user's segmentations (see status_events.py). The first event
+# contains the current status of all segmentations, every further event the changed ones, in the format of
+# /segmentations/status.
+@main_blueprint.route("/segmentations/status/stream", methods=["GET"])
+def stream_segmentation_statuses():
+    user_id = g.user_id
+
+    try:
+        pubsub = status_events.subscribe(user_id)
+    except redis.RedisError as e:
+        print(e)
+        return jsonify({'message': 'Status stream not available, use /segmentations/status instead'}), 503
+
+    user_segmentations = db.session.execute(
+        select(Segmentation.segmentation_id, Segmentation.status)
+        .join(Project, Segmentation.project_id == Project.project_id)
+        .where(Project.user_id == user_id)
+    ).all()
+    initial_statuses = { segmentation_id: status for segmentation_id, status in user_segmentations }
+    # Don't hold a DB connection for the lifetime of the stream
+    db.session.close()
+
+    response = Response(status_events.stream_statuses(pubsub, initial_statuses), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Disable the response buffering of nginx
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @main_blueprint.route("/projects", methods=["POST"])
 def create_project():
     stringified_project_information = request.form.get("project_information")
     print(request.form)
     project_information = json.loads(stringified_project_information)
-    file_infos = project_information["file_infos"]
     file_format = project_information["file_format"]
     files = request.files["data"]
-    user_id = g.user_id
+
+    def extract_files(sequence_directories, nifti_targets):
+        # Index the archive once and extract the files of all sequences in parallel (see ingest.py)
+        match file_format:
+            case "dicom":
+                ingest.extract_dicom_sequences(files, sequence_directories)
+
+            case "nifti":
+                missing_sequences = ingest.extract_nifti_sequences(files, nifti_targets)
+                if missing_sequences:
+                    return f'Image data for sequence: {missing_sequences[0]} is missing.'
+
+    return save_project(g.user_id, project_information, extract_files)
+
+
+def save_project(user_id, project_information, place_files):
+    """Create the project, its sequences and its folders. place_files(sequence_directories, nifti_targets) puts the
+    image data of the sequences into their folders and returns an error message or None.
+    Used by POST /projects and by the completion of a chunked upload."""
+    file_infos = project_information["file_infos"]
+    file_format = project_information["file_format"]
 
     print("----- Project information: -----")
     print(project_information)
@@ -685,13 +900,9 @@ def create_project():
         os.makedirs(preprocessed_directory, exist_ok=False)
         os.makedirs(segmentations_directory, exist_ok=False)
 
-        # Initialize temp directory for classification
-        if file_format == "dicom":
-            unique_id = str(uuid.uuid4())
-            classifier_path = os.path.join("temp", unique_id)
-            os.makedirs(classifier_path)
-
         # Add all sequences to the database
+        sequence_directories = {}
+        nifti_targets = {}
         for sequence_data in file_infos:
             # remove trailing '/' of sequence_name
             sequence_name = sequence_data.get('sequence_name')
@@ -724,48 +935,21 @@ def create_project():
             # ?
             sequence_directory = os.path.join(f'{raw_directory}/{sequence_id}-{sequence_name}')
             os.makedirs(sequence_directory, exist_ok=False)
+            sequence_directories[sequence_name] = sequence_directory
+            nifti_targets[sequence_name] = os.path.join(sequence_directory, f"{sequence_id}.nii.gz")
 
-            match file_format:
-                case "dicom":
-                    # Extract dicom files to the correct folder
-                    with zipfile.ZipFile(files) as z:
-                        # Get the files from the sequence
-                        relevant_files = [f for f in z.namelist() if f.startswith(sequence_name) and os.path.basename(f)]
-                        if not relevant_files:
-                            continue
-                        
-                        # Extract one slice of each sequence to the classifier folder
-                        z.extract(relevant_files[0], classifier_path)
-
-                        for file in relevant_files:
-                            filename = os.path.basename(file)
-                                
-                            # Extract each file to the image-repository
-                            source = z.open(file)
-                            target = open(os.path.join(sequence_directory, filename), "wb")
-                            with source, target:
-                                shutil.copyfileobj(source, target)
-                
-                case "nifti":
-                    with zipfile.ZipFile(files) as z:
-                        # Find the correct nifti file in the zip for each sequence
-                        if sequence_name in z.namelist():
-                            source = z.open(sequence_name)
-                            if sequence_name.endswith(".nii"): 
-                                with source, gzip.open(os.path.join(sequence_directory, f"{sequence_id}.nii.gz"), "wb") as target:
-                                    shutil.copyfileobj(source, target)
-                            elif sequence_name.endswith(".nii.gz"):
-                                target = open(os.path.join(sequence_directory, f"{sequence_id}.nii.gz"), "wb")
-                                # Extract each file to the image-repository
-                                with source, target:
-                                    shutil.copyfileobj(source, target)
-                        else:
-                            return jsonify({'message': f'Image data for sequence: {sequence_name} is missing.'}), 400
+        error_message = place_files(sequence_directories, nifti_targets)
+        if error_message:
+            db.session.rollback()
+            shutil.rmtree(project_path, ignore_errors=True)
+            return jsonify({'message': error_message}), 400
 
         if file_format == "dicom":
-            # Run classification
-            classification = dicom_classifier.classify(classifier_path)
-            shutil.rmtree(classifier_path)
+            # Run classification on the headers of one slice of each sequence
+            classification = dicom_classifier.classify_files({
+                sequence_name: os.path.join(sequence_directory, min(os.listdir(sequence_directory)))
+                for sequence_name, sequence_directory in sequence_directories.items() if os.listdir(sequence_directory)
+            })
 
             # Set database entries according to classification
             for seq_type, seq_list in classification.items():
@@ -790,6 +974,139 @@ def create_project():
     
 
 
+# Resumable chunked upload of a new project (see uploads.py)
+@main_blueprint.route("/uploads", methods=["POST"])
+def create_upload():
+    data = request.get_json()
+    project_information = data["project_information"]
+    parts = data["parts"]
+
+    if project_information.get("file_format") not in ["dicom", "nifti"]:
+        return jsonify({'message': f'Unsupported file format. Supported file formats are dicom or nifti.'}), 400
+
+    sequence_names = [file_info["sequence_name"] for file_info in project_information["file_infos"]]
+    part_names = [part.get("sequence_name") for part in parts]
+    if len(set(part_names)) != len(part_names) or any(name not in sequence_names for name in part_names):
+        return jsonify({'message': 'Every part must belong to a different sequence of the project.'}), 400
+    if any(not isinstance(part.get("size"), int) or part["size"] < 0 for part in parts):
+        return jsonify({'message': 'Invalid part size.'}), 400
+    if project_information["file_format"] == "nifti":
+        missing_sequences = [name for name in sequence_names if name not in part_names]
+        if missing_sequences:
+            return jsonify({'message': f'Image data for sequence: {missing_sequences[0]} is missing.'}), 400
+
+    upload = uploads.create_upload(g.user_id, project_information, parts)
+    return jsonify({
+        "upload_id": upload["upload_id"],
+        "chunk_size": upload["chunk_size"],
+        "parts": upload["parts"]
+    }), 201
+
+
+def get_user_upload(upload_id):
+    """Returns the upload, if it belongs to the user."""
+    upload = uploads.load_upload(upload_id)
+    if upload is None or upload["user_id"] != g.user_id:
+        return None
+    return upload
+
+
+@main_blueprint.route("/uploads/<uuid:upload_id>", methods=["GET"])
+def get_upload(upload_id):
+    upload_id = str(upload_id)
+    upload = get_user_upload(upload_id)
+    if upload is None:
+        return jsonify({'message': 'Upload not found.'}), 404
+
+    received_chunks = uploads.get_received_chunks(upload_id)
+    return jsonify({
+        "upload_id": upload_id,
+        "chunk_size": upload["chunk_size"],
+        "parts": [{**part, "received_chunks": received_chunks[index]} for index, part in enumerate(upload["parts"])]
+    }), 200
+
+
+@main_blueprint.route("/uploads/<uuid:upload_id>/parts/<int:part>/chunks/<int:index>", methods=["PUT"])
+def upload_chunk(upload_id, part, index):
+    upload_id = str(upload_id)
+    upload = get_user_upload(upload_id)
+    if upload is None:
+        return jsonify({'message': 'Upload not found.'}), 404
+    if part >= len(upload["parts"]) or index >= upload["parts"][part]["chunks"]:
+        return jsonify({'message': f'Chunk {index} of part {part} does not exist.'}), 404
+
+    checksum = request.headers.get("X-Chunk-SHA256", "").lower()
+    if not re.fullmatch(r"[0-9a-f]{64}", checksum):
+        return jsonify({'message': 'Missing or invalid X-Chunk-SHA256 header'}), 400
+
+    length = uploads.get_chunk_length(upload["parts"][part], index)
+    if request.content_length != length:
+        return jsonify({'message': f'Chunk {index} of part {part} must have {length} bytes.'}), 400
+
+    # A chunk that was sent again, e.g. because its response got lost. It must not be written again, the part may
+    # already be extracted.
+    received_checksum = uploads.get_received_checksum(upload_id, part, index)
+    if received_checksum is not None:
+        if received_checksum != checksum:
+            return jsonify({'message': f'Chunk {index} of part {part} was already received with another checksum.'}), 409
+        return jsonify({'message': 'Chunk received.'}), 200
+
+    try:
+        written_checksum = uploads.write_chunk(upload_id, part, index, request.stream, length)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    if written_checksum != checksum:
+        return jsonify({'message': f'Checksum mismatch of chunk {index} of part {part}, please send it again.'}), 422
+
+    part_complete = uploads.mark_chunk_received(upload_id, part, index, checksum)
+    return jsonify({'message': 'Chunk received.', "part_complete": part_complete}), 200
+
+
+@main_blueprint.route("/uploads/<uuid:upload_id>/complete", methods=["POST"])
+def complete_upload(upload_id):
+    upload_id = str(upload_id)
+    upload = get_user_upload(upload_id)
+    if upload is None:
+        return jsonify({'message': 'Upload not found.'}), 404
+
+    received_chunks = uploads.get_received_chunks(upload_id)
+    missing_chunks = {
+        index: part["chunks"] - len(received_chunks[index])
+        for index, part in enumerate(upload["parts"]) if len(received_chunks[index]) < part["chunks"]
+    }
+    if missing_chunks:
+        return jsonify({'message': 'The upload is incomplete.', "missing_chunks": missing_chunks}), 409
+
+    try:
+        uploads.wait_for_ingest(upload_id)
+    except Exception as e:
+        print(f"Error while extracting upload {upload_id}: ", e)
+        return jsonify({'message': f'Error occurred while extracting the upload, please upload the project again: {str(e)}'}), 422
+
+    moved_paths = []
+    def move_files(sequence_directories, nifti_targets):
+        uploads.move_sequences(upload_id, sequence_directories, nifti_targets, moved_paths)
+
+    response = save_project(g.user_id, upload["project_information"], move_files)
+    if response[1] == 201:
+        uploads.delete_upload(upload_id)
+    else:
+        # The project wasn't saved, the upload keeps its files so that the completion can be retried
+        uploads.restore_sequences(moved_paths)
+    return response
+
+
+@main_blueprint.route("/uploads/<uuid:upload_id>", methods=["DELETE"])
+def delete_upload(upload_id):
+    upload_id = str(upload_id)
+    if get_user_upload(upload_id) is None:
+        return jsonify({'message': 'Upload not found.'}), 404
+
+    uploads.delete_upload(upload_id)
+    return jsonify({'message': 'Upload deleted.'}), 200
+
+
 @main_blueprint.route("/sequences", methods=["PATCH"])
 def store_sequence_informations():
     try:
@@ -0,0 +1,190 @@
+# server/main/scheduler.py
+"""Routing of the segmentation jobs to per-resource queues and atomic reservation of GPUs.
+
+worker.py starts one RQ worker per GPU on the gpu queue and a configurable number of workers on the cpu and
+preprocessing queues, so a job is only dequeued when a worker for its resource is free and a GPU-bound backlog
+can't starve preprocessing or CPU inference. Inside a GPU job, reserve_gpu() atomically claims a device in Redis,
+so that several worker containers never use the same GPU at the same time.
+
+The preprocessing of a set of sequences has a fixed job ID. enqueue_preprocessing() only enqueues it if it isn't
+queued or running yet, otherwise the segmentation is attached to the pending job. Concurrent requests and the models
+of a batch therefore share one preprocessing job, instead of preprocessing into the same folder at the same time.
+"""
+
+import hashlib
+import time
+from contextlib import contextmanager
+
+import GPUtil
+import redis
+from rq import Queue, get_current_job
+
+REDIS_URL = "redis://redis:6379/0"
+
+PREPROCESSING_QUEUE = "preprocessing"
+GPU_QUEUE = "gpu"
+CPU_QUEUE = "cpu"
+QUEUES = [PREPROCESSING_QUEUE, GPU_QUEUE, CPU_QUEUE]
+# Background jobs that build zip archives for downloads and the viewer (see server/images/helper.py)
+ARCHIVE_QUEUE = "archives"
+
+# A reservation expires after the job timeout, so that a crashed worker doesn't block a GPU forever
+reservation_ttl = 60 * 60 + 5 * 60
+gpu_key_prefix = "brainns:gpu:"
+gpu_released_key = "brainns:gpu:released"
+job_lock_prefix = "brainns:lock:"
+# Job states in which a job will still run
+pending_job_states = ("queued", "deferred", "scheduled", "started")
+
+# Deletes the reservation only if it still belongs to the given owner
+release_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def get_queue_name(config) -> str:
+    """The queue a prediction job for the given model config is sent to."""
+    return GPU_QUEUE if config["uses_gpu"] else CPU_QUEUE
+
+
+def get_gpu_ids() -> list[int]:
+    return [gpu.id for gpu in GPUtil.getGPUs()]
+
+
+def reserve_gpu(owner, timeout=60 * 60) -> int:
+    """Reserve a free GPU for owner and return its ID. Blocks until a GPU is released if all are reserved."""
+    connection = redis.from_url(REDIS_URL)
+    gpu_ids = get_gpu_ids()
+    if not gpu_ids:
+        raise Exception("No GPU available on this worker.")
+
+    deadline = time.time() + timeout
+    while True:
+        for gpu_id in gpu_ids:
+            # SET NX is atomic, so only one job can get the reservation of a GPU
+            if connection.set(f"{gpu_key_prefix}{gpu_id}", str(owner), nx=True, ex=reservation_ttl):
+                print(f"Reserved GPU {gpu_id} for {owner}")
+                return gpu_id
+
+        if time.time() > deadline:
+            raise Exception(f"No GPU became free within {timeout}s.")
+
+        # Wait until another job releases its GPU instead of polling the GPUs
+        connection.blpop(gpu_released_key, timeout=5)
+
+
+def release_gpu(gpu_id, owner):
+    connection = redis.from_url(REDIS_URL)
+    if connection.eval(release_script, 1, f"{gpu_key_prefix}{gpu_id}", str(owner)):
+        connection.lpush(gpu_released_key, gpu_id)
+        # Nobody may be waiting, so don't let the notifications pile up, one per GPU is enough
+        connection.ltrim(gpu_released_key, 0, max(len(get_gpu_ids()), 1) - 1)
+        print(f"Released GPU {gpu_id} of {owner}")
+
+
+@contextmanager
+def reserved_gpu(owner):
+    gpu_id = reserve_gpu(owner)
+    try:
+        yield gpu_id
+    finally:
+        release_gpu(gpu_id, owner)
+
+
+def enqueue_archive(function, entries, archive_path, *args):
+    """Enqueue a job that builds the zip archive at archive_path, unless the same archive is already being built.
+    function is the import path of the build function, so the API doesn't have to import it."""
+    connection = redis.from_url(REDIS_URL)
+    q = Queue(ARCHIVE_QUEUE, connection=connection)
+    job_id = f"archive-{hashlib.sha1(archive_path.encode('utf-8')).hexdigest()}"
+
+    job = q.fetch_job(job_id)
+    if job is not None and job.get_status() in ("queued", "started"):
+        return job
+    return q.enqueue(function, entries, archive_path, *args, job_id=job_id, job_timeout=60 * 60, result_ttl=0)
+
+
+def get_preprocessing_job_id(project_id, sequence_ids_and_names) -> str:
+    """The ID of the preprocessing job of a set of sequences. The sequence IDs are the same as in the name of the
+    preprocessed folder (see tasks.py)."""
+    sequence_ids = "_".join(str(sequence_ids_and_names.get(seq, ("0",))[0]) for seq in ["flair", "t1", "t1km", "t2"])
+    return f"preprocessing-{project_id}-{sequence_ids}"
+
+
+def get_job_segmentation_ids(job) -> list:
+    """The segmentations that wait for a job. Only a shared preprocessing job has more than one."""
+    return job.meta.get("segmentation_ids", [job.meta.get("segmentation_id")])
+
+
+def add_job_segmentation_id(job, segmentation_id):
+    job.meta["segmentation_ids"] = get_job_segmentation_ids(job) + [segmentation_id]
+    job.save_meta()
+
+
+def attach_to_job(job, segmentation_id) -> bool:
+    """Let the segmentation wait for a job of another segmentation, e.g. its preprocessing. Returns False if the job
+    is not pending anymore."""
+    connection = redis.from_url(REDIS_URL)
+    with connection.lock(f"{job_lock_prefix}{job.id}", timeout=30):
+        job.refresh()
+        if job.get_status() not in pending_job_states:
+            return False
+        add_job_segmentation_id(job, segmentation_id)
+    return True
+
+
+def enqueue_preprocessing(function, args, segmentation_id, job_id, **kwargs):
+    """Enqueue the preprocessing job with job_id for the segmentation or attach the segmentation to it, if the job
+    is already pending. Returns the job."""
+    connection = redis.from_url(REDIS_URL)
+    q = Queue(PREPROCESSING_QUEUE, connection=connection)
+    with connection.lock(f"{job_lock_prefix}{job_id}", timeout=30):
+        job = q.fetch_job(job_id)
+        if job is not None and job.get_status() in pending_job_states:
+            add_job_segmentation_id(job, segmentation_id)
+            return job
+        return q.enqueue(function, args=args, job_id=job_id, meta={"segmentation_id": segmentation_id, "segmentation_ids": [segmentation_id]}, **kwargs)
+
+
+def get_current_segmentation_ids(segmentation_id) -> list:
+    """The segmentations that wait for the job that is running in this worker, segmentation_id outside of a job."""
+    job = get_current_job()
+    if job is None:
+        return [segmentation_id]
+    job.get_meta(refresh=True)
+    return get_job_segmentation_ids(job)
+
+
+def remove_queued_jobs(segmentation_ids) -> list[str]:
+    """Remove the queued jobs of the given segmentations from all queues and return the IDs of the segmentations
+    whose jobs were removed."""
+    segmentation_ids = [str(segmentation_id) for segmentation_id in segmentation_ids]
+    removed_segmentation_ids = []
+
+    connection = redis.from_url(REDIS_URL)
+    for queue_name in QUEUES:
+        q = Queue(queue_name, connection=connection)
+        for job in q.jobs:
+            job_segmentation_ids = [str(job_segmentation_id) for job_segmentation_id in get_job_segmentation_ids(job)]
+            if not any(job_segmentation_id in segmentation_ids for job_segmentation_id in job_segmentation_ids):
+                continue
+
+            # A shared preprocessing job is only removed together with the last of its segmentations
+            remaining_segmentation_ids = [job_segmentation_id for job_segmentation_id in job_segmentation_ids if job_segmentation_id not in segmentation_ids]
+            if remaining_segmentation_ids:
+                with connection.lock(f"{job_lock_prefix}{job.id}", timeout=30):
+                    job.meta["segmentation_ids"] = [int(job_segmentation_id) for job_segmentation_id in remaining_segmentation_ids]
+                    if str(job.meta.get("segmentation_id")) in segmentation_ids:
+                        job.meta["segmentation_id"] = job.meta["segmentation_ids"][0]
+                    job.save_meta()
+                continue
+
+            q.remove(job.id)
+            for job_segmentation_id in job_segmentation_ids:
+                print(f"Job for segmentation {job_segmentation_id} deleted from queue {queue_name}!")
+                removed_segmentation_ids.append(job_segmentation_id)
+
+    return removed_segmentation_ids
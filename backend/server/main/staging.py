@@ -0,0 +1,87 @@
+# server/main/staging.py
+"""Staging of the input files of the preprocessing and model containers.
+
+The inputs are already in the image repository, which is a directory on the host. Instead of packing them into a tar
+archive and copying them through the Docker API, they are bind-mounted read-only into the container ("bind"), or
+hard-linked into a per-job directory that is mounted ("link"). Streaming a tar archive ("tar") is only used as a
+fallback, e.g. if DATA_PATH is not set.
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import uuid
+
+from docker.types import Mount
+
+from server.main import helper
+
+mode = os.getenv("INPUT_STAGING_MODE", "bind").lower()
+
+worker_repository_path = "/usr/src/image-repository"
+staging_path = os.path.join(worker_repository_path, ".staging")
+
+
+def get_mode() -> str:
+    # Mounts need the host path of the image repository, because the containers are siblings of the worker
+    if not os.getenv('DATA_PATH'):
+        return "tar"
+    return mode
+
+
+def get_host_path(path) -> str:
+    """Translate a path in the image repository of the worker to the same path on the host."""
+    return os.path.join(os.getenv('DATA_PATH'), os.path.relpath(path, worker_repository_path)).replace("\\", "/")
+
+
+def stage_inputs(input_files, container_input_path) -> tuple[list[Mount], str | None]:
+    """Prepare the input files for a container. input_files maps names in container_input_path to files or
+    directories in the image repository. Returns the mounts to pass to containers.create() and, in link mode, the
+    staging directory that has to be removed with cleanup() after the container has finished. In tar mode no mounts
+    are returned and the caller has to use put_archive() on the created container."""
+    match get_mode():
+        case "bind":
+            mounts = [
+                Mount(target=f"{container_input_path}/{name}", source=get_host_path(path), type="bind", read_only=True)
+                for name, path in input_files.items()
+            ]
+            return mounts, None
+
+        case "link":
+            job_staging_path = os.path.join(staging_path, str(uuid.uuid4()))
+            for name, path in input_files.items():
+                target_path = os.path.join(job_staging_path, name)
+                if os.path.isdir(path):
+                    helper.link_tree(path, target_path)
+                else:
+                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                    try:
+                        os.link(path, target_path)
+                    except OSError:
+                        shutil.copy2(path, target_path)
+            mount = Mount(target=container_input_path, source=get_host_path(job_staging_path), type="bind", read_only=True)
+            return [mount], job_staging_path
+
+        case _:
+            return [], None
+
+
+def put_archive(container, input_files, container_input_path):
+    """Fallback: copy the input files into the container as a tar archive. The archive is spooled to a temporary
+    file instead of memory, so large DICOM studies don't cause memory spikes in the worker."""
+    with tempfile.TemporaryFile() as tarstream:
+        with tarfile.TarFile(fileobj=tarstream, mode='w') as tar:
+            for name, path in input_files.items():
+                tar.add(path, arcname=name)
+        tarstream.seek(0)
+
+        success = container.put_archive(container_input_path, tarstream)
+
+    if not success:
+        raise Exception(f'Failed to copy input files to container {container.name}')
+
+
+def cleanup(job_staging_path):
+    if job_staging_path is not None:
+        shutil.rmtree(job_staging_path, ignore_errors=True)
@@ -0,0 +1,56 @@
+# server/main/status_events.py
+"""Push of segmentation status changes to the frontend.
+
+The status writes in tasks.py publish the new status on a Redis channel of the user. The API subscribes to this
+channel for every connected client and forwards the messages as server-sent events, so the frontend doesn't have to
+poll /segmentations/status. Every event has the same format as the answer of /segmentations/status, a mapping of
+segmentation IDs to statuses.
+"""
+
+import json
+
+import redis
+
+from server.main.scheduler import REDIS_URL
+
+# A comment is sent after this many seconds without an event, so that proxies keep the connection open and closed
+# connections are noticed
+heartbeat_interval = 15
+
+
+def get_channel(user_id) -> str:
+    return f"brainns:status:{user_id}"
+
+
+def publish_status(user_id, segmentation_id, status):
+    """Publish a status change. Errors are only logged, because the status is stored in the DB anyway."""
+    try:
+        redis.from_url(REDIS_URL).publish(get_channel(user_id), json.dumps({str(segmentation_id): status}))
+    except redis.RedisError as e:
+        print(f"Failed to publish status {status} of segmentation {segmentation_id}: {e}")
+
+
+def subscribe(user_id):
+    """Subscribe to the status changes of the user. Subscribe before reading the current statuses from the DB, so
+    that no change between the two is lost."""
+    pubsub = redis.from_url(REDIS_URL).pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(get_channel(user_id))
+    return pubsub
+
+
+def format_event(data) -> str:
+    return f"event: status\ndata: {data}\n\n"
+
+
+def stream_statuses(pubsub, initial_statuses):
+    """Generator of the server-sent events for a subscription: first all current statuses, then every change."""
+    try:
+        yield format_event(json.dumps(initial_statuses))
+        while True:
+            message = pubsub.get_message(timeout=heartbeat_interval)
+            if message is None:
+                yield ": keepalive\n\n"
+            else:
+                yield format_event(message["data"].decode("utf-8"))
+    finally:
+        pubsub.close()
@@ -4,18 +4,17 @@ import docker
 import os
 import shutil
 import docker.errors
-import GPUtil
-import tarfile
 import server.main.nifti2dicom as nifti2dicom
-from io import BytesIO
 from server.database import db
 from flask import Flask
 from server.models import Project, Segmentation, Sequence, DisplayValues
-from server.images.helper import zip_preprocessed_files
+from server.images.helper import get_preprocessed_archive_entries
 from server.main.helper import model_config
+from server.main import model_pool, scheduler, preprocessing_cache, result_cache, staging, status_events, metrics, image_registry
+from contextlib import ExitStack, nullcontext
 import os
-import pydicom
-import numpy as np
+import json
+import zipfile
 
 import time
 
@@ -31,35 +30,47 @@ app.config["SQLALCHEMY_DATABASE_URI"] =  f"mysql+pymysql://{os.getenv('MYSQL_USE
 db.init_app(app)
 
 client = None
-possible_container_prefixes_for_segmentation = ["nnUnet_container_", "deepmedic_container_", "preprocessing_container_"]
+# Label of the preprocessing and prediction containers, to find the containers of a segmentation
+segmentation_label = "brainns.segmentation-id"
+# Intensity statistics of the converted sequences, written next to the dicom folder of the preprocessed data
+statistics_file_name = "statistics.json"
+
+docker_socket = 'unix://var/run/docker.sock'
 
 try:
-    client = docker.DockerClient(base_url='unix://var/run/docker.sock')
+    client = docker.DockerClient(base_url=docker_socket)
     client.ping()
 except docker.errors.DockerException as error:
     print(f"Failed to connect to Docker Socket: {error}")
 
+def reconnect_docker_client():
+    """RQ forks a work horse per job. It would share the connections of client with the worker process, so responses
+    could interleave on one socket. The child gets its own client with the API version the parent already negotiated,
+    so this makes no API call."""
+    global client
+    if isinstance(client, docker.DockerClient):
+        client = docker.DockerClient(base_url=docker_socket, version=client.api.api_version)
+
+os.register_at_fork(after_in_child=reconnect_docker_client)
+
 # General preprocessing steps provided by Jan (for all models the same) 
 def preprocessing_task(user_id, project_id, segmentation_id, sequence_ids_and_names, user_name, workplace, project_name, skip):
-    # Update the status of the segmentation
+    metrics.record_queue_wait()
+
+    # Update the status of the segmentations, the job is shared by all segmentations of the same sequences (see scheduler.py)
     with app.app_context():
         try:
-            segmentation = db.session.query(Segmentation).filter_by(segmentation_id=segmentation_id).first()
-            if segmentation:
-                segmentation.status = "PREPROCESSING"
-                db.session.commit()
+            for waiting_segmentation_id in scheduler.get_current_segmentation_ids(segmentation_id):
+                segmentation = db.session.query(Segmentation).filter_by(segmentation_id=waiting_segmentation_id).first()
+                if segmentation:
+                    segmentation.status = "PREPROCESSING"
+                    db.session.commit()
+                    status_events.publish_status(user_id, waiting_segmentation_id, "PREPROCESSING")
         except Exception as e:
             print("ERROR: ", e)
 
     raw_data_path = f'/usr/src/image-repository/{user_id}-{user_name}-{workplace}/{project_id}-{project_name}/raw'
-    processed_data_path = (
-        f'/usr/src/image-repository/{user_id}-{user_name}-{workplace}/'
-        f'{project_id}-{project_name}/preprocessed/'
-        f'{sequence_ids_and_names.get("flair", ("0",))[0]}_'
-        f'{sequence_ids_and_names.get("t1", ("0",))[0]}_'
-        f'{sequence_ids_and_names.get("t1km", ("0",))[0]}_'
-        f'{sequence_ids_and_names.get("t2", ("0",))[0]}'
-    )
+    processed_data_path = get_processed_data_path(user_id, user_name, workplace, project_id, project_name, sequence_ids_and_names)
 
     if os.path.exists(processed_data_path) and os.path.isdir(processed_data_path):
         shutil.rmtree(processed_data_path)
@@ -68,96 +79,117 @@ def preprocessing_task(user_id, project_id, segmentation_id, sequence_ids_and_na
 
     # Skip preprocessing means moving the file just into the processed file
     if skip:
-        for seq in sequence_ids_and_names:
-            seq_id = sequence_ids_and_names[seq][0]
-            seq_name = sequence_ids_and_names[seq][1]
-            rawPath = os.path.join(raw_data_path, f'{seq_id}-{seq_name}/{seq_id}.nii.gz')
-            shutil.copy(rawPath, processed_data_path)
-            shutil.move(os.path.join(processed_data_path, f'{seq_id}.nii.gz'),
-                    os.path.join(processed_data_path, f'{seq}.nii.gz'))
+        with metrics.stage("copy_inputs"):
+            for seq in sequence_ids_and_names:
+                seq_id = sequence_ids_and_names[seq][0]
+                seq_name = sequence_ids_and_names[seq][1]
+                rawPath = os.path.join(raw_data_path, f'{seq_id}-{seq_name}/{seq_id}.nii.gz')
+                shutil.copy(rawPath, processed_data_path)
+                shutil.move(os.path.join(processed_data_path, f'{seq_id}.nii.gz'),
+                        os.path.join(processed_data_path, f'{seq}.nii.gz'))
 
     else:
-        # Build the Docker image if it doesnt exist
-        image_exists = any("preprocessing:brainns" in image.tags for image in client.images.list())
-        if not image_exists:
-            print(f"Image preprocessing doesn't exist. Creating image...")
-            image, build_logs = client.images.build(path='/usr/src/preprocessing', tag="preprocessing:brainns")
-            print("Done creating image!")
-
-        data_path = os.getenv('DATA_PATH') # Das muss einen host-ordner (nicht im container) referenzieren, da es an sub-container weitergegeben wird
-        output_bind_mount_path = f'{data_path}/{user_id}-{user_name}-{workplace}/{project_id}-{project_name}/preprocessed/{sequence_ids_and_names["flair"][0]}_{sequence_ids_and_names["t1"][0]}_{sequence_ids_and_names["t1km"][0]}_{sequence_ids_and_names["t2"][0]}'
-
         with app.app_context():
             project_entry = db.session.query(Project).filter_by(project_id=project_id).first()
             file_format = project_entry.file_format
 
-        # Create the container
-        container = client.containers.create(
-            image = "preprocessing:brainns",
-            name = f'preprocessing_container_{segmentation_id}',
-            command = f"python main.py -p nifti -f {file_format}", # This command will be executed inside the spawned preprocessing-container
-            # command=["tail", "-f", "/dev/null"], # debug command keeps container alive
-            volumes = {
-                output_bind_mount_path: {
-                    'bind': '/app/output/nifti',
-                    'mode': 'rw',
-                },
-            },
-            user=container_user,
-            detach = True,
-            auto_remove = True
-        )
+        # This command will be executed inside the spawned preprocessing-container. The registration backend is part of
+        # it, so it is also part of the key of the preprocessing cache.
+        preprocessing_command = f"python main.py -p nifti -f {file_format} -r {image_registry.registration_backend}"
+
+        # Reuse the result if the same raw data has already been preprocessed, e.g. in another project or for another model
+        with metrics.stage("preprocessing_cache"):
+            cache_key = preprocessing_cache.get_cache_key(raw_data_path, sequence_ids_and_names, file_format, preprocessing_command)
+            cache_hit = preprocessing_cache.restore(cache_key, processed_data_path)
+        if cache_hit:
+            print(f"Preprocessing cache hit for {cache_key}. Skipping preprocessing.")
+            with metrics.stage("min_max_values"):
+                statistics = load_statistics(processed_data_path)
+                for waiting_segmentation_id in scheduler.get_current_segmentation_ids(segmentation_id):
+                    save_min_max_values(waiting_segmentation_id, statistics)
+            if not os.path.isfile(os.path.join(processed_data_path, "dicom", "sequences.zip")):
+                enqueue_sequences_archive(processed_data_path)
+            return True
 
-        # Copy raw data in input dir of model container
-        tarstream = BytesIO()
-        tar = tarfile.TarFile(fileobj=tarstream, mode='w')
+        # Build the Docker image if it doesnt exist
+        with metrics.stage("image_check"):
+            image_registry.ensure_image(client, image_registry.PREPROCESSING_IMAGE)
+
+        data_path = os.getenv('DATA_PATH') # Das muss einen host-ordner (nicht im container) referenzieren, da es an sub-container weitergegeben wird
+        output_bind_mount_path = f'{data_path}/{user_id}-{user_name}-{workplace}/{project_id}-{project_name}/preprocessed/{sequence_ids_and_names["flair"][0]}_{sequence_ids_and_names["t1"][0]}_{sequence_ids_and_names["t1km"][0]}_{sequence_ids_and_names["t2"][0]}'
 
+        # Raw data for the input dir of the preprocessing container
+        input_files = {}
         match file_format:
             case "dicom":
+                container_input_path = '/app/input/dicom'
                 for seq in ["flair", "t1", "t1km", "t2"]:
                     seq_id = sequence_ids_and_names[seq][0]
 
-                    path = os.path.join(raw_data_path, f'{seq_id}-{sequence_ids_and_names[seq][1]}/')
+                    path = os.path.join(raw_data_path, f'{seq_id}-{sequence_ids_and_names[seq][1]}')
                     if seq == "t1km":
-                        tar.add(path, arcname="t1c/")
+                        input_files["t1c"] = path
                     else:
-                        tar.add(path, arcname=f'{seq}/')
-
-                tar.close()
-                tarstream.seek(0)
-
-                success = container.put_archive('/app/input/dicom', tarstream)
+                        input_files[seq] = path
 
             # TODO: update folderstructure
             case "nifti":
+                container_input_path = '/app/input/nifti'
                 for seq in ["t1", "t2"]:
                     seq_id = sequence_ids_and_names[seq][0]
                     seq_name = sequence_ids_and_names[seq][1]
                     path = os.path.join(raw_data_path, f'{seq_id}-{seq_name}/{seq_id}.nii.gz')
                     if seq == "t1km":
-                        tar.add(path, arcname="nifti_t1c.nii.gz")
+                        input_files["nifti_t1c.nii.gz"] = path
                     else:
-                        tar.add(path, arcname=f'nifti_{seq}.nii.gz')
-
-                tar.close()
-                tarstream.seek(0)
-
-                success = container.put_archive('/app/input/nifti', tarstream)
+                        input_files[f'nifti_{seq}.nii.gz'] = path
 
-        if not success:
-            raise Exception('Failed to copy input files to preprocessing container')
+        # Mount the raw data read-only instead of copying it into the container (see staging.py)
+        with metrics.stage("input_staging"):
+            input_mounts, job_staging_path = staging.stage_inputs(input_files, container_input_path)
 
-        # Start the preprocessing container
-        container.start()
-
-        # Open a file to store logs
-        with open(os.path.join(processed_data_path, "container_logs.log"), "w") as logfile:
-            for line in container.logs(stream=True):  # Stream logs from the container
-                logfile.write(line.decode("utf-8"))
-                logfile.flush()  # Ensure logs are written immediately
-
-        # Wait for the container to finish
-        container.wait()
+        # The staged links are removed even if the container fails
+        try:
+            # Create the container
+            container = client.containers.create(
+                image = image_registry.PREPROCESSING_IMAGE,
+                name = f'preprocessing_container_{segmentation_id}',
+                command = preprocessing_command,
+                labels = {segmentation_label: str(segmentation_id)},
+                # command=["tail", "-f", "/dev/null"], # debug command keeps container alive
+                volumes = {
+                    output_bind_mount_path: {
+                        'bind': '/app/output/nifti',
+                        'mode': 'rw',
+                    },
+                },
+                mounts = input_mounts,
+                user=container_user,
+                detach = True,
+                auto_remove = True
+            )
+
+            if not input_mounts:
+                with metrics.stage("input_staging"):
+                    staging.put_archive(container, input_files, container_input_path)
+
+            with metrics.stage("container_run"):
+                # Start the preprocessing container
+                container.start()
+
+                # Open a file to store logs
+                with open(os.path.join(processed_data_path, "container_logs.log"), "w") as logfile:
+                    for line in container.logs(stream=True):  # Stream logs from the container
+                        logfile.write(line.decode("utf-8"))
+                        logfile.flush()  # Ensure logs are written immediately
+
+                # Wait for the container to finish
+                container.wait()
+        finally:
+            staging.cleanup(job_staging_path)
+
+        # Spans of the steps inside the container (skullstrip, resample, register), written by its main.py
+        metrics.record_container_timings(os.path.join(processed_data_path, "timings.json"))
 
         os.mkdir(os.path.join(processed_data_path, "dicom"))
 
@@ -167,99 +199,78 @@ def preprocessing_task(user_id, project_id, segmentation_id, sequence_ids_and_na
         # nifti2dicom.convert_base_image_to_3d_dicom(os.path.join(processed_data_path, "nifti_t2_register.nii.gz"), os.path.join(processed_data_path, "dicom/t2"), os.path.join(raw_data_path, f"{sequence_ids_and_names["t2"][0]}-{sequence_ids_and_names["t2"][1]}"))
         # nifti2dicom.convert_base_image_to_3d_dicom(os.path.join(processed_data_path, "nifti_t1c_register.nii.gz"), os.path.join(processed_data_path, "dicom/t1km"), os.path.join(raw_data_path, f"{sequence_ids_and_names["t1km"][0]}-{sequence_ids_and_names["t1km"][1]}"))
 
-        # Convert each base image to a dicom sequence, keep the headers of the original sequences if the original sequences were dicom files
-        match file_format:
-            case "dicom":
-                nifti2dicom.convert_base_image_to_dicom_sequence(os.path.join(processed_data_path, "nifti_flair_register.nii.gz"), os.path.join(processed_data_path, "dicom/flair"), os.path.join(raw_data_path, f"{sequence_ids_and_names["flair"][0]}-{sequence_ids_and_names["flair"][1]}"))
-                nifti2dicom.convert_base_image_to_dicom_sequence(os.path.join(processed_data_path, "nifti_t1_register.nii.gz"), os.path.join(processed_data_path, "dicom/t1"), os.path.join(raw_data_path, f"{sequence_ids_and_names["t1"][0]}-{sequence_ids_and_names["t1"][1]}"))
-                nifti2dicom.convert_base_image_to_dicom_sequence(os.path.join(processed_data_path, "nifti_t2_register.nii.gz"), os.path.join(processed_data_path, "dicom/t2"), os.path.join(raw_data_path, f"{sequence_ids_and_names["t2"][0]}-{sequence_ids_and_names["t2"][1]}"))
-                nifti2dicom.convert_base_image_to_dicom_sequence(os.path.join(processed_data_path, "nifti_t1c_register.nii.gz"), os.path.join(processed_data_path, "dicom/t1km"), os.path.join(raw_data_path, f"{sequence_ids_and_names["t1km"][0]}-{sequence_ids_and_names["t1km"][1]}"))
-            case "nifti":
-                nifti2dicom.convert_base_image_to_dicom_sequence(os.path.join(processed_data_path, "nifti_flair_register.nii.gz"), os.path.join(processed_data_path, "dicom/flair"))
-                nifti2dicom.convert_base_image_to_dicom_sequence(os.path.join(processed_data_path, "nifti_t1_register.nii.gz"), os.path.join(processed_data_path, "dicom/t1"))
-                nifti2dicom.convert_base_image_to_dicom_sequence(os.path.join(processed_data_path, "nifti_t2_register.nii.gz"), os.path.join(processed_data_path, "dicom/t2"))
-                nifti2dicom.convert_base_image_to_dicom_sequence(os.path.join(processed_data_path, "nifti_t1c_register.nii.gz"), os.path.join(processed_data_path, "dicom/t1km"))
-
+        # Convert each base image to a dicom sequence, keep the headers of the original sequences if the original sequences were dicom files.
+        # The four sequences are converted concurrently.
+        sequences = [("flair", "flair"), ("t1", "t1"), ("t2", "t2"), ("t1km", "t1c")]
+        conversions = []
+        for seq, nifti_seq in sequences:
+            conversion = (os.path.join(processed_data_path, f"nifti_{nifti_seq}_register.nii.gz"), os.path.join(processed_data_path, f"dicom/{seq}"))
+            if file_format == "dicom":
+                conversion += (os.path.join(raw_data_path, f"{sequence_ids_and_names[seq][0]}-{sequence_ids_and_names[seq][1]}"),)
+            conversions.append(conversion)
+        # The converter returns the intensity statistics of each sequence, so the DICOM files are not read again
+        with metrics.stage("nifti_to_dicom"):
+            statistics = dict(zip([seq for seq, _ in sequences], nifti2dicom.convert_base_images_to_dicom_sequences(conversions)))
 
         # Save min and max pixel values of the preprocessed sequence in DB and min and max values based on dicom tags.
         # This can be used to set the window leveling in the viewer
-        save_min_max_values(processed_data_path, segmentation_id, file_format)
+        with metrics.stage("min_max_values"):
+            save_statistics(processed_data_path, statistics)
+            for waiting_segmentation_id in scheduler.get_current_segmentation_ids(segmentation_id):
+                save_min_max_values(waiting_segmentation_id, statistics)
 
-        dicom_path = os.path.join(processed_data_path, "dicom")
-        zip = zip_preprocessed_files(dicom_path)
-        file_path = os.path.join(dicom_path, 'sequences.zip')
+        enqueue_sequences_archive(processed_data_path)
 
-        with open(file_path, 'wb') as f:
-            f.write(zip.getvalue())
+        with metrics.stage("preprocessing_cache_store"):
+            preprocessing_cache.store(cache_key, processed_data_path)
 
     return True
 
 
-def save_min_max_values(processed_data_path, segmentation_id, file_format, sequence_name):
-    sequence_path = f"{processed_data_path}/dicom/{sequence_name}"
+def enqueue_sequences_archive(processed_data_path):
+    """Build the zip of the DICOM series for the viewer (dicom/sequences.zip) in the background, so the compression
+    doesn't delay the segmentation. Until it exists, the API streams an uncompressed zip."""
+    dicom_path = os.path.join(processed_data_path, "dicom")
+    entries = get_preprocessed_archive_entries(dicom_path)
+    scheduler.enqueue_archive("server.images.helper.build_archive", entries, os.path.join(dicom_path, 'sequences.zip'), zipfile.ZIP_DEFLATED)
 
-    min_preprocessed_value, max_preprocessed_value = get_min_max_pixel_values(sequence_path)
 
-    if file_format == "dicom":
-        min_value_by_dicom_tag, max_value_by_dicom_tag = get_window_level_bounds_by_dicom_tags(sequence_path)
+def save_statistics(processed_data_path, statistics):
+    """Store the full intensity statistics (percentiles, histogram) next to the DICOM series. They are part of the
+    preprocessing cache entry, so a cache hit can restore the display values without reading any DICOM file."""
+    with open(os.path.join(processed_data_path, statistics_file_name), "w") as f:
+        json.dump(statistics, f)
 
-    with app.app_context():
 
-        segmentation = db.session.query(Segmentation).filter_by(segmentation_id=segmentation_id).first()
-        display_values_id = segmentation.display_values
-        display_values = db.session.query(DisplayValues).filter_by(display_values_id=display_values_id).first()
+def load_statistics(processed_data_path):
+    with open(os.path.join(processed_data_path, statistics_file_name)) as f:
+        return json.load(f)
 
-        display_values.min_display_value_custom = min_preprocessed_value
-        display_values.max_display_value_custom = max_preprocessed_value
 
-        if file_format == "dicom":
-            display_values.min_display_value_by_dicom_tag = min_value_by_dicom_tag
-            display_values.max_display_value_by_dicom_tag = max_value_by_dicom_tag
+def save_min_max_values(segmentation_id, statistics):
+    """Persist the min/max pixel values and the window bounds by DICOM tags of all sequences in one transaction.
+    statistics maps the sequence names to the statistics returned by nifti2dicom.convert_base_image_to_dicom_sequence."""
+    with app.app_context():
+        try:
+            segmentation = db.session.query(Segmentation).filter_by(segmentation_id=segmentation_id).first()
+            # Deleted while it was waiting for a shared preprocessing
+            if segmentation is None:
+                return
+            display_values = db.session.query(DisplayValues).filter_by(display_values_id=segmentation.display_values).first()
 
-        db.session.commit()
+            for sequence_name, sequence_statistics in statistics.items():
+                setattr(display_values, f"{sequence_name}_min_display_value_custom", sequence_statistics["min"])
+                setattr(display_values, f"{sequence_name}_max_display_value_custom", sequence_statistics["max"])
 
-def get_min_max_pixel_values(dicom_folder):
-    min_pixel_value = float('inf')
-    max_pixel_value = float('-inf')
-    
-    for filename in os.listdir(dicom_folder):
-        filepath = os.path.join(dicom_folder, filename)
-        if os.path.isfile(filepath) and filename.lower().endswith('.dcm'):
-            dicom_data = pydicom.dcmread(filepath)
-            pixel_array = dicom_data.pixel_array
-
-            min_pixel_value = min(min_pixel_value, np.min(pixel_array))
-            max_pixel_value = max(max_pixel_value, np.max(pixel_array))
-    
-    return min_pixel_value, max_pixel_value
-
-
-def get_window_level_bounds_by_dicom_tags(dicom_folder):
-    for filename in os.listdir(dicom_folder):
-        filepath = os.path.join(dicom_folder, filename)
-        if os.path.isfile(filepath) and filename.lower().endswith('.dcm'):
-            dicom_data = pydicom.dcmread(filepath)
-            
-            if 'WindowCenter' in dicom_data and 'WindowWidth' in dicom_data:
-                # Handle potential sequences
-                window_center = dicom_data.WindowCenter
-                window_width = dicom_data.WindowWidth
-
-                # These might be stored as lists
-                if isinstance(window_center, pydicom.multival.MultiValue):
-                    window_center = window_center[0]
-                if isinstance(window_width, pydicom.multival.MultiValue):
-                    window_width = window_width[0]
-
-                # Calculate window level bounds
-                window_min = window_center - (window_width / 2)
-                window_max = window_center + (window_width / 2)
-                
-                return window_min, window_max
-            else:
-                raise ValueError(f"DICOM file {filename} is missing Window Center or Window Width tag.")
-    
-    raise FileNotFoundError("No valid DICOM files found in the folder.")
+                # Only set if the source series had Window Center and Window Width tags
+                if sequence_statistics["min_by_dicom_tag"] is not None:
+                    setattr(display_values, f"{sequence_name}_min_display_value_by_dicom_tag", round(sequence_statistics["min_by_dicom_tag"]))
+                    setattr(display_values, f"{sequence_name}_max_display_value_by_dicom_tag", round(sequence_statistics["max_by_dicom_tag"]))
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
 
 def remove_containers_for_segmentation(segmentation_id: int, kill_immediately=False) -> bool:
@@ -267,13 +278,8 @@ def remove_containers_for_segmentation(segmentation_id: int, kill_immediately=Fa
     be able to assume one container per segmentation ID, but handle the case where several have the gien segmentation ID anyway.
     kill_immediately calls stop on the container with the argument timeout=0, leaving no time for cleanup. If a container
     has been removed, return True, else, return False."""
-    containers = client.containers.list()
-    # First, we match the suffix, i.e., the segmentation_id with the list of Docker containers.
-    containers_with_correct_suffix = list(filter(lambda container: container.name.endswith(str(segmentation_id)), containers))
-    # It's possible to have other kinds of containers ending in numbers, so we also have to ensure that the prefix matches, i.e., we have either
-    # a preprocessing or prediction container.
-    containers_to_remove = list(filter(lambda container: any(container.name.startswith(prefix) for prefix in possible_container_prefixes_for_segmentation), 
-                                       containers_with_correct_suffix))
+    # The preprocessing and prediction containers are labeled with their segmentation, Docker filters them
+    containers_to_remove = client.containers.list(filters={"label": f"{segmentation_label}={segmentation_id}"})
     # We're only supposed to have one container per segmentation id, but it can't hurt to assume to have a list.
     # for container in containers_to_remove:
     for container in containers_to_remove:
@@ -298,8 +304,104 @@ def get_device_requests(config, deviceIDs):
     else:
         return []
 
+def predict_with_model_server(config, model, deviceIDs, input_files, result_path) -> int | None:
+    """Run the prediction on a warm model server (see model_pool.py) on the reserved device. Returns the exit code of
+    the model or None if no model server could take the job."""
+    device = f"gpu{deviceIDs[0]}" if deviceIDs else "cpu"
+    if deviceIDs:
+        # Idle servers of other models on the reserved GPU would only hold its memory
+        model_pool.stop_idle_servers(client, device, keep_model=model)
+
+    server_name = model_pool.get_server_name(model, device)
+    server_info = model_pool.get_server_info(server_name)
+    if server_info is not None and not model_pool.serves_config(server_info, config):
+        # Started with another command line, e.g. by an older version of the worker
+        if server_info.get("status") != "ready":
+            return None
+        print("Replacing model server with another command line: ", server_name)
+        model_pool.stop_server(client, server_name)
+        server_info = None
+    if server_info is None:
+        print("Starting model server on: ", device)
+        with metrics.stage("model_server_start"):
+            server_name = model_pool.start_server(client, config, model, device, get_device_requests(config, deviceIDs), container_user)
+        if server_name is None:
+            return None
+
+    print("Using model server: ", server_name)
+    with metrics.stage("container_run"):
+        return model_pool.run_prediction(client, server_name, config, input_files, result_path)
+
+
+def predict_with_oneshot_container(config, segmentation_id, deviceIDs, input_files, result_path, output_bind_mount_path):
+    """Run the prediction in a new container, which is removed after the prediction."""
+    # Mount the preprocessed data read-only instead of copying it into the container (see staging.py)
+    with metrics.stage("input_staging"):
+        input_mounts, job_staging_path = staging.stage_inputs(input_files, '/app/input')
+
+    # The staged links are removed even if the container fails
+    try:
+        #  Create the container
+        container = client.containers.create(
+            image = config["image"],
+            name = config["container_name"],
+            command = config["command"], # This command will be executed inside the spawned container
+            labels = {segmentation_label: str(segmentation_id)},
+            # command=["tail", "-f", "/dev/null"], # debug command keeps container alive
+            volumes = {
+                output_bind_mount_path: { 
+                    'bind': config["output_path"],
+                    'mode': 'rw',
+                },
+            },
+            mounts = input_mounts,
+            device_requests = get_device_requests(config, deviceIDs),
+            user=container_user,
+            detach = True,
+            auto_remove = True
+        )
+
+        if not input_mounts:
+            with metrics.stage("input_staging"):
+                staging.put_archive(container, input_files, '/app/input')
+
+        with metrics.stage("container_run"):
+            # Start the model container
+            container.start()
+
+            # Open a file to store logs
+            with open(os.path.join(result_path, "container_logs.log"), "w") as logfile:
+                for line in container.logs(stream=True):  # Stream logs from the container
+                    logfile.write(line.decode("utf-8"))
+                    logfile.flush()  # Ensure logs are written immediately
+
+            container.wait()
+    finally:
+        staging.cleanup(job_staging_path)
+
+def get_processed_data_path(user_id, user_name, workplace, project_id, project_name, sequence_ids_and_names) -> str:
+    return (
+        f'/usr/src/image-repository/{user_id}-{user_name}-{workplace}/'
+        f'{project_id}-{project_name}/preprocessed/'
+        f'{sequence_ids_and_names.get("flair", ("0",))[0]}_'
+        f'{sequence_ids_and_names.get("t1", ("0",))[0]}_'
+        f'{sequence_ids_and_names.get("t1km", ("0",))[0]}_'
+        f'{sequence_ids_and_names.get("t2", ("0",))[0]}'
+    )
+
+
+def get_input_files(processed_data_path, sequence_ids_and_names) -> dict:
+    # t1, t1km, t2, flair as the model expects them in its input dir
+    return {
+        f'_000{index}.nii.gz': os.path.join(processed_data_path, f'{seq_name}.nii.gz')
+        for index, seq_name in enumerate(sequence_ids_and_names)
+    }
+
+
 # Sperate prediction Task for every model
 def prediction_task(user_id, project_id, segmentation_id, sequence_ids_and_names, model, user_name, workplace, project_name):
+    metrics.record_queue_wait()
+
     # Get model-specific configuration. May raise an exception if the given model doesn't exist.
     config = model_config(model, segmentation_id)
     segmentation_name = ""
@@ -313,77 +415,46 @@ def prediction_task(user_id, project_id, segmentation_id, sequence_ids_and_names
                 segmentation.status = "PREDICTING"
                 segmentation_name = segmentation.segmentation_name
                 db.session.commit()                    
+                status_events.publish_status(user_id, segmentation_id, "PREDICTING")
         except Exception as e:
             print("ERROR: ", e)
     
     # Build the Docker image if it doesnt exist
-    image_exists = any(model in image.tags for image in client.images.list())
-    if not image_exists:
-        print(f"Image ${model} doesn't exist. Creating image...")
-        image, build_logs = client.images.build(path=config["docker_file_path"], tag=model, rm=True)
-        print("Done creating image!")
-
-    # This wonderful function waits until a GPU is free
-    deviceIDs = GPUtil.getFirstAvailable(order = 'memory', maxLoad=0.5, maxMemory=0.5, attempts=100, interval=5, verbose=False)
-    print("Chosen GPU: ", deviceIDs)
+    with metrics.stage("image_check"):
+        image_registry.ensure_image(client, model)
 
     data_path = os.getenv('DATA_PATH') # Das muss einen host-ordner (nicht im container) referenzieren, da es an sub-container weitergegeben wird
-    processed_data_path = (
-        f'/usr/src/image-repository/{user_id}-{user_name}-{workplace}/'
-        f'{project_id}-{project_name}/preprocessed/'
-        f'{sequence_ids_and_names.get("flair", ("0",))[0]}_'
-        f'{sequence_ids_and_names.get("t1", ("0",))[0]}_'
-        f'{sequence_ids_and_names.get("t1km", ("0",))[0]}_'
-        f'{sequence_ids_and_names.get("t2", ("0",))[0]}'
-    )
+    processed_data_path = get_processed_data_path(user_id, user_name, workplace, project_id, project_name, sequence_ids_and_names)
     result_path = f'/usr/src/image-repository/{user_id}-{user_name}-{workplace}/{project_id}-{project_name}/segmentations/{segmentation_id}-{segmentation_name}'
     output_bind_mount_path = f'{data_path}/{user_id}-{user_name}-{workplace}/{project_id}-{project_name}/segmentations/{segmentation_id}-{segmentation_name}'
     print(f"PATHS:\nprocessed_data_path: {processed_data_path}\nresult_path: {result_path}\noutput_bind_mount_path: {output_bind_mount_path}")
-    #  Create the container
-    container = client.containers.create(
-        image = config["image"],
-        name = config["container_name"],
-        command = config["command"], # This command will be executed inside the spawned container
-        # command=["tail", "-f", "/dev/null"], # debug command keeps container alive
-        volumes = {
-            output_bind_mount_path: { 
-                'bind': config["output_path"],
-                'mode': 'rw',
-            },
-        },
-        device_requests = get_device_requests(config, deviceIDs),
-        user=container_user,
-        detach = True,
-        auto_remove = True
-    )
 
-    # Copy t1, t1km, t2, flair in input dir of model container
-    tarstream = BytesIO()
-    tar = tarfile.TarFile(fileobj=tarstream, mode='w')
+    input_files = get_input_files(processed_data_path, sequence_ids_and_names)
 
-    for index, seq_name in enumerate(sequence_ids_and_names):
-        path = os.path.join(processed_data_path, f'{seq_name}.nii.gz')
-        tar.add(path, arcname=f'_000{index}.nii.gz')
-    
-    tar.close()
-    tarstream.seek(0)
-
-    success = container.put_archive('/app/input', tarstream)
-
-    if not success:
-        raise Exception('Failed to copy input files to model container')
+    # Reuse the result of a segmentation with the same model and input instead of running the model (see result_cache.py)
+    with app.app_context(), metrics.stage("result_cache"):
+        cache_key = result_cache.get_cache_key(config, result_cache.get_image_digest(client, model), input_files)
+        cache_hit = result_cache.restore(cache_key, result_path)
+        db.session.commit()
 
-    # Start the model container
-    container.start()
+    if not cache_hit:
+        # GPU models run on the gpu queue, which has one worker per GPU, so a free GPU can normally be reserved at once
+        with ExitStack() as gpu_reservation:
+            with metrics.stage("gpu_wait"):
+                gpu_id = gpu_reservation.enter_context(scheduler.reserved_gpu(segmentation_id) if config["uses_gpu"] else nullcontext())
+            deviceIDs = [gpu_id] if gpu_id is not None else []
+            print("Chosen GPU: ", deviceIDs)
+
+            # Prefer a warm model server and fall back to a new container if none can take the job
+            exit_code = None
+            if model_pool.is_enabled(config):
+                exit_code = predict_with_model_server(config, model, deviceIDs, input_files, result_path)
+            if exit_code is None:
+                predict_with_oneshot_container(config, segmentation_id, deviceIDs, input_files, result_path, output_bind_mount_path)
+            elif exit_code != 0:
+                log_path = os.path.join(result_path, "container_logs.log")
+                raise Exception(f"The model {model} terminated with exit code {exit_code}. Please check the log file {log_path} for more information.")
 
-    # Open a file to store logs
-    with open(os.path.join(result_path, "container_logs.log"), "w") as logfile:
-        for line in container.logs(stream=True):  # Stream logs from the container
-            logfile.write(line.decode("utf-8"))
-            logfile.flush()  # Ensure logs are written immediately
-    
-    container.wait()
-    
     segmentation_path = f'/usr/src/image-repository/{user_id}-{user_name}-{workplace}/{project_id}-{project_name}/segmentations/{segmentation_id}-{segmentation_name}'
 
     # If there is no output file, we can assume there has been an error
@@ -398,7 +469,7 @@ def prediction_task(user_id, project_id, segmentation_id, sequence_ids_and_names
         break
     if segmentation_file is None:
         log_path = os.path.join(result_path, "container_logs.log")
-        raise Exception(f"The container {container.name} terminated with an error. Please check the log file {log_path} for more information.")
+        raise Exception(f"The model {model} terminated with an error. Please check the log file {log_path} for more information.")
 
     if config["resampledDataExists"]:
         print("Theresa: ResampledDataExists")
@@ -411,31 +482,38 @@ def prediction_task(user_id, project_id, segmentation_id, sequence_ids_and_names
 
         #test
         dicom_dir = os.path.join(segmentation_path, "dicom")
-        if os.path.exists(dicom_dir):
-            shutil.rmtree(dicom_dir)
-        os.mkdir(dicom_dir)
-
-
-        nifti2dicom.convert_segmentation_to_3d_dicom(segmentation_file, os.path.join(segmentation_path, "dicom/segmentation.dcm"))
+        # A cached result already has the converted segmentation
+        if not cache_hit:
+            if os.path.exists(dicom_dir):
+                shutil.rmtree(dicom_dir)
+            os.mkdir(dicom_dir)
+
+            with metrics.stage("nifti_to_dicom"):
+                nifti2dicom.convert_segmentation_to_3d_dicom(segmentation_file, os.path.join(segmentation_path, "dicom/segmentation.dcm"))
+
+        if cache_hit and os.path.isfile(os.path.join(processed_data_path, statistics_file_name)):
+            # The resampled sequence has been converted for the cached result already
+            statistics = load_statistics(processed_data_path)
+        else:
+            os.makedirs(os.path.join(processed_data_path, "dicom"), exist_ok=True)
 
-        os.mkdir(os.path.join(processed_data_path, "dicom"))
+            # Convert each base image to a dicom sequence, keep the headers of the original sequences if the original sequences were dicom files
+            with metrics.stage("nifti_to_dicom"):
+                statistics = {"t2": nifti2dicom.convert_base_image_to_dicom_sequence(
+                os.path.join(result_path, "resampled/_0000_resampled.nii.gz"),
+                os.path.join(processed_data_path, "dicom/t2"))}
 
-        # Convert each base image to a dicom sequence, keep the headers of the original sequences if the original sequences were dicom files
-        nifti2dicom.convert_base_image_to_dicom_sequence(
-        os.path.join(result_path, "resampled/_0000_resampled.nii.gz"),
-        os.path.join(processed_data_path, "dicom/t2"))
+            save_statistics(processed_data_path, statistics)
+            enqueue_sequences_archive(processed_data_path)
 
         # Save min and max pixel values of the preprocessed sequence in DB and min and max values based on dicom tags.
         # This can be used to set the window leveling in the viewer
-        for _, seq_name in enumerate(sequence_ids_and_names):
-            save_min_max_values(processed_data_path, segmentation_id, "nifti", seq_name)
-
-        dicom_path = os.path.join(processed_data_path, "dicom")
-        zip = zip_preprocessed_files(dicom_path)
-        file_path = os.path.join(dicom_path, 'sequences.zip')
+        with metrics.stage("min_max_values"):
+            save_min_max_values(segmentation_id, statistics)
 
-        with open(file_path, 'wb') as f:
-            f.write(zip.getvalue())
+    with app.app_context():
+        result_cache.store(cache_key, segmentation_id, result_path)
+        db.session.commit()
 
     return True
 
@@ -443,16 +521,28 @@ def prediction_task(user_id, project_id, segmentation_id, sequence_ids_and_names
 ############### Callbacks ##################
 ############################################
 
+def report_preprocessing_finished(job, connection, result, *args, **kwargs):
+    with app.app_context():
+        try:
+            job.refresh()
+            metrics.save_job_timings(job, scheduler.get_job_segmentation_ids(job))
+            db.session.commit()
+        except Exception as e:
+            print("ERROR: ", e)
+
+
 def report_segmentation_finished(job, connection, result, *args, **kwargs):
     with app.app_context():
         try:
             segmentation_id = job.meta.get('segmentation_id')
+            metrics.save_job_timings(job, [segmentation_id])
 
             # Update the status of the segmentation
             segmentation = db.session.query(Segmentation).filter_by(segmentation_id=segmentation_id).first()
             if segmentation:
                 segmentation.status = "DONE"
                 db.session.commit()                    
+                status_events.publish_status(segmentation.project.user_id, segmentation_id, "DONE")
         except Exception as e:
             print("ERROR: ", e)
 
@@ -461,12 +551,14 @@ def report_segmentation_error(job, connection, result, *args, **kwargs):
     with app.app_context():
         try:
             job.refresh()
-            segmentation_id = job.meta.get('segmentation_id')
-
-            # Update the status of the segmentation
-            segmentation = db.session.query(Segmentation).filter_by(segmentation_id=segmentation_id).first()
-            if segmentation:
-                segmentation.status = "ERROR"
-                db.session.commit()
+            metrics.save_job_timings(job, scheduler.get_job_segmentation_ids(job))
+
+            # Update the status of the segmentations, a failed shared preprocessing fails all of them
+            for segmentation_id in scheduler.get_job_segmentation_ids(job):
+                segmentation = db.session.query(Segmentation).filter_by(segmentation_id=segmentation_id).first()
+                if segmentation:
+                    segmentation.status = "ERROR"
+                    db.session.commit()
+                    status_events.publish_status(segmentation.project.user_id, segmentation_id, "ERROR")
         except Exception as e:
             print("ERROR: ", e)
\ No newline at end of file
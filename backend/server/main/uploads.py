@@ -0,0 +1,246 @@
+# server/main/uploads.py
+"""Resumable chunked upload of the study of a new project.
+
+Instead of one multipart request with the zipped study (POST /projects), the frontend creates an upload with the
+project information and one part per sequence: a zip of the folder of a DICOM sequence or the NIfTI file itself. The
+parts are uploaded in numbered chunks with a SHA-256 checksum, in any order and concurrently. Every chunk is streamed
+from the request to its offset in the part file in the image repository, so the API never holds more than a small
+buffer of an upload in memory. A dropped connection only loses the chunk in flight: the upload lists the received
+chunks, so the client can resume with the missing ones.
+
+As soon as all chunks of a part are received, the part is extracted into the staging folder of the upload in the
+background (see ingest.py). Completing the upload then only creates the project and moves the extracted files into
+its folders.
+
+Layout of an upload in upload_root/<upload_id>:
+    upload.json             user, project information and parts
+    parts/<part>            part file, chunk i is at offset i * chunk_size
+    received/<part>-<i>     marker of a received chunk, contains its checksum
+    staging/<part>[.nii.gz] extracted files of the part
+    ingested/<part>         marker of an extracted part
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from . import ingest
+
+upload_root = "/usr/src/image-repository/.uploads"
+chunk_size = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+# Uploads without a new chunk for this many hours are removed
+upload_expiry_hours = int(os.getenv("UPLOAD_EXPIRY_HOURS", 24))
+read_buffer_size = 1024 * 1024
+
+ingest_executor = ThreadPoolExecutor(max_workers=int(os.getenv("UPLOAD_INGEST_THREADS", 2)))
+# (upload_id, part) -> future of the extraction
+ingest_futures = {}
+ingest_lock = threading.Lock()
+
+
+def get_upload_path(upload_id) -> str:
+    return os.path.join(upload_root, str(upload_id))
+
+
+def get_chunk_count(size) -> int:
+    # An empty part still has one (empty) chunk
+    return max(1, -(-size // chunk_size))
+
+
+def get_chunk_length(part, index) -> int:
+    return min(chunk_size, part["size"] - index * chunk_size)
+
+
+def create_upload(user_id, project_information, parts) -> dict:
+    """Create an upload. parts is a list of {"sequence_name", "size"}, the part files are allocated right away."""
+    remove_expired_uploads()
+
+    upload_id = str(uuid.uuid4())
+    upload_path = get_upload_path(upload_id)
+    for directory in ["parts", "received", "staging", "ingested"]:
+        os.makedirs(os.path.join(upload_path, directory))
+
+    upload = {
+        "upload_id": upload_id,
+        "user_id": user_id,
+        "project_information": project_information,
+        "chunk_size": chunk_size,
+        "parts": [{"sequence_name": part["sequence_name"], "size": part["size"], "chunks": get_chunk_count(part["size"])} for part in parts],
+    }
+
+    for index, part in enumerate(upload["parts"]):
+        with open(os.path.join(upload_path, "parts", str(index)), "wb") as part_file:
+            part_file.truncate(part["size"])
+
+    temp_path = os.path.join(upload_path, "upload.json.tmp")
+    with open(temp_path, "w") as file:
+        json.dump(upload, file)
+    os.replace(temp_path, os.path.join(upload_path, "upload.json"))
+
+    return upload
+
+
+def load_upload(upload_id):
+    try:
+        with open(os.path.join(get_upload_path(upload_id), "upload.json")) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def get_received_chunks(upload_id) -> dict[int, list[int]]:
+    """Returns the indices of the received chunks of every part."""
+    upload = load_upload(upload_id)
+    received = {part: [] for part in range(len(upload["parts"]))}
+    for marker in os.listdir(os.path.join(get_upload_path(upload_id), "received")):
+        part, index = marker.split("-")
+        received[int(part)].append(int(index))
+    return {part: sorted(indices) for part, indices in received.items()}
+
+
+def get_received_checksum(upload_id, part, index):
+    try:
+        with open(os.path.join(get_upload_path(upload_id), "received", f"{part}-{index}")) as marker:
+            return marker.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_chunk(upload_id, part, index, stream, length) -> str:
+    """Stream a chunk from the request to its offset in the part file. Returns the SHA-256 of the written data, the
+    chunk is only marked as received by mark_chunk_received once the checksum is verified."""
+    sha256 = hashlib.sha256()
+    fd = os.open(os.path.join(get_upload_path(upload_id), "parts", str(part)), os.O_WRONLY)
+    try:
+        offset = index * chunk_size
+        remaining = length
+        while remaining > 0:
+            data = stream.read(min(read_buffer_size, remaining))
+            if not data:
+                raise ValueError(f"Chunk {index} of part {part} ended after {length - remaining} of {length} bytes")
+            sha256.update(data)
+            os.pwrite(fd, data, offset)
+            offset += len(data)
+            remaining -= len(data)
+    finally:
+        os.close(fd)
+    return sha256.hexdigest()
+
+
+def mark_chunk_received(upload_id, part, index, checksum) -> bool:
+    """Mark a chunk as received. Returns True if all chunks of the part are received, the part is extracted in the
+    background then."""
+    upload_path = get_upload_path(upload_id)
+    temp_path = os.path.join(upload_path, f".received-{part}-{index}-{uuid.uuid4()}")
+    with open(temp_path, "w") as marker:
+        marker.write(checksum)
+    os.replace(temp_path, os.path.join(upload_path, "received", f"{part}-{index}"))
+
+    upload = load_upload(upload_id)
+    if len(get_received_chunks(upload_id)[part]) < upload["parts"][part]["chunks"]:
+        return False
+
+    start_ingest(upload_id, part)
+    return True
+
+
+def start_ingest(upload_id, part):
+    """Start the extraction of a complete part, once. Returns the future of the extraction."""
+    with ingest_lock:
+        future = ingest_futures.get((upload_id, part))
+        if future is None:
+            future = ingest_executor.submit(ingest_part, upload_id, part)
+            ingest_futures[(upload_id, part)] = future
+    return future
+
+
+def ingest_part(upload_id, part):
+    upload_path = get_upload_path(upload_id)
+    ingested_marker = os.path.join(upload_path, "ingested", str(part))
+    # Extracted before a restart of the API
+    if os.path.exists(ingested_marker):
+        return
+
+    upload = load_upload(upload_id)
+    sequence_name = upload["parts"][part]["sequence_name"]
+    part_path = os.path.join(upload_path, "parts", str(part))
+    staging_path = os.path.join(upload_path, "staging", str(part))
+    start_time = time.time()
+
+    match upload["project_information"]["file_format"]:
+        case "dicom":
+            os.makedirs(staging_path, exist_ok=True)
+            ingest.extract_dicom_sequences(part_path, {sequence_name: staging_path})
+            os.remove(part_path)
+
+        case "nifti":
+            if sequence_name.endswith(".nii"):
+                ingest.gzip_file(part_path, f"{staging_path}.nii.gz")
+                os.remove(part_path)
+            elif sequence_name.endswith(".nii.gz"):
+                os.replace(part_path, f"{staging_path}.nii.gz")
+
+    open(ingested_marker, "w").close()
+    print(f"Upload {upload_id}: extracted {sequence_name} in {time.time() - start_time:.2f}s")
+
+
+def wait_for_ingest(upload_id):
+    """Wait until all parts are extracted. Raises the error of a failed extraction."""
+    upload = load_upload(upload_id)
+    for part in range(len(upload["parts"])):
+        start_ingest(upload_id, part).result()
+
+
+def move_sequences(upload_id, sequence_directories, nifti_targets, moved_paths):
+    """Move the extracted files of all parts into the folders of the new project. Every move is added to moved_paths
+    as (staging path, target path), so that restore_sequences can undo them."""
+    upload_path = get_upload_path(upload_id)
+    upload = load_upload(upload_id)
+
+    for part, part_information in enumerate(upload["parts"]):
+        sequence_name = part_information["sequence_name"]
+        staging_path = os.path.join(upload_path, "staging", str(part))
+        match upload["project_information"]["file_format"]:
+            case "dicom":
+                os.rmdir(sequence_directories[sequence_name])
+                os.replace(staging_path, sequence_directories[sequence_name])
+                moved_paths.append((staging_path, sequence_directories[sequence_name]))
+            case "nifti":
+                os.replace(f"{staging_path}.nii.gz", nifti_targets[sequence_name])
+                moved_paths.append((f"{staging_path}.nii.gz", nifti_targets[sequence_name]))
+
+
+def restore_sequences(moved_paths):
+    """Move the files of move_sequences back into the upload, after the project could not be saved. A retried
+    completion then finds them again."""
+    for staging_path, target_path in reversed(moved_paths):
+        if os.path.exists(target_path):
+            os.replace(target_path, staging_path)
+
+
+def delete_upload(upload_id):
+    with ingest_lock:
+        for key in [key for key in ingest_futures if key[0] == str(upload_id)]:
+            ingest_futures.pop(key).cancel()
+    shutil.rmtree(get_upload_path(upload_id), ignore_errors=True)
+
+
+def remove_expired_uploads():
+    if not os.path.isdir(upload_root):
+        return
+
+    expired_before = time.time() - upload_expiry_hours * 3600
+    for entry in os.scandir(upload_root):
+        try:
+            # The received folder changes with every chunk
+            if os.path.getmtime(os.path.join(entry.path, "received")) < expired_before:
+                print(f"Removing expired upload {entry.name}")
+                delete_upload(entry.name)
+        except FileNotFoundError:
+            # Upload that is being created or deleted
+            continue
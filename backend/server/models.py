@@ -34,7 +34,7 @@ class Session(db.Model):
     
     session_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
-    session_token = db.Column(db.String(255), nullable=False)
+    session_token = db.Column(db.String(255), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc), nullable=False)
     expires_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc) + timedelta(hours=token_expire_time_in_hours), nullable=False)
 
@@ -120,4 +120,46 @@ class DisplayValues(db.Model):
     t1km_min_display_value_custom = db.Column(db.Integer, nullable=True) 
     t1km_max_display_value_custom = db.Column(db.Integer, nullable=True) 
     t1km_min_display_value_by_dicom_tag = db.Column(db.Integer, nullable=True) 
-    t1km_max_display_value_by_dicom_tag = db.Column(db.Integer, nullable=True) 
\ No newline at end of file
+    t1km_max_display_value_by_dicom_tag = db.Column(db.Integer, nullable=True) 
+
+# Segmentations that were started together by POST /segmentations/batch, e.g. for a cohort
+class SegmentationBatch(db.Model):
+    __tablename__ = 'segmentation_batches'
+
+    batch_id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
+    batch_name = db.Column(db.String(255), nullable=True)
+    date_time = db.Column(db.DateTime, default=datetime.now(timezone.utc), nullable=False)
+
+    # Relationships
+    entries = db.relationship('SegmentationBatchEntry', backref='batch', cascade='all, delete', lazy=True)
+
+
+class SegmentationBatchEntry(db.Model):
+    __tablename__ = 'segmentation_batch_entries'
+
+    batch_id = db.Column(db.String(36), db.ForeignKey('segmentation_batches.batch_id', ondelete='CASCADE'), primary_key=True)
+    segmentation_id = db.Column(db.Integer, db.ForeignKey('segmentations.segmentation_id', ondelete='CASCADE'), primary_key=True)
+
+
+# Segmentations whose result can be reused for the same model and the same preprocessed input (see result_cache.py)
+class ResultCacheEntry(db.Model):
+    __tablename__ = 'result_cache_entries'
+
+    cache_key = db.Column(db.String(64), primary_key=True)
+    segmentation_id = db.Column(db.Integer, db.ForeignKey('segmentations.segmentation_id', ondelete='CASCADE'), primary_key=True, index=True)
+    result_path = db.Column(db.String(1024), nullable=False)
+    date_time = db.Column(db.DateTime, default=datetime.now(timezone.utc), nullable=False)
+
+
+# Durations of the pipeline stages of the jobs of a segmentation (see metrics.py)
+class SegmentationStageTiming(db.Model):
+    __tablename__ = 'segmentation_stage_timings'
+
+    timing_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    segmentation_id = db.Column(db.Integer, db.ForeignKey('segmentations.segmentation_id', ondelete='CASCADE'), nullable=False, index=True)
+    job_id = db.Column(db.String(255), nullable=False)
+    queue = db.Column(db.String(50), nullable=False)
+    stage = db.Column(db.String(50), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False)
+    duration = db.Column(db.Float, nullable=False)  # in seconds
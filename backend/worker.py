@@ -1,23 +1,55 @@
+import os
 import redis
+import GPUtil
 from rq import Connection, Worker
 from multiprocessing import Process
+# Queues per resource, see server/main/scheduler.py
+from server.main.scheduler import REDIS_URL, PREPROCESSING_QUEUE, GPU_QUEUE, CPU_QUEUE, ARCHIVE_QUEUE
 
-REDIS_URL = "redis://redis:6379/0"
-QUEUES = ["my_queue"]
+# Images built at startup, "all" for the preprocessing and all models, a comma-separated list of tags or "" for none
+PREBUILD_IMAGES = os.getenv("PREBUILD_IMAGES", "all")
 
 # Initialize Worker
-def run_worker():
+def run_worker(queues):
+    # Loaded before the first job, so the jobs forked from this process know the local images (see image_registry.py)
+    from server.main import image_registry, tasks
+    if tasks.client is not None:
+        image_registry.watch(tasks.client)
+
     redis_connection = redis.from_url(REDIS_URL)
     with Connection(redis_connection):
-        worker = Worker(QUEUES)
+        worker = Worker(queues)
         worker.work()
 
+def prebuild_images():
+    from server.main import image_registry, tasks
+    if tasks.client is None:
+        return
+    if PREBUILD_IMAGES == "all":
+        image_tags = [image_registry.PREPROCESSING_IMAGE] + image_registry.MODEL_IMAGES
+    else:
+        image_tags = [tag.strip() for tag in PREBUILD_IMAGES.split(",") if tag.strip()]
+    image_registry.prebuild(tasks.client, image_tags)
+
 if __name__ == "__main__":
 
-    number_of_workers = 4 # TODO: Set to number of available GPUs?
+    # One GPU worker per GPU, so that a GPU job is only started when a GPU is free. Without a GPU we still start one
+    # worker, which fails the GPU jobs instead of leaving them in the queue forever.
+    number_of_gpus = len(GPUtil.getGPUs())
+    number_of_workers = {
+        GPU_QUEUE: int(os.getenv("GPU_WORKERS", max(number_of_gpus, 1))),
+        CPU_QUEUE: int(os.getenv("CPU_WORKERS", 1)),
+        PREPROCESSING_QUEUE: int(os.getenv("PREPROCESSING_WORKERS", 2)),
+        ARCHIVE_QUEUE: int(os.getenv("ARCHIVE_WORKERS", 1)),
+    }
+    print(f"Found {number_of_gpus} GPU(s). Starting workers: {number_of_workers}")
+
+    # The builds run next to the workers, a job that needs an image before it is built waits for the build
+    Process(target=prebuild_images).start()
 
-    for i in range(number_of_workers):  
-        worker = Process(target=run_worker)
-        worker.start()
+    for queue, count in number_of_workers.items():
+        for i in range(count):
+            worker = Process(target=run_worker, args=([queue],))
+            worker.start()
 
-# Alternativ könnte man auch die worker container skalieren: docker-compose up --scale worker=2
\ No newline at end of file
+# Alternativ könnte man auch die worker container skalieren: docker-compose up --scale worker=2
@@ -10,6 +10,10 @@ import torchio as tio
 from argparse import Namespace, ArgumentParser
 from segmenter import Segmenter
 
+# Loaded models by (checkpoint, device). When the script runs inside the warm model server of the backend, main() is
+# called once per job in the same process, so the checkpoint only has to be loaded for the first job.
+loaded_models = {}
+
 def get_cmd_args() -> Namespace:
     """Get the CMD arguments: --lightning-checkpoint, --input-path, and --output-path are required arguments, while --device is optional."""
     parser = ArgumentParser()
@@ -61,9 +65,13 @@ def main():
     os.makedirs(cmd_args.output_path, exist_ok=True)
 
     # Load the model, set it to eval mode, and transfer it to the given device
-    model = Segmenter.load_from_checkpoint(cmd_args.lightning_checkpoint)
-    model.eval()
-    model.to(cmd_args.device)
+    model_key = (cmd_args.lightning_checkpoint, cmd_args.device)
+    if model_key not in loaded_models:
+        model = Segmenter.load_from_checkpoint(cmd_args.lightning_checkpoint)
+        model.eval()
+        model.to(cmd_args.device)
+        loaded_models[model_key] = model
+    model = loaded_models[model_key]
 
     hyperparams = model.hparams
 
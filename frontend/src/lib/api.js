@@ -113,6 +113,123 @@ export async function uploadProjectDataAPI(data) {
 }
 
 
+// Number of chunks that are uploaded at the same time and how often a chunk is retried
+const UPLOAD_PARALLEL_CHUNKS = 3;
+const UPLOAD_CHUNK_RETRIES = 5;
+
+async function sha256Hex(blob) {
+    const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
+async function uploadChunk(uploadID, partIndex, chunkIndex, chunk) {
+    const checksum = await sha256Hex(chunk);
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const response = await fetch(`${API_BASE_URL}/uploads/${uploadID}/parts/${partIndex}/chunks/${chunkIndex}`, {
+                method: 'PUT',
+                headers: {
+                    ...getAuthHeaders(),
+                    'Content-Type': 'application/octet-stream',
+                    'X-Chunk-SHA256': checksum,
+                },
+                body: chunk,
+            });
+            if (response.ok) {
+                return;
+            }
+            // Only a corrupted transfer (checksum mismatch) or a server error is worth a retry
+            if (response.status !== 422 && response.status < 500) {
+                throw new Error(`Upload of chunk ${chunkIndex} of part ${partIndex} failed: ${response.statusText}`);
+            }
+        } catch (error) {
+            // fetch throws a TypeError if the connection dropped
+            if (!(error instanceof TypeError) || attempt >= UPLOAD_CHUNK_RETRIES) {
+                throw error;
+            }
+        }
+        if (attempt >= UPLOAD_CHUNK_RETRIES) {
+            throw new Error(`Upload of chunk ${chunkIndex} of part ${partIndex} failed`);
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+    }
+}
+
+/**
+ * Uploads a new project in chunks, see backend/server/main/uploads.py. Every part is the zip of one DICOM sequence
+ * folder or one NIfTI file, the backend starts extracting a part as soon as it is complete. Chunks that already
+ * arrived (e.g. before a dropped connection) are skipped.
+ * @param projectInformation The project information as for uploadProjectDataAPI.
+ * @param parts List of {sequenceName, blob}.
+ * @param uploadID ID of an unfinished upload to resume, optional.
+ * @returns The answer of the project creation, like uploadProjectDataAPI.
+ */
+export async function uploadProjectInChunksAPI(projectInformation, parts, uploadID = null) {
+    let upload;
+    if (uploadID) {
+        const response = await fetch(`${API_BASE_URL}/uploads/${uploadID}`, {
+            method: 'GET',
+            headers: {
+                ...getAuthHeaders(),
+            },
+        });
+        if (response.ok) {
+            upload = await response.json();
+        }
+    }
+    if (!upload) {
+        const response = await fetch(`${API_BASE_URL}/uploads`, {
+            method: 'POST',
+            headers: {
+                ...getAuthHeaders(),
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                project_information: projectInformation,
+                parts: parts.map(part => ({ sequence_name: part.sequenceName, size: part.blob.size })),
+            }),
+        });
+        if (!response.ok) {
+            console.error('Fehler bei der Anfrage:', response.statusText);
+            return undefined;
+        }
+        upload = await response.json();
+    }
+
+    // All chunks that are still missing, part after part, so that the first sequences can be extracted early
+    const chunks = [];
+    upload.parts.forEach((part, partIndex) => {
+        const received = new Set(part.received_chunks || []);
+        for (let chunkIndex = 0; chunkIndex < part.chunks; chunkIndex++) {
+            if (!received.has(chunkIndex)) {
+                const start = chunkIndex * upload.chunk_size;
+                chunks.push([partIndex, chunkIndex, parts[partIndex].blob.slice(start, start + upload.chunk_size)]);
+            }
+        }
+    });
+
+    const workers = Array.from({ length: UPLOAD_PARALLEL_CHUNKS }, async () => {
+        while (chunks.length > 0) {
+            const [partIndex, chunkIndex, chunk] = chunks.shift();
+            await uploadChunk(upload.upload_id, partIndex, chunkIndex, chunk);
+        }
+    });
+    await Promise.all(workers);
+
+    const response = await fetch(`${API_BASE_URL}/uploads/${upload.upload_id}/complete`, {
+        method: 'POST',
+        headers: {
+            ...getAuthHeaders(),
+        },
+    });
+    if (!response.ok) {
+        console.error('Fehler bei der Anfrage:', response.statusText);
+        return undefined;
+    }
+    return await response.json();
+}
+
+
 export async function uploadSequenceTypesAPI(data) {
     let result;
 
@@ -146,6 +263,27 @@ export async function startSegmentationAPI(data) {
 }
 
 
+// Start the segmentations of many subjects with many models, see POST /segmentations/batch
+export async function startSegmentationBatchAPI(data) {
+    return await fetch(`${API_BASE_URL}/segmentations/batch`, {
+        method: 'POST',
+        headers: {
+            ...getAuthHeaders(),
+            'Content-Type': 'application/json',
+        },
+        body: data
+    })
+}
+
+
+export async function getSegmentationBatchStatusAPI(batchID) {
+    return await fetch(`${API_BASE_URL}/segmentations/batch/${batchID}`, {
+        method: 'GET',
+        headers: getAuthHeaders()
+    })
+}
+
+
 export async function getNifti() { 
     const response = await fetch(`${API_BASE_URL}/test-nifti`, {
         method: 'GET',
@@ -218,15 +356,47 @@ export async function getBaseImagesBySegmentationIdAPI(segmentationID) {
 
 
 export async function getRawSegmentationDataAPI(segmentationID) {
-    const response = await fetch(`${API_BASE_URL}/images/segmentations/${segmentationID}/rawsegmentation`, {
+    // Binary label map (the browser decompresses zstd/gzip transparently), see backend images/helper.py
+    const response = await fetch(`${API_BASE_URL}/images/segmentations/${segmentationID}/rawsegmentation/binary`, {
         method: 'GET',
         headers: {
             ...getAuthHeaders(),
-            'Content-Type': 'application/json',
         },
     })
 
-    return response.json();
+    if (!response.ok) {
+        console.error('Error fetching segmentation:', response.statusText);
+        return { segmentation: [] };
+    }
+
+    return { segmentation: decodeBinarySegmentation(await response.arrayBuffer()) };
+}
+
+// Header: magic "BSEG", version, encoding (0 = raw, 1 = rle), bytes per voxel, padding,
+// shape z, y, x (uint32), spacing x, y, z (float64), all little-endian. Returns the voxels as flat typed array.
+function decodeBinarySegmentation(buffer) {
+    const header = new DataView(buffer, 0, 44);
+    const encoding = header.getUint8(5);
+    const bytesPerVoxel = header.getUint8(6);
+    const shape = [header.getUint32(8, true), header.getUint32(12, true), header.getUint32(16, true)];
+    const VoxelArray = bytesPerVoxel === 1 ? Uint8Array : Uint16Array;
+
+    if (encoding === 0) {
+        return new VoxelArray(buffer.slice(44));
+    }
+
+    // Run-length encoded: (length uint32, value) pairs
+    const voxels = new VoxelArray(shape[0] * shape[1] * shape[2]);
+    const runs = new DataView(buffer, 44);
+    const runSize = 4 + bytesPerVoxel;
+    let offset = 0;
+    for (let i = 0; i + runSize <= runs.byteLength; i += runSize) {
+        const length = runs.getUint32(i, true);
+        const value = bytesPerVoxel === 1 ? runs.getUint8(i + 4) : runs.getUint16(i + 4, true);
+        voxels.fill(value, offset, offset + length);
+        offset += length;
+    }
+    return voxels;
 }
 
 
@@ -305,6 +475,45 @@ export async function getDicomFromNifti(data) {
 }
 
 
+// Reads the server-sent status events of the backend and calls onStatuses with each mapping of segmentation IDs to
+// statuses. Uses fetch instead of EventSource, because EventSource can't send the Authorization header.
+export async function readSegmentationStatusStreamAPI(signal, onStatuses) {
+    const response = await fetch(`${API_BASE_URL}/segmentations/status/stream`, {
+        method: 'GET',
+        headers: {
+            ...getAuthHeaders(),
+            'Accept': 'text/event-stream',
+        },
+        signal,
+    })
+
+    if (!response.ok || !response.body) {
+        throw new Error("Status stream not available");
+    }
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            throw new Error("Status stream closed");
+        }
+        buffer += value;
+
+        // Events are separated by an empty line, lines starting with ":" are keepalive comments
+        let end;
+        while ((end = buffer.indexOf("\n\n")) !== -1) {
+            const event = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            const data = event.split("\n").filter(line => line.startsWith("data: ")).map(line => line.slice(6)).join("\n");
+            if (data) {
+                onStatuses(JSON.parse(data));
+            }
+        }
+    }
+}
+
+
 export async function getAllSegmentationStatusesAPI() {
     return await fetch(`${API_BASE_URL}/segmentations/status`, {
         method: 'GET',
@@ -66,7 +66,8 @@ async function addSegmentationsToState(segmentationId) {
 
         const voxelManager = derivedVolume.voxelManager;
         const length = voxelManager.getScalarDataLength();
-        const flatSegmentationArray = segmentationArray.flat(Infinity); 
+        // The binary segmentation API already returns a flat typed array
+        const flatSegmentationArray = ArrayBuffer.isView(segmentationArray) ? segmentationArray : segmentationArray.flat(Infinity); 
 
         for (let i = 0; i < length; i++) {
             const segmentationValue = flatSegmentationArray[i] || 0;
@@ -2,7 +2,7 @@ import {writable, readable, get} from "svelte/store"
 import { Project } from "./Project.js"
 import { Segmentation, SegmentationStatus } from "./Segmentation.js"
 import { Sequence, DicomSequence, NiftiSequence } from "./Sequence.js"
-import { getAllSegmentationStatusesAPI } from '../lib/api.js'
+import { getAllSegmentationStatusesAPI, readSegmentationStatusStreamAPI } from '../lib/api.js'
 
 
 export const AvailableModels = [
@@ -217,7 +217,7 @@ export async function startPolling() {
     
     // Only start polling if such a segmentation exists
     if (shouldStartPolling) {
-        pollSegmentationStatuses(StatusPollingIntervalMs);
+        streamSegmentationStatuses(StatusPollingIntervalMs);
     } else {
         isPolling.set(false); 
     }
@@ -226,6 +226,44 @@ export async function startPolling() {
 export async function stopPolling() {
     isPolling.set(false)
     clearInterval(pollingInterval)
+    statusStreamController?.abort()
+}
+
+
+let statusStreamController;
+
+function hasOngoingSegmentations() {
+    return get(Projects).some(project =>
+        project.segmentations.some(segmentation =>
+            ["QUEUEING", "PREPROCESSING", "PREDICTING"].includes(segmentation.status.id)
+        )
+    );
+}
+
+/**
+ * Receives the status changes pushed by the backend. Falls back to polling if the stream is not available.
+ * @param {The polling interval in milliseconds for the fallback} pollIntervalMs 
+ */
+async function streamSegmentationStatuses(pollIntervalMs) {
+    statusStreamController = new AbortController();
+    try {
+        await readSegmentationStatusStreamAPI(statusStreamController.signal, segmentationStatuses => {
+            updateSegmentationStatus(segmentationStatuses);
+
+            // Stop when no more ongoing segmentations
+            if (!hasOngoingSegmentations()) {
+                stopPolling();
+            }
+        });
+    } catch (error) {
+        if (error.name === "AbortError") {
+            return;
+        }
+        console.warn("Segmentation status stream failed, falling back to polling:", error);
+        if (get(isPolling)) {
+            pollSegmentationStatuses(pollIntervalMs).catch(error => console.error(error));
+        }
+    }
 }
 
 
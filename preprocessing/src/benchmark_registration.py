@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+import brainpp_config as config
+from preprocess.register import rigid_register
+
+description = '''
+Compares the registration backends (FSL flirt and SimpleITK) in speed and accuracy. Registers the resampled sequences
+of a subject (the <subject>_<seq>_resample.nii.gz files in the working folder of a preprocessing run) or of a
+synthetic subject to the reference sequence with each backend and reports the time and the normalized mutual
+information (NMI) of every registered sequence with the reference. The synthetic sequences are the reference with other
+contrasts, moved by known transforms, so for them the normalized cross correlation (NCC) with the ground truth is
+reported as well.
+'''
+
+
+def normalized_mutual_information(image, reference, mask, bins=64):
+    joint, _, _ = np.histogram2d(image[mask], reference[mask], bins=bins)
+    joint = joint / joint.sum()
+    p_image, p_reference = joint.sum(axis=1), joint.sum(axis=0)
+    entropy = lambda p: -np.sum(p[p > 0] * np.log(p[p > 0]))
+    return (entropy(p_image) + entropy(p_reference)) / entropy(joint.ravel())
+
+
+def normalized_cross_correlation(image, reference, mask):
+    a, b = image[mask] - image[mask].mean(), reference[mask] - reference[mask].mean()
+    return float(np.sum(a * b) / np.sqrt(np.sum(a * a) * np.sum(b * b)))
+
+
+def make_synthetic_subject(folder, subject_id, size):
+    """Write a reference (t1c) and three sequences with other contrasts, rotated by a few degrees, scaled and shifted.
+    Returns the ground truth of each sequence in the reference space."""
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, size)] * 3, indexing='ij')
+    radius = np.sqrt((x / 0.8) ** 2 + (y / 0.9) ** 2 + (z / 0.7) ** 2)
+    tissue = np.clip(1.2 - radius, 0, None) + 0.3 * (np.sin(6 * x) * np.cos(5 * y) * np.sin(4 * z) + 1) * (radius < 0.9)
+    contrasts = {'t1c': lambda v: v, 't1': lambda v: v ** 2, 't2': lambda v: np.log1p(4 * v), 'flair': lambda v: np.sqrt(v)}
+    moves = {'t1': (4, 3.0, 1.02), 't2': (-6, -4.0, 0.97), 'flair': (3, 5.0, 1.0)}
+
+    truth = {}
+    for seq, contrast in contrasts.items():
+        image = sitk.GetImageFromArray((contrast(tissue) * 1000).astype(np.float32))
+        truth[seq] = sitk.GetArrayFromImage(image)
+        if seq in moves:
+            angle, shift, scale = moves[seq]
+            transform = sitk.ScaleVersor3DTransform()
+            transform.SetCenter([(size - 1) / 2] * 3)
+            transform.SetRotation((0, 0, 1), np.deg2rad(angle))
+            transform.SetTranslation((shift, -shift / 2, shift / 3))
+            transform.SetScale((scale, scale, scale))
+            image = sitk.Resample(image, image, transform, sitk.sitkLinear, 0.0)
+        sitk.WriteImage(image, os.path.join(folder, f"{subject_id}_{seq}_resample.nii.gz"))
+    return truth
+
+
+def run_backend(backend, input_folder, subject_id, sequences, reference_seq, dof, max_jobs):
+    working_dir = tempfile.mkdtemp(prefix=f"register-{backend}-")
+    subject = config.SubjectConfig(subject_id, working_dir=working_dir)
+    subject.resample_files = {seq: os.path.join(input_folder, f"{subject_id}_{seq}_resample.nii.gz") for seq in sequences}
+    subject.register_files = dict()
+    subject.same_coordinates = dict()
+    subject.label_sequences = []
+
+    started_at = time.time()
+    rigid_register(subject, reference_seq=reference_seq, force=True, max_jobs=max_jobs, backend=backend, dof=dof)
+    return time.time() - started_at, subject
+
+
+def main():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-i', '--input_folder', metavar='folder_path', help='Folder with the resampled sequences, e.g. the temp folder of a run.')
+    parser.add_argument('-p', '--subject_id', metavar='str', default='nifti', help='Set the id or prefix for the subject.')
+    parser.add_argument('--synthetic', metavar='int', type=int, help='Use a synthetic subject with volumes of this size instead.')
+    parser.add_argument('--backends', nargs='+', default=['flirt', 'sitk'], choices=['flirt', 'sitk'], help='Backends to compare.')
+    parser.add_argument('--dof', type=int, default=config.RegistrationDOF, choices=[6, 9, 12], help='Degrees of freedom.')
+    parser.add_argument('-j', '--jobs', type=int, default=config.RegisterJobs, help='Registrations at the same time.')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        input_folder = tempfile.mkdtemp(prefix="register-synthetic-")
+        truth = make_synthetic_subject(input_folder, args.subject_id, args.synthetic)
+    elif args.input_folder:
+        input_folder, truth = args.input_folder, None
+    else:
+        parser.print_help()
+        exit(1)
+
+    sequences = [seq for seq in config.SequenceNames if os.path.isfile(os.path.join(input_folder, f"{args.subject_id}_{seq}_resample.nii.gz"))]
+    reference_seq = config.ReferenceSequence
+    assert reference_seq in sequences, f"No resampled reference sequence {reference_seq} in {input_folder}"
+    reference = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(input_folder, f"{args.subject_id}_{reference_seq}_resample.nii.gz"), sitk.sitkFloat32))
+    mask = reference > np.percentile(reference, 50)
+
+    print(f"{'backend':<8}{'time [s]':>10}  " + "  ".join(f"{seq + ' NMI':>10}" + (f"{seq + ' NCC':>10}" if truth else "") for seq in sequences))
+    for backend in args.backends:
+        if backend == 'flirt' and not os.path.isfile(os.path.join(config.FSLDIR, 'bin', 'flirt')):
+            print(f"{backend:<8}  skipped, FSL not found in {config.FSLDIR}")
+            continue
+        duration, subject = run_backend(backend, input_folder, args.subject_id, sequences, reference_seq, args.dof, args.jobs)
+        columns = []
+        for seq in sequences:
+            registered = sitk.GetArrayFromImage(subject.read_image(subject.register_files[seq], sitk.sitkFloat32))
+            column = f"{normalized_mutual_information(registered, reference, mask):>10.4f}"
+            if truth:
+                column += f"{normalized_cross_correlation(registered, truth[seq], mask):>10.4f}"
+            columns.append(column)
+        print(f"{backend:<8}{duration:>10.2f}  " + "  ".join(columns))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,6 @@
 import os
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import SimpleITK as sitk
 
 BASEDIR = './'
@@ -13,6 +13,32 @@ FSLDIR = './fsl'
 # FSLDIR = os.path.join(BASEDIR, 'FSL')
 # FSLDIR = '/data_marvin2/ehrhardt/projects/Fallstudie/NeuralPreProcessing/FSL'
 
+# Number of flirt registrations that run at the same time (one CPU each)
+RegisterJobs = int(os.environ.get('REGISTER_JOBS', os.cpu_count() or 1))
+# Number of sequences that are resampled at the same time
+ResampleJobs = int(os.environ.get('RESAMPLE_JOBS', os.cpu_count() or 1))
+# 'flirt' (FSL) or 'sitk' (SimpleITK, see preprocess/register_sitk.py), the image only has FSL if it was built for flirt
+RegistrationBackend = os.environ.get('REGISTRATION_BACKEND', 'flirt')
+# Degrees of freedom of the registration: 6 (rigid), 9 (rigid + scaling) or 12 (affine)
+RegistrationDOF = 9
+# Write the intermediate images of all stages to WRKDIR (debugging), otherwise they are passed on in memory and only
+# written if an external tool (flirt) needs them
+KeepIntermediateFiles = os.environ.get('KEEP_INTERMEDIATE_FILES', '0') == '1'
+
+# Skull stripping with NPP: torch device ('cpu', 'cuda', 'cuda:1'), CPU threads of torch (0 keeps the default),
+# precision ('float32' or 'bfloat16') and TorchScript (traced and frozen model, pays off for several subjects)
+SkullstripDevice = os.environ.get('SKULLSTRIP_DEVICE', 'cpu')
+SkullstripThreads = int(os.environ.get('SKULLSTRIP_THREADS', 0))
+SkullstripPrecision = os.environ.get('SKULLSTRIP_PRECISION', 'float32')
+SkullstripTorchScript = os.environ.get('SKULLSTRIP_TORCHSCRIPT', '0') == '1'
+# Subjects in one forward pass, each one is a 256³ volume
+SkullstripBatchSize = int(os.environ.get('SKULLSTRIP_BATCH_SIZE', 1))
+# NPP checkpoint on the Hugging Face Hub and the cache it is kept in, the image has it baked in (see Dockerfile),
+# NPP_CACHE_DIR can also point to a shared volume
+NppRepository = 'hexinzi/NeuralPreProcessing'
+NppCheckpoint = 'npp_v1.pth'
+NppCacheDir = os.environ.get('NPP_CACHE_DIR') or None
+
 SequenceNames = ('t1c', 't1', 't2', 'flair')
 ReferenceSequence = 't1c'
 RequiredSequences = ('t1c', 't1', 't2', 'flair')
@@ -24,15 +50,19 @@ class SubjectConfig:
     input_base_dir: str = DATADIR
     output_base_dir: str = RESULTDIR
     working_dir: str = WRKDIR
-    input_files = dict({seq: None for seq in SequenceNames})
-    input_meta = dict({seq: None for seq in SequenceNames})
-    skullstrip_files = dict()  # a dictionary sequence -> Filename
-    resample_files = dict()  # a dictionary sequence -> Filename
-    register_files = dict()  # a dictionary sequence -> Filename
+    # per subject, several subjects are preprocessed in one process (see main.py)
+    input_files: dict = field(default_factory=lambda: {seq: None for seq in SequenceNames})
+    input_meta: dict = field(default_factory=lambda: {seq: None for seq in SequenceNames})
+    skullstrip_files: dict = field(default_factory=dict)  # a dictionary sequence -> Filename
+    resample_files: dict = field(default_factory=dict)  # a dictionary sequence -> Filename
+    register_files: dict = field(default_factory=dict)  # a dictionary sequence -> Filename
     reference_seq: str = ReferenceSequence
-    same_coordinates = dict()
+    same_coordinates: dict = field(default_factory=dict)
     # same_coordinates = dict({'t2': ['t1', 'flair'], 'flair': ['t1', 't2'], 't1': ['flair', 't2']})  # a dictionary sequence -> sequence to save which sequence is co_registered to which other
-    label_sequences = []  # list of sequences that are labels or segmentation (e.g. for adequat interpolation)
+    label_sequences: list = field(default_factory=list)  # list of sequences that are labels or segmentation (e.g. for adequat interpolation)
+    # The images of the stages by the filenames above, passed from one stage to the next without writing them
+    images: dict = field(default_factory=dict)
+    keep_files: bool = KeepIntermediateFiles
 
     def get_output_dir(self):
         assert os.path.isdir(self.output_base_dir)
@@ -42,6 +72,31 @@ class SubjectConfig:
         assert os.path.isdir(self.working_dir)
         return self.working_dir
 
+    def get_working_filename(self, name: str):
+        # uncompressed, compressing the intermediate images takes longer than writing them
+        return os.path.join(self.get_working_dir(), f"{self.subject_id}_{name}.nii")
+
+    def read_image(self, filename, pixel_type=sitk.sitkUnknown):
+        """The image of a stage, from memory or from the file if it was only written to disk (input, flirt)."""
+        image = self.images.get(filename)
+        if image is None:
+            return sitk.ReadImage(filename, pixel_type)
+        return image if pixel_type in (sitk.sitkUnknown, image.GetPixelID()) else sitk.Cast(image, pixel_type)
+
+    def write_image(self, filename, image, persist=False):
+        """Pass the image of a stage on in memory. It is only written with keep_files or persist."""
+        self.images[filename] = image
+        if self.keep_files or persist:
+            sitk.WriteImage(image, filename)
+
+    def persist_image(self, filename):
+        """Write an image that is only in memory to its file, e.g. as input of flirt."""
+        if filename in self.images and not os.path.isfile(filename):
+            sitk.WriteImage(self.images[filename], filename)
+
+    def has_image(self, filename):
+        return filename is not None and (filename in self.images or os.path.isfile(filename))
+
     def init_filenames(self):
         for seq in self.input_files.keys():
             fname = self.get_input_filename(seq)
@@ -49,14 +104,14 @@ class SubjectConfig:
         skullstrip_sequences = ['brainmask', 'scalar_field']
         # only set other files if not already set/updated
         for seq in [s for s in skullstrip_sequences if not s in self.skullstrip_files]:
-            self.skullstrip_files[seq] = os.path.join(self.get_working_dir(), f"{self.subject_id}_{seq}.nii.gz")
+            self.skullstrip_files[seq] = self.get_working_filename(seq)
         resample_sequences = list(self.input_files.keys()) + skullstrip_sequences + ['resample_mask']
         for seq in [s for s in resample_sequences if not s in self.resample_files]:
             if not seq in self.input_files.keys() or self.input_files[seq] is not None:
-                self.resample_files[seq] = os.path.join(self.get_working_dir(), f"{self.subject_id}_{seq}_resample.nii.gz")
+                self.resample_files[seq] = self.get_working_filename(f"{seq}_resample")
         for seq in [s for s in resample_sequences if not s in self.register_files]:
             if not seq in self.input_files.keys() or self.input_files[seq] is not None:
-                self.register_files[seq] = os.path.join(self.get_working_dir(), f"{self.subject_id}_{seq}_register.nii.gz")
+                self.register_files[seq] = self.get_working_filename(f"{seq}_register")
 
     def init_meta(self):
         self.init_filenames()
@@ -84,6 +139,10 @@ def setup_logger(logger_name, logfile, level=logging.DEBUG):
         os.rename(logfile, logfile + ".bak")
 
     logger = logging.getLogger(logger_name)
+    # the handlers of the previous subject
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
     logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
     fileHandler = logging.FileHandler(logfile, mode='w')
     fileHandler.setFormatter(logFormatter)
@@ -1,12 +1,16 @@
 import sys
 import os
 import argparse
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 
 import SimpleITK as sitk
 
 import brainpp_config as config
 from preprocess.resample import resample_images
-from preprocess.skullstrip import skullstrip_images
+from preprocess.skullstrip import skullstrip_subjects
 from preprocess.register import rigid_register
 from dicom2nifti import dicom2nifti
 
@@ -17,66 +21,119 @@ nate space. If you use NPP in your analysis, please cite:
 '''
 
 
-def main():
-    # parse command line
-    parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('-p', '--subject_id', metavar='str', default='nifti', help='Set the id or prefix for the subject.')
-    parser.add_argument('-i', '--input_folder', metavar='folder_path', default=config.DATADIR, help='set alternative folder to input data.')
-    parser.add_argument('-o', '--output_folder', metavar='folder_path', default=config.RESULTDIR, help='set alternative output folder.')
-    parser.add_argument('-w', '--weight', metavar='float', help='Smoothness of intensity normalization mapping. The range of smoothness is [-3,2],'
-                                                                ' where a larger value implies a higher degree of smoothing',default =-1)
-    parser.add_argument('-s', '--field', action='store_true', help='Save the scalar field map.')
-    parser.add_argument('-g', '--gpu', action='store_true', help='Use the GPU.')
-    parser.add_argument('-f', '--file_format', metavar='str', default='nifti', help='Set the file format of the input data (Accepted: dicom or nifti).')
+# Durations of the preprocessing steps per subject, written to timings.json in the output folder of each subject for
+# the metrics of the worker. A step done for several subjects at once (skull stripping a batch) counts for each.
+timings = defaultdict(list)
 
-    if len(sys.argv) < 1:
-        parser.print_help()
-        exit(1)
 
-    args = parser.parse_args()
+@contextmanager
+def timed(stage, subject_ids):
+    started_at = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - started_at
+        print(f"TIMING {stage}: {duration:.2f}s")
+        for subject_id in subject_ids:
+            timings[subject_id].append({"stage": stage, "started_at": started_at, "duration": duration})
 
-    assert os.path.isdir(args.input_folder), f"Base input folder is not a directory: {args.input_folder} "
-    assert os.path.isdir(args.output_folder), f"Base output folder is not a directory: {args.output_folder} "
-    subject_folder = os.path.join(args.input_folder, args.subject_id)
-    assert os.path.isdir(subject_folder), f"Subject id {args.subject_id} is not present. Subject input folder is not a directory: {subject_folder}"
-    assert os.path.isdir(config.FSLDIR), f"FSL directory {config.FSLDIR} does not exist!"
 
-    if args.file_format == "dicom":
-        dicom2nifti()
+def save_timings(subject: config.SubjectConfig):
+    with open(os.path.join(subject.get_output_dir(), "timings.json"), "w") as f:
+        json.dump(timings[subject.subject_id], f)
+
 
-    subject = config.SubjectConfig(args.subject_id, args.input_folder, args.output_folder)
+def init_subject(subject_id, args):
+    subject_folder = os.path.join(args.input_folder, subject_id)
+    assert os.path.isdir(subject_folder), f"Subject id {subject_id} is not present. Subject input folder is not a directory: {subject_folder}"
+
+    subject = config.SubjectConfig(subject_id, args.input_folder, args.output_folder, keep_files=args.debug)
     subject.init_filenames()
     subject.init_meta()
     for sequ in [k for k in subject.input_files if subject.input_files[k] is not None]:
-        print(f'Subject {args.subject_id} found sequence {sequ} in {subject.input_files[sequ]}')
+        print(f'Subject {subject_id} found sequence {sequ} in {subject.input_files[sequ]}')
     assert not any([True for seq in subject.input_files.keys()
                     if seq in config.RequiredSequences and subject.input_files[seq] is None]), \
         f"Required sequences are missing! Required are {config.RequiredSequences} {subject.input_files}"
 
     print(subject)
     print(subject.input_meta)
+    return subject
+
+
+def register_and_save(subject: config.SubjectConfig, args):
+    with timed("resample", [subject.subject_id]):
+        resample_images(subject, re_center=True)
+    with timed("register", [subject.subject_id]):
+        rigid_register(subject, reference_seq='t1c', backend=args.registration)
 
-    skullstrip_images(subject, weight=args.weight)
-    resample_images(subject, re_center=True)
-    rigid_register(subject, reference_seq='t1c')
+    # The inputs of the registration aren't needed anymore
+    for filename in list(subject.skullstrip_files.values()) + list(subject.resample_files.values()):
+        subject.images.pop(filename, None)
 
     final_sequences = list(config.SequenceNames) + ['brainmask', 'resample_mask', 't1_norm']
-    brainmask = sitk.ReadImage(subject.register_files['brainmask'])
+    brainmask = subject.read_image(subject.register_files['brainmask'])
     for seq in final_sequences:
-        if seq not in subject.register_files or subject.register_files[seq] is None or not os.path.exists(subject.register_files[seq]):
+        if seq not in subject.register_files or not subject.has_image(subject.register_files[seq]):
             print(f"WARNING registered sequence {seq} for subject {subject.subject_id} is missing!")
             continue
         outfile = os.path.join(subject.get_output_dir(), f"{subject.subject_id}_{seq}_register.nii.gz")
         if seq in config.SequenceNames:
             print("  Mask sequence {} with brain mask ...".format(seq))
-            image = sitk.ReadImage(subject.register_files[seq])
+            image = subject.read_image(subject.register_files[seq])
             image = sitk.Mask(image=image, maskImage=brainmask, outsideValue=0)
             sitk.WriteImage(image, outfile)
         else:
-            print("  Copy sequence {} ...".format(seq))
-            syscall = "cp {} {}".format(subject.register_files[seq], outfile)
-            print("    >> {}".format(syscall))
-            os.system(syscall)
+            print("  Save sequence {} ...".format(seq))
+            sitk.WriteImage(subject.read_image(subject.register_files[seq]), outfile)
+    subject.images.clear()
+
+    save_timings(subject)
+
+
+def main():
+    # parse command line
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-p', '--subject_id', metavar='str', nargs='+', default=['nifti'], help='Set the id or prefix for the subject, several'
+                                                                                          ' subjects are skull stripped with one loaded model.')
+    parser.add_argument('-i', '--input_folder', metavar='folder_path', default=config.DATADIR, help='set alternative folder to input data.')
+    parser.add_argument('-o', '--output_folder', metavar='folder_path', default=config.RESULTDIR, help='set alternative output folder.')
+    parser.add_argument('-w', '--weight', metavar='float', help='Smoothness of intensity normalization mapping. The range of smoothness is [-3,2],'
+                                                                ' where a larger value implies a higher degree of smoothing',default =-1)
+    parser.add_argument('-s', '--field', action='store_true', help='Save the scalar field map.')
+    parser.add_argument('-g', '--gpu', action='store_true', help='Use the GPU.')
+    parser.add_argument('--device', metavar='str', default=config.SkullstripDevice, help='Set the torch device of the skull stripping (e.g. cpu or cuda:1).')
+    parser.add_argument('--threads', metavar='int', type=int, default=config.SkullstripThreads, help='Set the CPU threads of the skull stripping (0: torch default).')
+    parser.add_argument('--precision', metavar='str', default=config.SkullstripPrecision, choices=['float32', 'bfloat16'], help='Set the precision of the skull stripping.')
+    parser.add_argument('--torchscript', action='store_true', default=config.SkullstripTorchScript, help='Skull strip with a traced and frozen model.')
+    parser.add_argument('-b', '--batch_size', metavar='int', type=int, default=config.SkullstripBatchSize, help='Set the subjects per forward pass of the skull stripping.')
+    parser.add_argument('-r', '--registration', metavar='str', default=config.RegistrationBackend, choices=['flirt', 'sitk'], help='Set the registration backend (Accepted: flirt or sitk).')
+    parser.add_argument('-d', '--debug', action='store_true', default=config.KeepIntermediateFiles, help='Save the intermediate images of all stages in the working folder.')
+    parser.add_argument('-f', '--file_format', metavar='str', default='nifti', help='Set the file format of the input data (Accepted: dicom or nifti).')
+
+    if len(sys.argv) < 1:
+        parser.print_help()
+        exit(1)
+
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.input_folder), f"Base input folder is not a directory: {args.input_folder} "
+    assert os.path.isdir(args.output_folder), f"Base output folder is not a directory: {args.output_folder} "
+    assert args.registration != 'flirt' or os.path.isdir(config.FSLDIR), f"FSL directory {config.FSLDIR} does not exist!"
+
+    if args.file_format == "dicom":
+        with timed("dicom2nifti", args.subject_id):
+            dicom2nifti()
+
+    # The subjects are preprocessed in batches of batch_size, the model of the skull stripping stays loaded
+    device = 'cuda' if args.gpu else args.device
+    for start in range(0, len(args.subject_id), args.batch_size):
+        subjects = [init_subject(subject_id, args) for subject_id in args.subject_id[start:start + args.batch_size]]
+        with timed("skullstrip", [subject.subject_id for subject in subjects]):
+            skullstrip_subjects(subjects, weight=args.weight, device=device, threads=args.threads, precision=args.precision,
+                                torchscript=args.torchscript, batch_size=args.batch_size)
+        for subject in subjects:
+            register_and_save(subject, args)
 
 
 # Press the green button in the gutter to run the script.
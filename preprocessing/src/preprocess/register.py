@@ -1,17 +1,83 @@
 import os
 import datetime
+import logging
 import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from numpy.distutils.command.config import config
+import SimpleITK as sitk
 
 import brainpp_config as config
+from preprocess import register_sitk
 
 
-def rigid_register(subject: config.SubjectConfig, reference_seq='t1', force=False):
-    assert os.path.isdir(config.FSLDIR), f"FSL not found in {config.FSLDIR} !"
-    os.environ["FSLOUTPUTTYPE"] = "NIFTI_GZ"
-    FLIRTCMD = os.path.join(config.FSLDIR, 'bin', 'flirt')
-    assert os.path.isfile(FLIRTCMD), f"FSL flirt not found in {FLIRTCMD} !"
+def copy_sequence(logger, subject, infile, outfile):
+    logger.info("    >> {} -> {}".format(infile, outfile))
+    subject.write_image(outfile, subject.read_image(infile))
+
+
+def run_flirt(logger, syscall, output_level=logging.INFO):
+    logger.info("    >> {}".format(syscall))
+    call_output = subprocess.run(syscall.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    logger.log(output_level, "    {}".format(call_output.stdout.decode('utf-8')))
+
+
+def apply_transform(logger, co_registered_to, co_registered_lta, syscall):
+    # check for lta file
+    if not os.path.isfile(co_registered_lta):
+        logger.error("ERROR: transform file of sequence {} does not exist - re-order processing list of sequences !".format(co_registered_to))
+        return
+    run_flirt(logger, syscall)
+
+
+def sitk_register(logger, subject, reference_image, infile, outfile, transform_file, is_label, dof, number_of_threads):
+    moving_image = subject.read_image(infile, sitk.sitkFloat32)
+    transform, metric_value, stop_condition = register_sitk.register(reference_image, moving_image, dof, number_of_threads)
+    logger.debug("    Registered {} (metric {:.4f}): {}".format(infile, metric_value, stop_condition))
+    sitk.WriteTransform(transform, transform_file)
+    # The input in its own pixel type, the float copy was only for the metric
+    subject.write_image(outfile, register_sitk.resample(subject.read_image(infile), reference_image, transform, is_label))
+
+
+def sitk_apply_transform(logger, co_registered_to, subject, reference_image, infile, outfile, transform_file, is_label):
+    if not os.path.isfile(transform_file):
+        logger.error("ERROR: transform file of sequence {} does not exist - re-order processing list of sequences !".format(co_registered_to))
+        return
+    transform = sitk.ReadTransform(transform_file)
+    subject.write_image(outfile, register_sitk.resample(subject.read_image(infile), reference_image, transform, is_label))
+
+
+def submit_after(executor, parent, function, *args):
+    """Submit function to the executor when the parent job has finished, without blocking a worker while waiting.
+    Returns a future of the result."""
+    result = Future()
+
+    def forward(job):
+        if job.exception() is not None:
+            result.set_exception(job.exception())
+        else:
+            result.set_result(job.result())
+
+    def submit(parent_job):
+        if parent_job.exception() is not None:
+            result.set_exception(parent_job.exception())
+        else:
+            executor.submit(function, *args).add_done_callback(forward)
+
+    parent.add_done_callback(submit)
+    return result
+
+
+def rigid_register(subject: config.SubjectConfig, reference_seq='t1', force=False, max_jobs=config.RegisterJobs,
+                   backend=config.RegistrationBackend, dof=config.RegistrationDOF):
+    """Register all resampled sequences to reference_seq with FSL flirt (backend 'flirt') or with the
+    ImageRegistrationMethod of SimpleITK (backend 'sitk', see register_sitk.py)."""
+    assert backend in ('flirt', 'sitk'), f"Unknown registration backend {backend} !"
+    if backend == 'flirt':
+        assert os.path.isdir(config.FSLDIR), f"FSL not found in {config.FSLDIR} !"
+        # flirt reads and writes files, uncompressed like the other intermediate images
+        os.environ["FSLOUTPUTTYPE"] = "NIFTI"
+        FLIRTCMD = os.path.join(config.FSLDIR, 'bin', 'flirt')
+        assert os.path.isfile(FLIRTCMD), f"FSL flirt not found in {FLIRTCMD} !"
     # Initialize output directory and logging info
     patid = subject.subject_id
     OUTPATDIR = subject.get_working_dir()
@@ -20,10 +86,11 @@ def rigid_register(subject: config.SubjectConfig, reference_seq='t1', force=Fals
     logger = config.setup_logger('register', os.path.join(OUTPATDIR, "rigid_register.log"))
     logger.info("Start Registration at " + datetime.datetime.now().strftime("%d. %m. %Y at %H:%M:%S"))
     logger.info("Patient: " + patid)
+    logger.info("Registration backend: " + backend)
 
     # check if reference sequence is already resampled
     reference_image_filename = subject.resample_files[reference_seq] if reference_seq in subject.resample_files else None
-    if reference_image_filename is None or not os.path.isfile(reference_image_filename):
+    if not subject.has_image(reference_image_filename):
         logger.error('ERROR: No resampled reference file for patient {} !'.format(patid))
         logger.error('ERROR: Expected reference file: {}'.format(reference_image_filename))
         return False
@@ -32,8 +99,8 @@ def rigid_register(subject: config.SubjectConfig, reference_seq='t1', force=Fals
     for sequ in subject.resample_files:
         registration_dict[sequ] = {
             'input': subject.resample_files[sequ],
-            'output': os.path.join(OUTPATDIR, f"{patid}_{sequ}_register.nii.gz"),
-            'transform': os.path.join(OUTPATDIR, f"{patid}_{sequ}_registered.lta"),
+            'output': subject.get_working_filename(f"{sequ}_register"),
+            'transform': os.path.join(OUTPATDIR, f"{patid}_{sequ}_registered.{'lta' if backend == 'flirt' else 'tfm'}"),
             'co_registered_to': subject.same_coordinates[sequ] if sequ in subject.same_coordinates else [],
             'interpolation': 'trilinear' if sequ not in subject.label_sequences else 'nearestneighbour -datatype char'
         }
@@ -42,54 +109,66 @@ def rigid_register(subject: config.SubjectConfig, reference_seq='t1', force=Fals
     #
     # Start registration of all sequences
     #
-    ready_registered = []
+    # The registrations to the reference are independent and run concurrently (flirt is single-threaded), up to
+    # max_jobs at a time. A sequence co-registered to another one gets the transform of that sequence applied as soon
+    # as its registration has finished.
     reffile = reference_image_filename
-    for sequ in subject.resample_files:
-        sequ_dict = registration_dict[sequ]
-        infile = sequ_dict['input']
-        outfile = sequ_dict['output']
-        co_registered_sequ = [s for s in ready_registered if s in sequ_dict['co_registered_to']]
-        co_registered_lta = None if not co_registered_sequ else registration_dict[co_registered_sequ[0]]['transform']
-        # check if sequence exists
-        if infile is None or not os.path.isfile(infile):
-            logger.warning('WARNING: No resampled {} sequence file for patient {} found !'.format(sequ, patid))
-            continue
-
-        if sequ == reference_seq:
-            logger.info("  Copy sequence {} ...".format(sequ))
-            syscall = "cp {} {}".format(sequ_dict['input'], sequ_dict['output'])
-            logger.info("    >> {}".format(syscall))
-            os.system(syscall)
-        elif sequ_dict['co_registered_to'] is not None and reference_seq in sequ_dict['co_registered_to']:
-            logger.info("  Copy sequence {} (co-registered with {}) ...".format(sequ, reference_seq))
-            syscall = "cp {} {}".format(sequ_dict['input'], sequ_dict['output'])
-            logger.info("    >> {}".format(syscall))
-            os.system(syscall)
-        elif co_registered_lta is not None:
-            logger.info("  Transform sequence {} (apply transform of co-registered sequence {}) ...".format(sequ, co_registered_sequ[0]))
-            # check for lta file
-            if not os.path.isfile(co_registered_lta):
-                logger.error("ERROR: transform file of sequence {} does not exist - re-order processing list of sequences !".format(sequ_dict['co_registered_to']))
+    if backend == 'flirt':
+        # the other stages pass the images on in memory, flirt needs the files
+        subject.persist_image(reffile)
+    if backend == 'sitk':
+        # Read once and shared by all registrations, ITK spreads each registration over the CPUs left by the others
+        reference_image = subject.read_image(reffile, sitk.sitkFloat32)
+        number_of_threads = max(1, (os.cpu_count() or 1) // max(1, min(max_jobs, len(subject.resample_files))))
+    jobs = dict()
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        for sequ in subject.resample_files:
+            sequ_dict = registration_dict[sequ]
+            infile = sequ_dict['input']
+            outfile = sequ_dict['output']
+            co_registered_sequ = [s for s in jobs if s in sequ_dict['co_registered_to']]
+            co_registered_lta = None if not co_registered_sequ else registration_dict[co_registered_sequ[0]]['transform']
+            # check if sequence exists
+            if not subject.has_image(infile):
+                logger.warning('WARNING: No resampled {} sequence file for patient {} found !'.format(sequ, patid))
                 continue
-            interp = sequ_dict['interpolation']
-            syscall = "{} -in {} -ref {} -applyxfm -init {} -interp {} -out {}".format(FLIRTCMD, infile, reffile, co_registered_lta, interp, outfile)
-            logger.info("    >> {}".format(syscall))
-            call_output = subprocess.run(syscall.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            logger.info("    {}".format(call_output.stdout.decode('utf-8')))
-        else:
-            logger.info("  Register {} to {} ...".format(sequ, reference_seq))
-            out_lta_file = sequ_dict['transform']
-            interp = sequ_dict['interpolation']
-            if not os.path.exists(out_lta_file) or force:
-                #CALL="${FSLPATH}/bin/flirt -in ${t1_image} -ref ${t1c_image} -omat ${out_t1_transform} -o ${out_t1_image} -cost normmi -dof 9"
-                syscall = "{} -in {} -ref {} -omat {} -interp {} -o {} -cost normmi -dof 9 -v".format(FLIRTCMD, infile, reffile, out_lta_file, interp, outfile)
-                logger.info("    >> {}".format(syscall))
-                call_output = subprocess.run(syscall.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                logger.debug("    {}".format(call_output.stdout.decode('utf-8')))
+
+            if sequ == reference_seq:
+                logger.info("  Copy sequence {} ...".format(sequ))
+                jobs[sequ] = executor.submit(copy_sequence, logger, subject, infile, outfile)
+            elif sequ_dict['co_registered_to'] is not None and reference_seq in sequ_dict['co_registered_to']:
+                logger.info("  Copy sequence {} (co-registered with {}) ...".format(sequ, reference_seq))
+                jobs[sequ] = executor.submit(copy_sequence, logger, subject, infile, outfile)
+            elif co_registered_lta is not None:
+                logger.info("  Transform sequence {} (apply transform of co-registered sequence {}) ...".format(sequ, co_registered_sequ[0]))
+                if backend == 'sitk':
+                    jobs[sequ] = submit_after(executor, jobs[co_registered_sequ[0]], sitk_apply_transform, logger, sequ_dict['co_registered_to'],
+                                              subject, reference_image, infile, outfile, co_registered_lta, sequ in subject.label_sequences)
+                else:
+                    subject.persist_image(infile)
+                    interp = sequ_dict['interpolation']
+                    syscall = "{} -in {} -ref {} -applyxfm -init {} -interp {} -out {}".format(FLIRTCMD, infile, reffile, co_registered_lta, interp, outfile)
+                    jobs[sequ] = submit_after(executor, jobs[co_registered_sequ[0]], apply_transform, logger, sequ_dict['co_registered_to'], co_registered_lta, syscall)
             else:
-                logger.info("  Transform file exist, SKIP registration.")
-        ready_registered.append(sequ)
-        subject.register_files[sequ] = sequ_dict['output']
+                logger.info("  Register {} to {} ...".format(sequ, reference_seq))
+                out_lta_file = sequ_dict['transform']
+                interp = sequ_dict['interpolation']
+                if (not os.path.exists(out_lta_file) or force) and backend == 'sitk':
+                    jobs[sequ] = executor.submit(sitk_register, logger, subject, reference_image, infile, outfile, out_lta_file,
+                                                 sequ in subject.label_sequences, dof, number_of_threads)
+                elif not os.path.exists(out_lta_file) or force:
+                    subject.persist_image(infile)
+                    #CALL="${FSLPATH}/bin/flirt -in ${t1_image} -ref ${t1c_image} -omat ${out_t1_transform} -o ${out_t1_image} -cost normmi -dof 9"
+                    syscall = "{} -in {} -ref {} -omat {} -interp {} -o {} -cost normmi -dof {} -v".format(FLIRTCMD, infile, reffile, out_lta_file, interp, outfile, dof)
+                    jobs[sequ] = executor.submit(run_flirt, logger, syscall, logging.DEBUG)
+                else:
+                    logger.info("  Transform file exist, SKIP registration.")
+                    jobs[sequ] = executor.submit(lambda: None)
+            subject.register_files[sequ] = outfile
+
+        # Wait for all sequences, a failed copy or call raises here
+        for sequ, job in jobs.items():
+            job.result()
 
     for sequ in subject.register_files:
         logger.info(f"  Sequence {sequ} registered in {subject.register_files[sequ]}")
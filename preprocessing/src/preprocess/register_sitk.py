@@ -0,0 +1,86 @@
+import SimpleITK as sitk
+
+# Transforms by degrees of freedom: rigid, rigid + scaling (like flirt -dof 9) and affine
+transform_types = {
+    6: sitk.VersorRigid3DTransform,
+    9: sitk.ScaleVersor3DTransform,
+    12: lambda: sitk.AffineTransform(3),
+}
+
+# Multi-resolution pyramid: shrink factors and smoothing sigmas (in mm) per level, coarse to fine
+shrink_factors = [4, 2, 1]
+smoothing_sigmas = [2, 1, 0]
+# Levels of the pyramid on which the scalings (dof 9) or the affine parameters (dof 12) are optimized
+fine_levels = 2
+# Fraction of the voxels of the reference that are sampled for the mutual information, with a fixed seed so the
+# result is reproducible
+sampling_percentage = 0.1
+sampling_seed = 42
+histogram_bins = 32
+iterations = 200
+# Voxels the foreground mask of the reference is dilated by, so the edge of the head is part of the metric
+mask_dilation = 3
+
+
+def foreground_mask(image):
+    """The head in image (Otsu threshold), the metric is only sampled in it. Over the whole volume the mutual
+    information also rewards mapping the background of the reference onto the head, e.g. with too small scalings."""
+    return sitk.BinaryDilate(sitk.OtsuThreshold(image, 0, 1), [mask_dilation] * 3)
+
+
+def run_registration(reference_image, reference_mask, moving_image, initial_transform, levels, number_of_threads):
+    registration = sitk.ImageRegistrationMethod()
+    registration.SetMetricAsMattesMutualInformation(numberOfHistogramBins=histogram_bins)
+    registration.SetMetricFixedMask(reference_mask)
+    registration.SetMetricSamplingStrategy(registration.RANDOM)
+    registration.SetMetricSamplingPercentage(sampling_percentage, sampling_seed)
+    registration.SetInterpolator(sitk.sitkLinear)
+
+    registration.SetOptimizerAsRegularStepGradientDescent(learningRate=1.0, minStep=1e-4, numberOfIterations=iterations,
+                                                          relaxationFactor=0.5, gradientMagnitudeTolerance=1e-6)
+    # Rotations, translations and scalings have very different ranges, the scales make one step move the voxels by
+    # about the same distance in every parameter
+    registration.SetOptimizerScalesFromPhysicalShift()
+
+    registration.SetShrinkFactorsPerLevel(shrink_factors[-levels:])
+    registration.SetSmoothingSigmasPerLevel(smoothing_sigmas[-levels:])
+    registration.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+
+    registration.SetInitialTransform(initial_transform, inPlace=True)
+    if number_of_threads:
+        registration.SetNumberOfThreads(number_of_threads)
+
+    registration.Execute(reference_image, moving_image)
+    return registration.GetMetricValue(), registration.GetOptimizerStopConditionDescription()
+
+
+def register(reference_image, moving_image, dof=9, number_of_threads=None):
+    """Register moving_image to reference_image with mutual information on a multi-resolution pyramid. Both images
+    are float32 sitk images. Returns the transform that maps the reference space to the moving image (as expected by
+    sitk.Resample), the final metric value and the stop condition of the optimizer."""
+    assert dof in transform_types, f"Unsupported degrees of freedom {dof}, use one of {list(transform_types)}"
+
+    reference_mask = foreground_mask(reference_image)
+
+    # The rigid alignment first on all levels, then the scalings or affine parameters from there
+    rigid_transform = sitk.CenteredTransformInitializer(reference_image, moving_image, sitk.VersorRigid3DTransform(),
+                                                        sitk.CenteredTransformInitializerFilter.GEOMETRY)
+    metric_value, stop_condition = run_registration(reference_image, reference_mask, moving_image, rigid_transform, len(shrink_factors), number_of_threads)
+    if dof == 6:
+        return rigid_transform, metric_value, stop_condition
+
+    transform = transform_types[dof]()
+    transform.SetCenter(rigid_transform.GetCenter())
+    transform.SetTranslation(rigid_transform.GetTranslation())
+    if dof == 9:
+        transform.SetRotation(rigid_transform.GetVersor())
+    else:
+        transform.SetMatrix(rigid_transform.GetMatrix())
+    metric_value, stop_condition = run_registration(reference_image, reference_mask, moving_image, transform, fine_levels, number_of_threads)
+    return transform, metric_value, stop_condition
+
+
+def resample(moving_image, reference_image, transform, is_label=False):
+    """Resample moving_image onto the grid of reference_image with the transform of register()."""
+    interpolator = sitk.sitkNearestNeighbor if is_label else sitk.sitkLinear
+    return sitk.Resample(moving_image, reference_image, transform, interpolator, 0.0, moving_image.GetPixelID())
@@ -6,6 +6,9 @@ import csv
 import argparse
 import logging
 import datetime
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import brainpp_config as config
 
@@ -19,7 +22,36 @@ def calculate_threshold(image, relative_thresh=0.1):
     return thresh, imgmin, imgmax
 
 
-def resample_images(subject: config.SubjectConfig, reference_seq=None, re_center=False):
+def log_image_info(logger, title, image):
+    logger.info(f'{title}: origin {image.GetOrigin()}, size {image.GetSize()}, spacing {image.GetSpacing()}, '
+                f'direction {image.GetDirection()}, pixel type {image.GetPixelIDTypeAsString()} '
+                f'({image.GetNumberOfComponentsPerPixel()} components)')
+
+
+def resample_sequence(logger, subject, sequence, seq_image, transform, output_size, output_origin, output_spacing,
+                      output_direction, number_of_threads):
+    logger.info(f'  Start resampling sequence {sequence} {"as segmentation" if sequence in subject.label_sequences else ""}...')
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(output_size)
+    resampler.SetTransform(transform)
+    resampler.SetInterpolator(sitk.sitkLinear if not sequence in subject.label_sequences else sitk.sitkLabelGaussian)
+    resampler.SetOutputOrigin(output_origin)
+    resampler.SetOutputSpacing(output_spacing)
+    resampler.SetOutputDirection(output_direction)
+    resampler.SetNumberOfThreads(number_of_threads)
+    resampled_image = resampler.Execute(seq_image)
+    log_image_info(logger, f'  After modification of sequence {sequence}', resampled_image)
+
+    output_file = subject.get_working_filename(f"{sequence}_resample")
+    # sitk.WriteImage(sitk.Cast(resampled_image, sitk.sitkInt16), output_file)
+    logger.info(f"Pass sequence {sequence} on as {output_file} ... ")
+    subject.write_image(output_file, resampled_image)
+    # the part of the mask of anatomical overlap, only for base image sequences t1,t2, t1c flair
+    # (no BinaryThreshold with a large upper threshold, it overflows for integer images)
+    return output_file, resampled_image >= 25 if sequence in config.SequenceNames else None
+
+
+def resample_images(subject: config.SubjectConfig, reference_seq=None, re_center=False, max_jobs=config.ResampleJobs):
     assert reference_seq is None or subject.input_files[reference_seq] is not None, f"No input file for subject {subject.subject_id} and sequence {reference_seq} "
 
     # Initialize output directory and logging info
@@ -51,13 +83,7 @@ def resample_images(subject: config.SubjectConfig, reference_seq=None, re_center
     ref_file = subject.input_files[reference_seq]
     ref_image = sitk.ReadImage(ref_file)
     logger.info(f'Reference file: {ref_file}')
-    logger.info('Reference file meta-data:')
-    logger.info('  origin: ' + str(ref_image.GetOrigin()))
-    logger.info('  size: ' + str(ref_image.GetSize()))
-    logger.info('  spacing: ' + str(ref_image.GetSpacing()))
-    logger.info('  direction: ' + str(ref_image.GetDirection()))
-    logger.info('  pixel type: ' + str(ref_image.GetPixelIDTypeAsString()))
-    logger.info('  number of pixel components: ' + str(ref_image.GetNumberOfComponentsPerPixel()))
+    log_image_info(logger, 'Reference file meta-data', ref_image)
     # output_file = output_dir + '/' + patid + '_' + 't1c' + '_resampled.nii.gz'
     # sitk.WriteImage(sitk.Cast(ref_image, sitk.sitkInt16), output_file)
 
@@ -79,87 +105,64 @@ def resample_images(subject: config.SubjectConfig, reference_seq=None, re_center
         output_size[dim] = int(output_size[dim] * output_spacing[dim])  # not sure if correct
         output_spacing[dim] = 1.0
 
-    # set start transform to identity (we can think about using the image centers ... )
-    transform = sitk.TranslationTransform(3, [0, 0, 0])
-    transform.SetIdentity()
-
     # Select all sequences and files for resampling
     if (set(subject.input_files) - set(subject.skullstrip_files)) != set(subject.input_files):
         logger.error(f"There are duplicate keys in input_files and skullstrip!")
     # make sequence - file -- pairs for all images to resample
-    sequ_file_pairs = list(subject.input_files.items()) + list(subject.skullstrip_files.items())
-
-    mask_image = None
-    seq_translation = None
-
-    for sequence, seq_file in sequ_file_pairs:
+    sequ_file_pairs = []
+    for sequence, seq_file in list(subject.input_files.items()) + list(subject.skullstrip_files.items()):
         # seq_file = config.get_preprocess_filename(sequence, subject=subject, method='resample')
-        if seq_file is None or not os.path.isfile(seq_file):
+        if not subject.has_image(seq_file):
             logger.warning('WARNING: No {} sequence file for patient {} in {} !'.format(sequence, patid, seq_file))
             continue
-        logger.info(f'Resample sequence {sequence} {"(segmentation)" if sequence in subject.label_sequences else ""}...')
-        seq_image = sitk.ReadImage(seq_file)
-        logger.info('  Before modification of sequence {}:'.format(sequence))
-        logger.info('    origin: ' + str(seq_image.GetOrigin()))
-        logger.info('    size: ' + str(seq_image.GetSize()))
-        logger.info('    spacing: ' + str(seq_image.GetSpacing()))
-        logger.info('    direction: ' + str(seq_image.GetDirection()))
-        logger.info('    pixel type: ' + str(seq_image.GetPixelIDTypeAsString()))
-        logger.info('    number of pixel components: ' + str(seq_image.GetNumberOfComponentsPerPixel()))
-        # compute image center
-        seq_extent = np.array(seq_image.GetSpacing()) * np.array(seq_image.GetSize())
-        seq_center = np.array(seq_image.TransformContinuousIndexToPhysicalPoint(np.array(seq_image.GetSize()) / 2))
-        logger.info('    extent: ' + str(seq_extent))
-        logger.info('    center: ' + str(seq_center))
-        # compute center distance and map centers
-        if re_center:
-            dist_to_ref_center = np.linalg.norm(seq_center - ref_center)
-            if dist_to_ref_center > 0.1 * np.linalg.norm(seq_extent):
-                logger.info('  Translate sequence ' + sequence + ' to match reference center!')
-                if seq_translation is None:
-                    seq_translation = seq_center - ref_center
-                transform.SetOffset(seq_translation)
-                logger.info('    translation: ' + str(transform.GetOffset()))
-            else:
-                transform.SetIdentity()
-
-        logger.info(f'  Start resampling sequence {sequence} {"as segmentation" if sequence in subject.label_sequences else ""}...')
-        resampled_image = sitk.Resample(seq_image, output_size, transform,
-                                        sitk.sitkLinear if not sequence in subject.label_sequences else sitk.sitkLabelGaussian,
-                                        output_origin, output_spacing, output_direction)
-
-        logger.info('  After modification of sequence {}:'.format(sequence))
-        logger.info('    origin: ' + str(resampled_image.GetOrigin()))
-        logger.info('    size: ' + str(resampled_image.GetSize()))
-        logger.info('    spacing: ' + str(resampled_image.GetSpacing()))
-        logger.info('    direction: ' + str(resampled_image.GetDirection()))
-        logger.info('    pixel type: ' + str(resampled_image.GetPixelIDTypeAsString()))
-        logger.info('    number of pixel components: ' + str(resampled_image.GetNumberOfComponentsPerPixel()))
-
-        output_file = os.path.join(OUTPATDIR, f"{subject.subject_id}_{sequence}_resample.nii.gz")
-        subject.resample_files[sequence] = output_file
-        # sitk.WriteImage(sitk.Cast(resampled_image, sitk.sitkInt16), output_file)
-        logger.info(f"Save sequence {sequence} to {output_file} ... ")
-        sitk.WriteImage(resampled_image, output_file)
-
-        # update mask to show area of anatomical overlap, update mask only for base image sequences t1,t2, t1c flair
-        if sequence in config.SequenceNames:
-            logger.info('Update mask image ...')
-            if mask_image is None:
-                # initialize mask
-                mask_image = sitk.BinaryThreshold(resampled_image, 25, 10000000)
-            else:
-                # update mask
-                mask_image = sitk.Multiply(mask_image, sitk.BinaryThreshold(resampled_image, 25, 1000000))
+        sequ_file_pairs.append((sequence, seq_file))
+
+    # The sequences are resampled concurrently, max_jobs at a time. ITK releases the GIL and spreads each resampling
+    # over the CPUs left by the others. The images are read here and not in the jobs: after reading a .nii.gz a thread
+    # was about 8 times slower in the LabelGaussian interpolation of the masks (SimpleITK 2.4).
+    number_of_threads = max(1, (os.cpu_count() or 1) // max(1, min(max_jobs, len(sequ_file_pairs))))
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        # The translations in order, all re-centered sequences get the translation of the first one
+        seq_translation = None
+        jobs = dict()
+        for sequence, seq_file in sequ_file_pairs:
+            seq_image = ref_image if seq_file == ref_file else subject.read_image(seq_file)
+            logger.info(f'Resample sequence {sequence} {"(segmentation)" if sequence in subject.label_sequences else ""}...')
+            log_image_info(logger, f'  Before modification of sequence {sequence}', seq_image)
+            # set transform to identity (we can think about using the image centers ... )
+            transform = sitk.TranslationTransform(3, [0, 0, 0])
+            # compute center distance and map centers
+            if re_center:
+                seq_extent = np.array(seq_image.GetSpacing()) * np.array(seq_image.GetSize())
+                seq_center = np.array(seq_image.TransformContinuousIndexToPhysicalPoint(np.array(seq_image.GetSize()) / 2))
+                dist_to_ref_center = np.linalg.norm(seq_center - ref_center)
+                if dist_to_ref_center > 0.1 * np.linalg.norm(seq_extent):
+                    logger.info('  Translate sequence ' + sequence + ' to match reference center!')
+                    if seq_translation is None:
+                        seq_translation = seq_center - ref_center
+                    transform.SetOffset(seq_translation)
+                    logger.info('    translation: ' + str(transform.GetOffset()))
+
+            jobs[sequence] = executor.submit(resample_sequence, logger, subject, sequence, seq_image, transform, output_size,
+                                             output_origin, output_spacing, output_direction, number_of_threads)
+
+        masks = []
+        for sequence, job in jobs.items():
+            subject.resample_files[sequence], mask = job.result()
+            if mask is not None:
+                masks.append(mask)
+
+    logger.info('Build mask image ...')
+    mask_image = functools.reduce(sitk.Multiply, masks)
 
     # print(mask_image)
-    mask_file = os.path.join(OUTPATDIR, f'{subject.subject_id}_resample_mask.nii.gz')
-    logger.info(f'Morphological smoothing and save mask image to {mask_file}.')
+    mask_file = subject.get_working_filename('resample_mask')
+    logger.info(f'Morphological smoothing and pass mask image on as {mask_file}.')
     mask_image = sitk.BinaryMorphologicalOpening(mask_image, (1,1,1))
     subject.resample_files['resample_mask'] = mask_file
     subject.same_coordinates['resample_mask'] = [reference_seq]
     subject.label_sequences.append('resample_mask')
-    sitk.WriteImage(sitk.Cast(mask_image, sitk.sitkUInt8), mask_file)
+    subject.write_image(mask_file, sitk.Cast(mask_image, sitk.sitkUInt8))
 
     logger.info("Finished Resampling at " + datetime.datetime.now().strftime("%d. %m. %Y at %H:%M:%S"))
     logger.info("Finished.")
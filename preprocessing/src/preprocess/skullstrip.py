@@ -14,6 +14,7 @@ from nppy.models.utils import normalize
 from scipy.ndimage import binary_closing, binary_opening
 import SimpleITK as sitk
 import math
+import contextlib
 from importlib import reload
 
 '''
@@ -39,21 +40,99 @@ def preprocess_image(image: sitk.Image):
 '''
 
 
-def skullstrip_images(subject: config.SubjectConfig, reference_seq='t1', weight=None, device='cpu'):
-    assert subject.input_files[reference_seq] is not None, f"No input file for subject {subject.subject_id} and sequence {reference_seq}"
+def volume_to_image(volume: sf.Volume, reference: sitk.Image):
+    """Convert a surfa volume on the grid of reference to a SimpleITK image (surfa x,y,z -> SimpleITK z,y,x)."""
+    data = volume.framed_data[..., 0]
+    data = data.astype(np.uint8) if data.dtype == bool else data
+    image = sitk.GetImageFromArray(np.ascontiguousarray(np.transpose(data, (2, 1, 0))))
+    image.CopyInformation(reference)
+    return image
 
-    checkpoint_path = hf_hub_download(repo_id="hexinzi/NeuralPreProcessing", filename="npp_v1.pth")
-    #logging.shutdown()
-    #reload(logging)
+
+# Loaded NPP models by device, and traced ones by device, precision, weight and input shape. They are kept for the
+# following subjects of the process.
+models = dict()
+traced_models = dict()
+
+
+class WeightedUNet(torch.nn.Module):
+    """The UNet with a fixed smoothness weight, torch.jit.trace only takes tensor inputs."""
+    def __init__(self, model, weight):
+        super().__init__()
+        self.model = model
+        self.weight = weight
+
+    def forward(self, x):
+        return self.model(x, self.weight)
+
+
+def get_checkpoint_path():
+    # the cache first, without asking the hub for a newer revision
+    try:
+        return hf_hub_download(repo_id=config.NppRepository, filename=config.NppCheckpoint, cache_dir=config.NppCacheDir, local_files_only=True)
+    except (FileNotFoundError, ValueError):
+        return hf_hub_download(repo_id=config.NppRepository, filename=config.NppCheckpoint, cache_dir=config.NppCacheDir)
+
+
+def get_device(device, logger):
+    device = torch.device(device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        logger.warning(f'WARNING: device {device} is not available, running on the cpu')
+        device = torch.device('cpu')
+    return device
+
+
+def get_model(device, logger):
+    if str(device) not in models:
+        version = '0.1'
+        logger.info(f'Load Neural Pre-processing model version {version} on the {device}')
+        with torch.no_grad():
+            model = UNet()
+            model.load_state_dict(torch.load(get_checkpoint_path(), map_location=device))
+            model.to(device)
+            model.eval()
+            # no gradients, also lets torch.jit.trace fold the weights cast by autocast into the model
+            model.requires_grad_(False)
+        models[str(device)] = model
+    return models[str(device)]
+
+
+def autocast(device, precision):
+    if precision == 'bfloat16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def predict(input_tensor, weight, device, precision, torchscript, logger):
+    """Run the model on a batch of conformed volumes, returns the normalized images and the scalar fields."""
+    model = get_model(device, logger)
+    with torch.no_grad(), autocast(device, precision):
+        if torchscript:
+            key = (str(device), precision, weight, tuple(input_tensor.shape))
+            if key not in traced_models:
+                logger.info(f'Trace model for input {tuple(input_tensor.shape)} ({precision})')
+                traced_models[key] = torch.jit.freeze(torch.jit.trace(WeightedUNet(model, weight).eval(), input_tensor, check_trace=False))
+            output = traced_models[key](input_tensor)
+        else:
+            output = model(input_tensor, weight)
+        # mni_norm = output[0]  # not used
+        return output[1].float().cpu().numpy(), output[2].float().cpu().numpy()
+
+
+def skullstrip_subjects(subjects, reference_seq='t1', weight=None, device=config.SkullstripDevice, threads=config.SkullstripThreads,
+                        precision=config.SkullstripPrecision, torchscript=config.SkullstripTorchScript, batch_size=config.SkullstripBatchSize):
+    """Skull strip reference_seq of all subjects with one loaded model, batch_size subjects per forward pass."""
+    for subject in subjects:
+        assert subject.input_files[reference_seq] is not None, f"No input file for subject {subject.subject_id} and sequence {reference_seq}"
+    assert precision in ('float32', 'bfloat16'), f"Unknown precision {precision}"
 
     # Initialize output directory and logging info
-    patid = subject.subject_id
-    OUTPATDIR = subject.get_working_dir()
+    OUTPATDIR = subjects[0].get_working_dir()
     os.makedirs(OUTPATDIR, exist_ok=True)
 
     logger = config.setup_logger('skullstrip', os.path.join(OUTPATDIR, "skullstrip.log"))
     logger.info("Start Skullstripping at " + datetime.datetime.now().strftime("%d. %m. %Y at %H:%M:%S"))
-    logger.info("Patient: " + patid)
+    logger.info("Patients: " + ", ".join(subject.subject_id for subject in subjects))
 
     # check args.weight is in the range and float
     if weight is not None:
@@ -64,48 +143,44 @@ def skullstrip_images(subject: config.SubjectConfig, reference_seq='t1', weight=
     # necessary for speed gains (I think)
     torch.backends.cudnn.benchmark = True
     torch.backends.cudnn.deterministic = True
+    if threads:
+        torch.set_num_threads(threads)
+
+    device = get_device(device, logger)
+    logger.info(f'Configuring model on the {device} ({precision}{", TorchScript" if torchscript else ""}, {torch.get_num_threads()} threads)')
+
+    for start in range(0, len(subjects), batch_size):
+        batch = subjects[start:start + batch_size]
+        images, conformed_images = [], []
+        for subject in batch:
+            # load image data for sequence for skullstrip
+            input_path = subject.get_input_filename(reference_seq)
+            image = sf.load_volume(input_path)
+            logger.info(f'Input image read from: {input_path}')
+            # frame check
+            assert image.nframes <= 1, 'Input image cannot have more than 1 frame'
+
+            #i normalize image to [0, 255] and to [0, 1]
+            conformed = normalize(image.copy())
+            # conform image and fit to shape with factors of 64
+            conformed = conformed.conform(voxsize=1.0, dtype='float32',shape=(256,256,256), method='nearest', orientation='LIA')
+            images.append(image)
+            conformed_images.append(conformed)
+
+        # predict the surface distance transform
+        input_tensor = torch.from_numpy(np.stack([conformed.data for conformed in conformed_images])[:, np.newaxis]).to(device)
+        norms, scalar_fields = predict(input_tensor, weight, device, precision, torchscript, logger)
+
+        for subject, image, conformed, norm, scalar_field in zip(batch, images, conformed_images, norms, scalar_fields):
+            save_skullstrip(subject, reference_seq, image, conformed, norm.squeeze().astype(np.int16), scalar_field.squeeze(), logger)
 
-    # configure GPU device
-    is_gpu_available = torch.cuda.is_available()
-    device = torch.device(device)
-    # configure model
-    logger.info(f'Configuring model on the {device}')
-
-    with torch.no_grad():
-        model = UNet()
-        model.to(device)
-        model.eval()
-
-    version = '0.1'
-    logger.info(f'Running Neural Pre-processing model version {version}')
-    #cwd = os.getcwd()
-    #modelfile = os.path.join(cwd,'models/checkpoints', f'npp_v{version}.pth')
-    modelfile = checkpoint_path
-    checkpoint = torch.load(modelfile, map_location=device)
-
-    model.load_state_dict(checkpoint)
-
-    # load image data for sequence for skullstrip
-    input_path = subject.get_input_filename(reference_seq)
-    image = sf.load_volume(input_path)
-    logger.info(f'Input image read from: {input_path}')
-    # frame check
-    assert image.nframes <= 1, 'Input image cannot have more than 1 frame'
-
-    #i normalize image to [0, 255] and to [0, 1]
-    conformed = normalize(image.copy())
-    # conform image and fit to shape with factors of 64
-    conformed = conformed.conform(voxsize=1.0, dtype='float32',shape=(256,256,256), method='nearest', orientation='LIA')
-
-    # predict the surface distance transform
-    with torch.no_grad():
-        input_tensor = torch.from_numpy(conformed.data[np.newaxis, np.newaxis]).to(device)
-        output = model(input_tensor, weight)
-        # mni_norm = output[0].cpu().numpy().squeeze().astype(np.int16)  # not used
-        norm = output[1].cpu().numpy().squeeze().astype(np.int16)
-        scalar_field = output[2].cpu().numpy().squeeze().astype(np.float32)
-
-    logger.info(f'  generate brain mask and normalize {reference_seq} image.')
+    logger.info("Finished skull stripping at " + datetime.datetime.now().strftime("%d. %m. %Y at %H:%M:%S"))
+    logger.info("Finished.")
+
+
+def save_skullstrip(subject: config.SubjectConfig, reference_seq, image, conformed, norm, scalar_field, logger):
+    OUTPATDIR = subject.get_working_dir()
+    logger.info(f'  generate brain mask and normalize {reference_seq} image of {subject.subject_id}.')
     # make brain_mask image and resampled as original image
     brain_mask = np.zeros_like(norm, dtype=np.uint8)
     brain_mask[norm > 0] = 1
@@ -117,25 +192,17 @@ def skullstrip_images(subject: config.SubjectConfig, reference_seq='t1', weight=
     # apply scalar field and brain mask to original image
     image.data = image.data * scalar_field.data * brain_mask.data
 
-    logger.info(f'Save images to {OUTPATDIR} ... ')
-    # write out brain mask, scalar_field and orig image normalized
-    subject.skullstrip_files[f"{reference_seq}_norm"] = os.path.join(OUTPATDIR, f"{subject.subject_id}_{reference_seq}_norm.nii.gz")
-    subject.same_coordinates[f"{reference_seq}_norm"] = [reference_seq]
-    image.save(subject.skullstrip_files[f"{reference_seq}_norm"])
-    subject.skullstrip_files[f"{reference_seq}_brainmask"] = os.path.join(OUTPATDIR, f"{subject.subject_id}_{reference_seq}_brainmask.nii.gz")
-    subject.same_coordinates[f"{reference_seq}_brainmask"] = [reference_seq]
+    logger.info(f'Pass images on{" and save them to " + OUTPATDIR if subject.keep_files else ""} ... ')
+    # The results are on the grid of the input image, they get its geometry as read by SimpleITK
+    input_image = sitk.ReadImage(subject.get_input_filename(reference_seq))
+    # brain mask, scalar_field and orig image normalized
+    for name, volume in ((f"{reference_seq}_norm", image), (f"{reference_seq}_brainmask", brain_mask), (f"{reference_seq}_scalar_field", scalar_field)):
+        subject.skullstrip_files[name] = subject.get_working_filename(name)
+        subject.same_coordinates[name] = [reference_seq]
+        subject.write_image(subject.skullstrip_files[name], volume_to_image(volume, input_image))
     subject.label_sequences.append(f"{reference_seq}_brainmask")
     # add key 'brainmask' in skullstrip dictionary
     subject.skullstrip_files["brainmask"] = subject.skullstrip_files[f"{reference_seq}_brainmask"]
     subject.same_coordinates["brainmask"] = [reference_seq]
     subject.label_sequences.append("brainmask")
-    brain_mask.save(subject.skullstrip_files[f"{reference_seq}_brainmask"])
-    subject.skullstrip_files[f"{reference_seq}_scalar_field"] = os.path.join(OUTPATDIR, f"{subject.subject_id}_{reference_seq}_scalar_field.nii.gz")
-    subject.same_coordinates[f"{reference_seq}_scalar_field"] = [reference_seq]
-    scalar_field.save(subject.skullstrip_files[f"{reference_seq}_scalar_field"])
     logger.debug(f'  saved skullstrip images: {subject.skullstrip_files}')
-
-    logger.info("Finished skull stripping at " + datetime.datetime.now().strftime("%d. %m. %Y at %H:%M:%S"))
-    logger.info("Finished.")
-
-